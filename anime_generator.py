@@ -7,7 +7,9 @@ from storyboard_generator import StoryboardGenerator
 from character_manager import CharacterManager
 from image_generator import ImageGenerator
 from tts_generator import TTSGenerator
-from scene_composer import SceneComposer
+from audio_utils import AUDIO_VARIANT_PROFILES
+from scene_composer import SceneComposer, DEFAULT_DERIVED_SHOTS
+from video_merger import VideoMerger, HlsPlaylist, SEGMENT_PROFILES
 from typing import List, Dict
 import json
 import concurrent.futures
@@ -15,17 +17,27 @@ import threading
 
 
 class AnimeGenerator:
-    def __init__(self, openai_api_key: str = None, provider: str = "qiniu", custom_prompt: str = None, use_ai_analysis: bool = True, session_id: str = None):
+    def __init__(self, openai_api_key: str = None, provider: str = "qiniu", custom_prompt: str = None, use_ai_analysis: bool = True, session_id: str = None, grid_layout: str = None, derive_shots: Dict[str, float] = None, reuse_backgrounds: bool = False,
+                 dedup_threshold: float = None, dedup_scope: str = "task", hedge_policy: Dict = None,
+                 parallel_tts: bool = False, tts_backend: str = 'google', audio_variants=None,
+                 batch_tts: bool = False, segment_dir: str = None):
         load_dotenv()
         
         self.api_key = openai_api_key or os.getenv('OPENAI_API_KEY')
+        # provider="local" 离线生图，无需 API Key（配合 use_ai_analysis=False 可完全离线压测）
+        if not self.api_key and provider == "local":
+            self.api_key = "local"
         if not self.api_key:
             raise ValueError("需要提供 API Key")
         
         self.session_id = session_id
         self.char_mgr = CharacterManager()
-        self.image_gen = ImageGenerator(self.api_key, provider=provider, custom_prompt=custom_prompt)
-        self.tts_gen = TTSGenerator(session_id=session_id)
+        # 根据资源情况选择场景并发数；如启用视频生成，调用方可降低 base/ceil 或 max_workers
+        self.max_workers = min(8, max(2, os.cpu_count() or 4))
+        self.image_gen = ImageGenerator(self.api_key, provider=provider, custom_prompt=custom_prompt,
+                                        dedup_threshold=dedup_threshold, dedup_scope=dedup_scope,
+                                        hedge_policy=hedge_policy, max_concurrency=self.max_workers)
+        self.tts_gen = TTSGenerator(session_id=session_id, parallel_segments=parallel_tts, backend=tts_backend)
         
         
         self.novel_analyzer = None
@@ -34,7 +46,15 @@ class AnimeGenerator:
             self.novel_analyzer = NovelAnalyzer(self.api_key)
             self.storyboard_gen = StoryboardGenerator(self.api_key)
         
-        self.scene_composer = SceneComposer(self.image_gen, self.tts_gen, self.char_mgr, session_id=session_id)
+        self.scene_composer = SceneComposer(self.image_gen, self.tts_gen, self.char_mgr, session_id=session_id, grid_layout=grid_layout, derive_shots=derive_shots, reuse_backgrounds=reuse_backgrounds,
+                                            audio_variants=audio_variants, batch_tts=batch_tts)
+        
+        # 指定 segment_dir 时每个分镜完成后立即在后台编码视频片段，下载时只需流复制拼接；
+        # 同时按顺序把就绪的片段发布到 HLS 播放列表，生成过程中即可开始播放
+        self.segment_dir = segment_dir
+        self.video_merger = VideoMerger(hls=True) if segment_dir else None
+        self.segment_futures_ = []
+        self.hls_playlist_ = None
         
         from common import get_base_dir
         
@@ -89,8 +109,11 @@ class AnimeGenerator:
         if progress_callback:
             progress_callback(base, f'开始并发生成 {total} 个{stage_label}...')
 
-        # 根据资源情况选择线程数；如启用视频生成，调用方可降低 base/ceil 或 max_workers
-        max_workers = min(8, max(2, os.cpu_count() or 4))
+        if self.video_merger:
+            self.hls_playlist_ = HlsPlaylist(self.segment_dir, total,
+                                             bandwidth=SEGMENT_PROFILES[self.video_merger.profile]['bandwidth'])
+
+        max_workers = self.max_workers
 
         def _submit(executor):
             futures = []
@@ -103,6 +126,7 @@ class AnimeGenerator:
             futures = _submit(executor)
             for fut in concurrent.futures.as_completed(futures):
                 idx, scene_metadata = fut.result()
+                self._on_scene_completed(idx, scene_metadata)
                 with lock:
                     results[idx] = scene_metadata
                     completed += 1
@@ -111,11 +135,78 @@ class AnimeGenerator:
 
         return results
 
+    def _on_scene_completed(self, idx, scene_metadata):
+        """分镜的图片和音频已落盘，提交到后台编码池，与其余分镜的生成并行"""
+        if not self.video_merger:
+            return
+        if not scene_metadata or not scene_metadata.get('folder'):
+            self.hls_playlist_.mark_skipped(idx)
+            return
+        try:
+            future = self.video_merger.submit_segment(scene_metadata['folder'], self.segment_dir)
+            future.add_done_callback(lambda f: self._publish_segment(idx, f))
+            self.segment_futures_.append((idx, future))
+        except Exception as e:
+            logging.error(f"提交分镜片段编码失败: {e}")
+            self.hls_playlist_.mark_skipped(idx)
+
+    def _publish_segment(self, idx, future):
+        report = None if future.exception() else future.result()
+        if report and report.get('vtt'):
+            self.hls_playlist_.mark_ready(idx, report['ts'], report['duration'], report['vtt'])
+        else:
+            self.hls_playlist_.mark_skipped(idx)
+
+    def _wait_for_segments(self, progress_callback=None):
+        """等待后台片段编码结束并结束 HLS 播放列表；失败的片段在下载合并时会重新编码"""
+        if not self.video_merger:
+            return
+        pending = [f for _, f in self.segment_futures_ if not f.done()]
+        if pending and progress_callback:
+            progress_callback(95, f'正在编码剩余 {len(pending)} 个视频片段...')
+        failed = 0
+        for idx, future in self.segment_futures_:
+            try:
+                if not future.result():
+                    failed += 1
+            except Exception as e:
+                logging.error(f"后台编码分镜片段失败: {e}")
+                failed += 1
+            # 完成回调可能还没执行，这里再发布一次（重复发布会被忽略）
+            if self.hls_playlist_:
+                self._publish_segment(idx, future)
+        logging.info(f"后台片段编码完成：{len(self.segment_futures_) - failed}/{len(self.segment_futures_)}")
+        self.segment_futures_ = []
+        self.video_merger.shutdown()
+        if self.hls_playlist_:
+            self.hls_playlist_.finish()
+
     def generate_from_novel(self, novel_path: str, 
                           max_scenes: int = None,
                           character_descriptions: Dict[str, str] = None,
                           use_storyboard: bool = True,
                           progress_callback = None) -> Dict:
+        try:
+            metadata = self._generate_scenes(novel_path, max_scenes, character_descriptions,
+                                             use_storyboard, progress_callback)
+        except BaseException:
+            # 生成中途失败也要结束 HLS 播放列表（写入 ENDLIST，播放器不再轮询）并关闭后台编码池
+            self._wait_for_segments()
+            raise
+        self._wait_for_segments(progress_callback)
+        
+        logging.info(f"动漫生成完成！")
+        logging.info(f"总场景数：{metadata['total_scenes']}")
+        logging.info(f"输出目录：{self.output_dir}")
+
+        # 收尾把进度推到 100%
+        if progress_callback:
+            progress_callback(100, f'生成完成：共 {metadata["total_scenes"]} 个场景')
+        
+        return metadata
+    
+    def _generate_scenes(self, novel_path: str, max_scenes: int, character_descriptions: Dict[str, str],
+                         use_storyboard: bool, progress_callback) -> Dict:
         with open(novel_path, 'r', encoding='utf-8') as f:
             novel_text = f.read()
         
@@ -205,6 +296,9 @@ class AnimeGenerator:
                     panels_to_process = storyboard_panels[:max_scenes]
 
                 total = len(panels_to_process)
+                panel_character_designs = {name: design.get('visual_keywords', '') for name, design in character_designs.items()}
+                self.scene_composer.plan_storyboard(panels_to_process, panel_character_designs,
+                                                    character_portraits=character_portraits)
 
                 def worker_panel(panel_idx, panel_info, per_scene_cb):
                     logging.info(f"生成分镜 {panel_idx + 1}/{total}...")
@@ -212,7 +306,7 @@ class AnimeGenerator:
                     scene_metadata = self.scene_composer.create_scene_from_storyboard(
                         scene_index=panel_idx,
                         panel_info=panel_info,
-                        character_designs={name: design.get('visual_keywords', '') for name, design in character_designs.items()}
+                        character_designs=panel_character_designs
                         # , progress_callback=per_scene_cb  # 若支持请取消注释
                     )
                     # 如未支持内部进度，完成时置为 1.0
@@ -351,17 +445,12 @@ class AnimeGenerator:
         }
         
         self._save_project_metadata(metadata)
-        
-        logging.info(f"动漫生成完成！")
-        logging.info(f"总场景数：{len(all_scenes)}")
-        logging.info(f"输出目录：{self.output_dir}")
-
-        # 收尾把进度推到 100%
-        if 'progress_callback' in locals() and progress_callback:
-            progress_callback(100, f'生成完成：共 {len(all_scenes)} 个场景')
-        
         return metadata
     
+    def close(self):
+        """释放生图对冲线程池等后台资源；生成结束后由调用方调用"""
+        self.image_gen.close()
+    
     def _save_project_metadata(self, metadata: Dict):
         metadata_path = os.path.join(self.output_dir, "project_metadata.json")
         
@@ -383,15 +472,56 @@ def main():
                        help='OpenAI API Key（也可通过 .env 文件配置）')
     parser.add_argument('--session-id', default=None,
                        help='会话ID（用于隔离不同生成任务，默认自动生成）')
+    parser.add_argument('--provider', default='qiniu', choices=['qiniu', 'openai', 'local'],
+                       help='生图 provider，local 为离线占位图后端，用于压测（默认：qiniu）')
+    parser.add_argument('--no-ai-analysis', action='store_true',
+                       help='不使用 AI 分析，按段落直接生成场景（默认：使用）')
+    parser.add_argument('--grid-layout', default=None, choices=['2x2', '1x3'],
+                       help='多格合图模式：将相邻分镜合并为一次生图请求后本地切分（默认：关闭）')
+    parser.add_argument('--derive-shots', action='store_true',
+                       help='镜头派生：同地点连续分镜只生成一张远景图，中景/特写本地裁剪得到（默认：关闭）')
+    parser.add_argument('--reuse-backgrounds', action='store_true',
+                       help='背景复用：按地点和情绪共享背景图，角色立绘本地合成（默认：关闭）')
+    parser.add_argument('--dedup-threshold', type=float, default=None,
+                       help='近似提示词复用场景图的相似度阈值，如 0.85（默认：关闭）')
+    parser.add_argument('--dedup-scope', default='task', choices=['task', 'global'],
+                       help='近似复用范围：task 仅当前任务内，global 跨任务共享（默认：task）')
+    parser.add_argument('--hedge-provider', default=None, choices=['qiniu', 'openai'],
+                       help='对冲请求的备用 provider：主请求超过 P90 延迟时补发（默认：关闭）')
+    parser.add_argument('--hedge-api-key', default=os.getenv('HEDGE_API_KEY'),
+                       help='备用 provider 的 API Key，与主 provider 不同时必须提供（也可通过 HEDGE_API_KEY 配置）')
+    parser.add_argument('--parallel-tts', action='store_true',
+                       help='长旁白按句切分并行合成语音，逐句缓存（默认：关闭）')
+    parser.add_argument('--tts-backend', default='google', choices=['google', 'espeak'],
+                       help='语音合成后端，espeak 为本地合成，无需联网（默认：google）')
+    parser.add_argument('--audio-variants', default=None,
+                       help='额外生成的移动端音频档位，逗号分隔，如 opus,aac（默认：只生成 MP3）')
+    parser.add_argument('--batch-tts', action='store_true',
+                       help='很短的分镜旁白拼成一次请求批量合成，再按停顿切开（默认：关闭）')
     
     args = parser.parse_args()
+    if args.audio_variants and any(p not in AUDIO_VARIANT_PROFILES for p in args.audio_variants.split(',')):
+        parser.error(f"--audio-variants 只支持: {', '.join(AUDIO_VARIANT_PROFILES)}")
     
     session_id = args.session_id or str(uuid.uuid4())
     logging.info(f"会话ID：{session_id}")
     
     try:
-        generator = AnimeGenerator(openai_api_key=args.api_key, session_id=session_id)
-        generator.generate_from_novel(args.novel_path, max_scenes=args.max_scenes)
+        generator = AnimeGenerator(openai_api_key=args.api_key, provider=args.provider,
+                                   use_ai_analysis=not args.no_ai_analysis,
+                                   session_id=session_id, grid_layout=args.grid_layout,
+                                   derive_shots=DEFAULT_DERIVED_SHOTS if args.derive_shots else None,
+                                   reuse_backgrounds=args.reuse_backgrounds,
+                                   dedup_threshold=args.dedup_threshold, dedup_scope=args.dedup_scope,
+                                   hedge_policy={'provider': args.hedge_provider, 'api_key': args.hedge_api_key}
+                                   if args.hedge_provider else None,
+                                   parallel_tts=args.parallel_tts, tts_backend=args.tts_backend,
+                                   audio_variants=tuple(args.audio_variants.split(',')) if args.audio_variants else None,
+                                   batch_tts=args.batch_tts)
+        try:
+            generator.generate_from_novel(args.novel_path, max_scenes=args.max_scenes)
+        finally:
+            generator.close()
     except Exception as e:
         logging.exception(f"错误：{e}")
         return 1
@@ -0,0 +1,410 @@
+import os
+import math
+import logging
+import threading
+import subprocess
+from typing import Optional, List, Dict, Iterator, Tuple
+
+import numpy as np
+
+from common import get_ffmpeg_exe
+
+
+# MPEG 音频帧头解析表，参见 ISO/IEC 11172-3 / 13818-3
+_MPEG_VERSIONS = {0: 2.5, 2: 2, 3: 1}
+_LAYERS = {1: 3, 2: 2, 3: 1}
+_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+
+# 移动端音频档位：语音用单声道低码率编码，原 MP3 保留作为兜底
+AUDIO_VARIANT_PROFILES = {
+    'opus': {
+        'ext': 'ogg',
+        'format': 'ogg',
+        'mime': 'audio/ogg; codecs=opus',
+        'args': ['-c:a', 'libopus', '-b:a', '12k', '-ac', '1', '-application', 'voip'],
+    },
+    'aac': {
+        'ext': 'm4a',
+        'format': 'ipod',
+        'mime': 'audio/mp4; codecs="mp4a.40.2"',
+        'args': ['-c:a', 'aac', '-b:a', '24k', '-ar', '24000', '-ac', '1', '-movflags', '+faststart'],
+    },
+}
+DEFAULT_AUDIO_VARIANTS = ('opus', 'aac')
+
+
+def strip_id3(data: bytes) -> bytes:
+    """去掉开头的 ID3v2 标签和结尾的 ID3v1 标签，只留下音频帧"""
+    start = 0
+    while data[start:start + 3] == b'ID3' and len(data) >= start + 10:
+        size = ((data[start + 6] & 0x7F) << 21 | (data[start + 7] & 0x7F) << 14
+                | (data[start + 8] & 0x7F) << 7 | (data[start + 9] & 0x7F))
+        has_footer = data[start + 5] & 0x10
+        start += 10 + size + (10 if has_footer else 0)
+
+    end = len(data)
+    if end - start >= 128 and data[end - 128:end - 125] == b'TAG':
+        end -= 128
+    return data[start:end]
+
+
+def parse_frame_header(data: bytes, offset: int = 0) -> Optional[Dict]:
+    """解析 offset 处的 4 字节帧头，不是合法帧头时返回 None"""
+    if offset + 4 > len(data):
+        return None
+    b0, b1, b2, b3 = data[offset:offset + 4]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+
+    version = _MPEG_VERSIONS.get((b1 >> 3) & 0x03)
+    layer = _LAYERS.get((b1 >> 1) & 0x03)
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x03
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrate = _BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    padding = (b2 >> 1) & 0x01
+    channel_mode = b3 >> 6
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 576 if (layer == 3 and version != 1) else 1152
+        length = samples // 8 * bitrate // sample_rate + padding
+
+    return {
+        'version': version,
+        'layer': layer,
+        'bitrate': bitrate,
+        'sample_rate': sample_rate,
+        'channels': 1 if channel_mode == 3 else 2,
+        'channel_mode': channel_mode,
+        'protected': not (b1 & 0x01),
+        'padding': padding,
+        'samples': samples,
+        'length': length,
+        'raw': bytes(data[offset:offset + 4]),
+    }
+
+
+def _is_info_frame(data: bytes, offset: int, header: Dict) -> bool:
+    """Xing/Info/VBRI 帧只记录整段文件的统计信息，拼接后会失效，需要丢掉"""
+    if header['layer'] != 3:
+        return False
+    if header['version'] == 1:
+        side_info = 17 if header['channels'] == 1 else 32
+    else:
+        side_info = 9 if header['channels'] == 1 else 17
+    tag_offset = offset + 4 + (2 if header['protected'] else 0) + side_info
+    return (data[tag_offset:tag_offset + 4] in (b'Xing', b'Info')
+            or data[offset + 36:offset + 40] == b'VBRI')
+
+
+def iter_frames(data: bytes) -> Iterator[Tuple[int, Dict]]:
+    """
+    依次产出 (offset, header)，跳过 Xing/Info 帧。
+    遇到损坏数据时逐字节重新同步，只有下一帧也能对上时才认为同步成功
+    """
+    offset = 0
+    synced = False
+    while offset + 4 <= len(data):
+        header = parse_frame_header(data, offset)
+        if header is None or header['length'] <= 4 or offset + header['length'] > len(data):
+            offset += 1
+            synced = False
+            continue
+        next_offset = offset + header['length']
+        if not synced and next_offset + 4 <= len(data) and parse_frame_header(data, next_offset) is None:
+            offset += 1
+            continue
+        synced = True
+        if not _is_info_frame(data, offset, header):
+            yield offset, header
+        offset = next_offset
+
+
+def read_frames(path: str) -> Tuple[List[bytes], Optional[Dict]]:
+    """读出文件中的全部音频帧，返回 (帧列表, 第一帧的帧头)"""
+    with open(path, 'rb') as f:
+        data = strip_id3(f.read())
+    frames = []
+    first_header = None
+    for offset, header in iter_frames(data):
+        if first_header is None:
+            first_header = header
+        frames.append(data[offset:offset + header['length']])
+    return frames, first_header
+
+
+def _same_format(a: Dict, b: Dict) -> bool:
+    return all(a[key] == b[key] for key in ('version', 'layer', 'sample_rate', 'channels'))
+
+
+def silent_frame(header: Dict) -> bytes:
+    """
+    构造与 header 同规格的静音帧：去掉 CRC 和 padding，side info 与主数据全部为 0，
+    part2_3_length 为 0，解码结果就是静音
+    """
+    raw = header['raw']
+    length = header['length'] - header['padding']
+    return bytes([0xFF, raw[1] | 0x01, raw[2] & 0xFD, raw[3]]) + bytes(length - 4)
+
+
+def silence_frames(header: Dict, duration: float) -> bytes:
+    frame_count = int(math.ceil(duration * header['sample_rate'] / header['samples']))
+    return silent_frame(header) * frame_count
+
+
+def concat_mp3(input_paths: List[str], output_path: str, gap: float = 0.0) -> Optional[str]:
+    """
+    按帧直接拼接多个 MP3，不解码也不重新编码，耗时只和总字节数成正比。
+    gap > 0 时在每段之后插入 gap 秒静音帧（按第一段的规格生成）。
+    任一输入读不出帧、各段采样率/声道不一致或需要静音但不是 Layer III 时返回 None，
+    由调用方走其他拼接方式
+    """
+    try:
+        chunks = []
+        first_header = None
+        for path in input_paths:
+            frames, header = read_frames(path)
+            if not frames:
+                logging.error(f"MP3 中没有可用的音频帧: {path}")
+                return None
+            if first_header is None:
+                first_header = header
+                if gap > 0 and header['layer'] != 3:
+                    return None
+                silence = silence_frames(header, gap) if gap > 0 else b''
+            elif not _same_format(first_header, header):
+                logging.info(f"MP3 规格不一致，无法按帧拼接: {path}")
+                return None
+            chunks.extend(frames)
+            chunks.append(silence)
+
+        tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(chunks))
+        # 输出文件可能是共享语音库的硬链接，rename 替换而不是原地改写
+        os.replace(tmp_path, output_path)
+        return output_path
+    except Exception as e:
+        logging.exception(f"拼接 MP3 失败: {e}")
+        return None
+
+
+def probe_mp3(path: str) -> Optional[Dict]:
+    """
+    只解析帧头得到时长、采样率、声道数和平均码率，不解码音频。
+    文件不存在或没有可用帧时返回 None
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = strip_id3(f.read())
+    except OSError:
+        return None
+
+    first_header = None
+    total_samples = 0
+    total_bytes = 0
+    frame_count = 0
+    for _, header in iter_frames(data):
+        if first_header is None:
+            first_header = header
+        total_samples += header['samples']
+        total_bytes += header['length']
+        frame_count += 1
+
+    if first_header is None:
+        return None
+
+    duration = total_samples / float(first_header['sample_rate'])
+    return {
+        'duration': round(duration, 3),
+        'sample_rate': first_header['sample_rate'],
+        'channels': first_header['channels'],
+        'bitrate': int(total_bytes * 8 / duration) if duration else first_header['bitrate'],
+        'frames': frame_count,
+    }
+
+
+def transcode_audio(input_path: str, output_path: str, profile: str) -> Optional[str]:
+    """用 ffmpeg 把音频转成 AUDIO_VARIANT_PROFILES 中的档位，失败返回 None"""
+    settings = AUDIO_VARIANT_PROFILES[profile]
+    tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        subprocess.run([get_ffmpeg_exe(), '-y', '-loglevel', 'error', '-i', input_path, '-vn']
+                       + settings['args'] + ['-f', settings['format'], tmp_path],
+                       check=True, capture_output=True, timeout=120)
+        os.replace(tmp_path, output_path)
+        return output_path
+    except Exception as e:
+        logging.error(f"音频转码失败 ({profile}): {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+
+
+# gTTS 输出的规格（MPEG2 Layer III, 32kbps, 24000Hz, 单声道），默认按它生成静音
+DEFAULT_MP3_HEADER = bytes([0xFF, 0xF3, 0x44, 0xC0])
+_ADTS_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350]
+
+
+def iter_adts_frames(data: bytes) -> Iterator[Tuple[int, int]]:
+    """依次产出 ADTS（裸 AAC）帧的 (offset, length)"""
+    offset = 0
+    while offset + 7 <= len(data):
+        if data[offset] != 0xFF or (data[offset + 1] & 0xF6) != 0xF0:
+            offset += 1
+            continue
+        length = ((data[offset + 3] & 0x03) << 11) | (data[offset + 4] << 3) | (data[offset + 5] >> 5)
+        if length < 7 or offset + length > len(data):
+            offset += 1
+            continue
+        yield offset, length
+        offset += length
+
+
+class SilenceProvider:
+    """
+    预编码静音，不经过 pydub 解码/编码：
+    - MP3：按帧头规格直接构造静音帧，任意时长一次写出
+    - AAC：用 ffmpeg 编一次静音模板（ADTS），取其中一帧重复拼接；每帧 1024 个采样
+    生成的文件按 (格式, 规格, 毫秒) 缓存，调用方用 link_or_copy 硬链接过去即可
+    """
+
+    def __init__(self, cache_dir: str = None):
+        if cache_dir is None:
+            from common import get_base_dir
+            cache_dir = os.path.join(get_base_dir(), "audio_cache", "shared", "silence")
+        self.cache_dir_ = cache_dir
+        self.aac_frames_ = {}
+        self.lock_ = threading.Lock()
+
+    def mp3_frames(self, duration: float, header: Dict = None) -> bytes:
+        return silence_frames(header or parse_frame_header(DEFAULT_MP3_HEADER), duration)
+
+    def mp3(self, duration: float, header: Dict = None) -> str:
+        header = header or parse_frame_header(DEFAULT_MP3_HEADER)
+        name = (f"silence_{header['version']}_{header['sample_rate']}_{header['channels']}"
+                f"_{header['bitrate']}_{int(round(duration * 1000))}.mp3")
+        return self._write_once(name, lambda: self.mp3_frames(duration, header))
+
+    def aac_frames(self, duration: float, sample_rate: int = 24000, channels: int = 1) -> bytes:
+        frame = self._aac_template(sample_rate, channels)
+        return frame * int(math.ceil(duration * sample_rate / 1024.0))
+
+    def aac(self, duration: float, sample_rate: int = 24000, channels: int = 1) -> str:
+        name = f"silence_{sample_rate}_{channels}_{int(round(duration * 1000))}.aac"
+        return self._write_once(name, lambda: self.aac_frames(duration, sample_rate, channels))
+
+    def _aac_template(self, sample_rate: int, channels: int) -> bytes:
+        key = (sample_rate, channels)
+        with self.lock_:
+            if key not in self.aac_frames_:
+                template_path = os.path.join(self.cache_dir_, f"template_{sample_rate}_{channels}.aac")
+                if not os.path.exists(template_path):
+                    os.makedirs(self.cache_dir_, exist_ok=True)
+                    tmp_path = f"{template_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    subprocess.run([get_ffmpeg_exe(), '-y', '-loglevel', 'error', '-f', 'lavfi',
+                                    '-i', f"anullsrc=r={sample_rate}:cl={'mono' if channels == 1 else 'stereo'}",
+                                    '-t', '1', '-c:a', 'aac', '-b:a', '24k', '-f', 'adts', tmp_path],
+                                   check=True, capture_output=True, timeout=60)
+                    os.replace(tmp_path, template_path)
+                with open(template_path, 'rb') as f:
+                    data = f.read()
+                frames = list(iter_adts_frames(data))
+                if not frames:
+                    raise ValueError(f"AAC 静音模板无效: {template_path}")
+                # 取中间的一帧，避开编码器起始的预热帧
+                offset, length = frames[len(frames) // 2]
+                self.aac_frames_[key] = data[offset:offset + length]
+            return self.aac_frames_[key]
+
+    def _write_once(self, name: str, build) -> str:
+        path = os.path.join(self.cache_dir_, name)
+        if not os.path.exists(path):
+            os.makedirs(self.cache_dir_, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(build())
+            os.replace(tmp_path, path)
+        return path
+
+
+def decode_pcm(path: str, sample_rate: int) -> np.ndarray:
+    """用 ffmpeg 解码为单声道 16bit PCM"""
+    result = subprocess.run([get_ffmpeg_exe(), '-loglevel', 'error', '-i', path,
+                             '-f', 's16le', '-ac', '1', '-ar', str(sample_rate), '-'],
+                            check=True, capture_output=True, timeout=120)
+    return np.frombuffer(result.stdout, dtype=np.int16)
+
+
+def split_mp3_on_silence(path: str, count: int, min_silence: float = 0.2,
+                         silence_db: float = -35.0, weights: Optional[List[float]] = None,
+                         tolerance: float = 1.5) -> Optional[List[bytes]]:
+    """
+    把一段 MP3 在最长的 count-1 段静音处切成 count 份，切点落在帧边界（静音段中间），
+    每份直接是原始帧，不重新编码。静音段不够时返回 None。
+    静音检测：按帧计算解码后 PCM 的 RMS，低于全段峰值 silence_db 分贝的帧视为静音。
+    weights：每份预期的有声时长比例（如各段文本的字数）；某一份有声帧的占比与预期相差超过
+    tolerance 倍时说明切在了段内的停顿上，返回 None
+    """
+    frames, header = read_frames(path)
+    if not frames or count < 1:
+        return None
+    if count == 1:
+        return [b''.join(frames)]
+
+    samples_per_frame = header['samples']
+    pcm = decode_pcm(path, header['sample_rate']).astype(np.float32)
+    padded = np.zeros(len(frames) * samples_per_frame, dtype=np.float32)
+    usable = min(len(pcm), len(padded))
+    padded[:usable] = pcm[:usable]
+    rms = np.sqrt((padded.reshape(len(frames), samples_per_frame) ** 2).mean(axis=1))
+    threshold = max(rms.max() * 10 ** (silence_db / 20.0), 1.0)
+    silent = rms < threshold
+
+    # 找出不接触首尾的连续静音段 (start, end)
+    runs = []
+    start = None
+    for i, is_silent in enumerate(silent):
+        if is_silent and start is None:
+            start = i
+        elif not is_silent and start is not None:
+            if start > 0:
+                runs.append((start, i))
+            start = None
+
+    min_frames = int(math.ceil(min_silence * header['sample_rate'] / samples_per_frame))
+    runs = [run for run in runs if run[1] - run[0] >= min_frames]
+    if len(runs) < count - 1:
+        return None
+
+    pauses = sorted(sorted(runs, key=lambda run: run[1] - run[0], reverse=True)[:count - 1])
+    cuts = [0] + [(run_start + run_end) // 2 for run_start, run_end in pauses] + [len(frames)]
+
+    if weights is not None:
+        voiced = [int((~silent[cuts[i]:cuts[i + 1]]).sum()) for i in range(count)]
+        total_voiced, total_weight = sum(voiced), float(sum(weights))
+        if not total_voiced or total_weight <= 0:
+            return None
+        for piece_voiced, weight in zip(voiced, weights):
+            ratio = (piece_voiced / total_voiced) / (weight / total_weight) if weight > 0 else float('inf')
+            if not 1.0 / tolerance <= ratio <= tolerance:
+                return None
+    return [b''.join(frames[cuts[i]:cuts[i + 1]]) for i in range(count)]
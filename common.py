@@ -1,5 +1,6 @@
 import os
 import sys
+import shutil
 import getpass
 
 
@@ -17,3 +18,26 @@ def get_base_dir():
 
     os.makedirs(base_dir, exist_ok=True)
     return base_dir
+
+
+def link_or_copy(src, dst):
+    """
+    优先用硬链接把 src 放到 dst（同一文件系统下不占额外空间），失败时退回复制。
+    先删除已存在的 dst：dst 可能是共享缓存的硬链接，直接覆盖写会改坏缓存里的文件
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+    return dst
+
+
+def get_ffmpeg_exe():
+    """优先用 PATH 里的 ffmpeg，没有时用 moviepy 依赖的 imageio-ffmpeg 自带的二进制"""
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg:
+        return ffmpeg
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
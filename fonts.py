@@ -0,0 +1,55 @@
+import threading
+
+from PIL import ImageFont
+
+
+CHINESE_FONT_PATHS = [
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/arphic/uming.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+]
+
+# 进程级字体缓存：(path, size) -> FreeTypeFont，加载失败的路径缓存为 None，避免重复尝试
+_FONT_CACHE = {}
+# size -> 按 CHINESE_FONT_PATHS 顺序解析出的第一个可用字体
+_RESOLVED_FONTS = {}
+_FONT_CACHE_LOCK = threading.Lock()
+
+
+def _load_font(font_path: str, size: int):
+    key = (font_path, size)
+    with _FONT_CACHE_LOCK:
+        if key in _FONT_CACHE:
+            return _FONT_CACHE[key]
+    try:
+        font = ImageFont.truetype(font_path, size)
+    except:
+        font = None
+    with _FONT_CACHE_LOCK:
+        _FONT_CACHE[key] = font
+    return font
+
+
+def load_chinese_font(size: int):
+    with _FONT_CACHE_LOCK:
+        if size in _RESOLVED_FONTS:
+            return _RESOLVED_FONTS[size]
+    
+    font = None
+    for font_path in CHINESE_FONT_PATHS:
+        font = _load_font(font_path, size)
+        if font is not None:
+            break
+    
+    if font is None:
+        try:
+            font = ImageFont.load_default()
+        except:
+            font = None
+    
+    with _FONT_CACHE_LOCK:
+        _RESOLVED_FONTS[size] = font
+    return font
@@ -0,0 +1,181 @@
+import os
+import logging
+import hashlib
+from typing import Optional, Tuple, List
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from common import get_base_dir
+
+
+# 显著性计算时先把图缩到这个宽度，足够定位主体且开销很小
+SALIENCY_WORK_WIDTH = 128
+
+# 角色合成布局: shot_type -> 最多容纳的角色数、角色高度（相对画面高度）、脚底位置（>1 表示下半身出画）
+COMPOSITE_LAYOUTS = {
+    '特写': {'max_characters': 1, 'height': 1.3, 'baseline': 1.45},
+    '中景': {'max_characters': 2, 'height': 1.0, 'baseline': 1.2},
+    '过肩镜头': {'max_characters': 2, 'height': 1.0, 'baseline': 1.2},
+    '全景': {'max_characters': 3, 'height': 0.75, 'baseline': 0.95},
+    '远景': {'max_characters': 4, 'height': 0.45, 'baseline': 0.9},
+}
+# 立绘抠图：边缘颜色标准差超过该值说明背景不是纯色，无法可靠抠出角色
+PORTRAIT_BACKGROUND_MAX_STD = 18.0
+PORTRAIT_KEY_TOLERANCE = 40.0
+PORTRAIT_KEY_SOFTNESS = 30.0
+
+
+class ImageCompositor:
+    """本地 PIL 图像加工：不调用生图接口，从已有图片派生新的分镜画面"""
+
+    def __init__(self):
+        self.cache_dir = os.path.join(get_base_dir(), "image_cache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def derive_shot(self, source_path: str, zoom: float, focus: str = "saliency") -> Optional[str]:
+        """
+        从远景/全景图裁出更近的镜头：
+        - zoom: 保留的宽高比例（0~1），越小镜头越近
+        - focus: 'saliency' 以显著区域为中心裁剪，'center' 以画面中心裁剪
+        裁剪结果放大回原图尺寸并缓存
+        """
+        if not source_path or not os.path.exists(source_path):
+            return None
+
+        zoom = max(0.1, min(1.0, float(zoom)))
+        cache_key = hashlib.md5(f"{source_path}_{os.path.getmtime(source_path)}_{zoom}_{focus}".encode()).hexdigest()
+        cache_path = os.path.join(self.cache_dir, f"derived_{cache_key}.png")
+
+        if os.path.exists(cache_path):
+            return cache_path
+
+        try:
+            with Image.open(source_path) as img:
+                img = img.convert('RGB')
+                box = self._crop_box(img, zoom, focus)
+                derived = img.crop(box).resize(img.size, Image.LANCZOS)
+                derived.save(cache_path)
+            return cache_path
+        except Exception as e:
+            logging.exception(f"派生镜头失败: {e}")
+            return None
+
+    def _crop_box(self, img, zoom: float, focus: str) -> Tuple[int, int, int, int]:
+        width, height = img.size
+        crop_width = int(width * zoom)
+        crop_height = int(height * zoom)
+
+        if focus == "saliency":
+            center_x, center_y = self._salient_center(img, zoom)
+        else:
+            center_x, center_y = width / 2, height / 2
+
+        left = int(min(max(center_x - crop_width / 2, 0), width - crop_width))
+        top = int(min(max(center_y - crop_height / 2, 0), height - crop_height))
+        return left, top, left + crop_width, top + crop_height
+
+    def _salient_center(self, img, zoom: float) -> Tuple[float, float]:
+        """
+        简单显著性：边缘强度 + 与平均色的差异，再用积分图找出
+        与裁剪窗口同尺寸、显著性总和最大的位置，返回其中心（原图坐标）
+        """
+        width, height = img.size
+        scale = SALIENCY_WORK_WIDTH / float(width)
+        small = img.resize((SALIENCY_WORK_WIDTH, max(1, int(height * scale))), Image.BILINEAR)
+
+        edges = np.asarray(small.convert('L').filter(ImageFilter.FIND_EDGES), dtype=np.float32)
+        rgb = np.asarray(small, dtype=np.float32)
+        color_distance = np.sqrt(((rgb - rgb.reshape(-1, 3).mean(axis=0)) ** 2).sum(axis=2))
+        saliency = edges / (edges.max() or 1.0) + color_distance / (color_distance.max() or 1.0)
+
+        small_height, small_width = saliency.shape
+        window_width = max(1, int(small_width * zoom))
+        window_height = max(1, int(small_height * zoom))
+
+        integral = np.zeros((small_height + 1, small_width + 1), dtype=np.float64)
+        integral[1:, 1:] = saliency.cumsum(axis=0).cumsum(axis=1)
+        window_sums = (integral[window_height:, window_width:]
+                       - integral[:-window_height, window_width:]
+                       - integral[window_height:, :-window_width]
+                       + integral[:-window_height, :-window_width])
+
+        top, left = np.unravel_index(np.argmax(window_sums), window_sums.shape)
+        center_x = (left + window_width / 2) / scale
+        center_y = (top + window_height / 2) / scale
+        return center_x, center_y
+
+    def composite_characters(self, background_path: str, portrait_paths: List[str],
+                             shot_type: str = '中景') -> Optional[str]:
+        """
+        把角色立绘抠图后按镜头类型的布局贴到背景图上。
+        无法满足时返回 None（镜头类型没有布局、角色过多、立绘背景不是纯色等），
+        由调用方退回完整生图。
+        """
+        layout = COMPOSITE_LAYOUTS.get(shot_type)
+        if layout is None or len(portrait_paths) > layout['max_characters']:
+            return None
+        if not background_path or not os.path.exists(background_path):
+            return None
+        if not all(path and os.path.exists(path) for path in portrait_paths):
+            return None
+
+        cache_key = hashlib.md5("|".join([background_path, shot_type] + list(portrait_paths)).encode()).hexdigest()
+        cache_path = os.path.join(self.cache_dir, f"composite_{cache_key}.png")
+
+        if os.path.exists(cache_path):
+            return cache_path
+
+        try:
+            cutouts = []
+            for path in portrait_paths:
+                cutout = self._cut_out_portrait(path)
+                if cutout is None:
+                    logging.info(f"立绘背景不是纯色，无法合成: {path}")
+                    return None
+                cutouts.append(cutout)
+
+            with Image.open(background_path) as background:
+                canvas = background.convert('RGBA')
+
+            width, height = canvas.size
+            slot_width = width / (len(cutouts) + 1)
+            for i, cutout in enumerate(cutouts):
+                target_height = int(height * layout['height'])
+                target_width = max(1, int(cutout.width * target_height / cutout.height))
+                figure = cutout.resize((target_width, target_height), Image.LANCZOS)
+
+                center_x = slot_width * (i + 1)
+                left = int(center_x - target_width / 2)
+                top = int(height * layout['baseline']) - target_height
+                canvas.alpha_composite(figure, dest=(max(left, 0), max(top, 0)),
+                                       source=(max(-left, 0), max(-top, 0)))
+
+            canvas.convert('RGB').save(cache_path)
+            return cache_path
+        except Exception as e:
+            logging.exception(f"角色合成失败: {e}")
+            return None
+
+    def _cut_out_portrait(self, portrait_path: str):
+        """按边缘像素估计纯色背景并抠图，返回裁掉空白后的 RGBA 立绘；背景不是纯色时返回 None"""
+        with Image.open(portrait_path) as img:
+            rgb = np.asarray(img.convert('RGB'), dtype=np.float32)
+
+        border = np.concatenate([rgb[:4].reshape(-1, 3), rgb[-4:].reshape(-1, 3),
+                                 rgb[:, :4].reshape(-1, 3), rgb[:, -4:].reshape(-1, 3)])
+        if border.std(axis=0).max() > PORTRAIT_BACKGROUND_MAX_STD:
+            return None
+
+        background_color = np.median(border, axis=0)
+        distance = np.sqrt(((rgb - background_color) ** 2).sum(axis=2))
+        alpha = np.clip((distance - PORTRAIT_KEY_TOLERANCE) / PORTRAIT_KEY_SOFTNESS, 0.0, 1.0) * 255
+
+        rgba = np.dstack([rgb, alpha]).astype(np.uint8)
+        cutout = Image.fromarray(rgba, 'RGBA')
+        cutout.putalpha(cutout.getchannel('A').filter(ImageFilter.GaussianBlur(1)))
+
+        bbox = cutout.getchannel('A').point(lambda a: 255 if a > 16 else 0).getbbox()
+        if not bbox:
+            return None
+        return cutout.crop(bbox)
@@ -1,33 +1,147 @@
 import logging
 import os
+import math
+import time
+import threading
+import concurrent.futures
 from openai import OpenAI
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 import requests
 from io import BytesIO
-from typing import Optional, Dict
+from typing import Optional, Dict, List
+from collections import deque
 import hashlib
 import base64
 
+from prompt_index import PromptSimilarityIndex
+from local_image_provider import LocalImageClient
+from fonts import load_chinese_font
+
+
+SCENE_IMAGE_SIZE = (1792, 1024)
+
+# 多格合图布局: layout -> (列数, 行数, 请求尺寸)；切出的单格宽高比接近场景图的 16:9
+GRID_LAYOUTS = {
+    '2x2': (2, 2, "1792x1024"),
+    '1x3': (1, 3, "1024x1792"),
+}
+GRID_GUTTER_RATIO = 0.02
+
+# 对冲请求默认策略：主请求耗时超过历史延迟的 percentile 分位时，向备用 provider 补发一次
+DEFAULT_HEDGE_POLICY = {
+    'percentile': 0.9,
+    'min_samples': 10,
+    'initial_delay': 30.0,
+    'provider': 'openai',
+    'model': None,
+    'api_key': None,
+    'base_url': None,
+}
+HEDGE_LATENCY_WINDOW = 200
+# 同时进行的生图请求数（与场景并发数一致）；对冲线程池按其两倍分配，主请求全部卡住时备用请求仍有线程可用
+DEFAULT_IMAGE_CONCURRENCY = 8
+QINIU_BASE_URL = "https://openai.qiniu.com/v1"
+
+_GLOBAL_PROMPT_INDEX = None
+_GLOBAL_PROMPT_INDEX_LOCK = threading.Lock()
+
+
+def _get_global_prompt_index(cache_dir: str) -> PromptSimilarityIndex:
+    global _GLOBAL_PROMPT_INDEX
+    with _GLOBAL_PROMPT_INDEX_LOCK:
+        if _GLOBAL_PROMPT_INDEX is None:
+            _GLOBAL_PROMPT_INDEX = PromptSimilarityIndex(persist_path=os.path.join(cache_dir, "prompt_index.jsonl"))
+        return _GLOBAL_PROMPT_INDEX
+
 
 class ImageGenerator:
-    def __init__(self, api_key: str, provider: str = "qiniu", custom_prompt: str = None):
+    def __init__(self, api_key: str, provider: str = "qiniu", custom_prompt: str = None,
+                 dedup_threshold: float = None, dedup_scope: str = "task",
+                 hedge_policy: Dict = None, max_concurrency: int = DEFAULT_IMAGE_CONCURRENCY):
         self.provider = provider
         self.custom_prompt = custom_prompt
         self.style_consistency_keywords = "anime style, consistent art style, unified visual style, coherent character design, same clothing, same hairstyle, same face shape, identical environment, consistent background"
         
-        if provider == "qiniu":
-            self.client = OpenAI(
-                api_key=api_key,
-                base_url="https://openai.qiniu.com/v1"
-            )
-        else:
-            self.client = OpenAI(api_key=api_key)
-            
+        self.client = self._create_client(provider, api_key)
+        
         from common import get_base_dir
         
         self.cache_dir = os.path.join(get_base_dir(), "image_cache")
         os.makedirs(self.cache_dir, exist_ok=True)
         
+        # 近似提示词复用：相邻分镜的描述往往只差一两个词，相似度达到阈值时直接复用已有场景图
+        # dedup_scope='task' 只在本实例（一个任务）内复用，'global' 在进程内共享并持久化到缓存目录
+        self.dedup_threshold = dedup_threshold
+        self.dedup_scope = dedup_scope
+        self.dedup_hits_ = 0
+        self.prompt_index_ = None
+        if dedup_threshold is not None:
+            if dedup_scope == "global":
+                self.prompt_index_ = _get_global_prompt_index(self.cache_dir)
+            else:
+                self.prompt_index_ = PromptSimilarityIndex()
+        
+        # 对冲请求：主 provider 长尾延迟时向备用 provider / 模型补发，谁先返回用谁
+        self.hedge_policy = None
+        self.hedge_executor_ = None
+        hedge_policy = dict(DEFAULT_HEDGE_POLICY, **hedge_policy) if hedge_policy is not None else None
+        hedge_api_key = hedge_policy and hedge_policy['api_key']
+        if hedge_policy and not hedge_api_key:
+            # 主 Key 只能发给同一个服务，不同的 provider / base_url 必须单独配置 api_key
+            same_endpoint = (hedge_policy['provider'] == provider and
+                             self._endpoint(hedge_policy['provider'], hedge_policy['base_url']) == self._endpoint(provider))
+            if same_endpoint or hedge_policy['provider'] == "local":
+                hedge_api_key = api_key
+            else:
+                logging.warning(f"对冲 provider {hedge_policy['provider']} 未配置 api_key，不启用对冲请求")
+                hedge_policy = None
+        if hedge_policy is not None:
+            self.hedge_policy = hedge_policy
+            self.hedge_client = self._create_client(
+                self.hedge_policy['provider'],
+                hedge_api_key,
+                self.hedge_policy['base_url']
+            )
+            self.hedge_executor_ = concurrent.futures.ThreadPoolExecutor(max_workers=max(2, max_concurrency * 2),
+                                                                         thread_name_prefix='image-hedge')
+            self.hedge_lock_ = threading.Lock()
+            self.primary_latencies_ = deque(maxlen=HEDGE_LATENCY_WINDOW)
+            self.hedge_stats_ = {
+                'requests': 0,
+                'hedged': 0,
+                'hedge_wins': 0,
+                'latency_saved': 0.0
+            }
+        
+    def _create_client(self, provider: str, api_key: str, base_url: str = None):
+        if provider == "local":
+            return LocalImageClient()
+        base_url = self._endpoint(provider, base_url)
+        if base_url:
+            return OpenAI(api_key=api_key, base_url=base_url)
+        return OpenAI(api_key=api_key)
+    
+    @staticmethod
+    def _endpoint(provider: str, base_url: str = None) -> Optional[str]:
+        """实际请求的 base_url；None 表示 OpenAI 官方地址"""
+        if base_url:
+            return base_url
+        return QINIU_BASE_URL if provider == "qiniu" else None
+    
+    def close(self):
+        """关闭对冲线程池；落后的请求无法中断，不等待它们结束"""
+        if self.hedge_executor_ is not None:
+            self.hedge_executor_.shutdown(wait=False)
+    
+    def get_hedge_stats(self) -> Dict:
+        if self.hedge_policy is None:
+            return {}
+        with self.hedge_lock_:
+            stats = dict(self.hedge_stats_)
+        stats['hedge_rate'] = stats['hedged'] / stats['requests'] if stats['requests'] else 0.0
+        stats['current_delay'] = self._hedge_delay()
+        return stats
+    
     def generate_character_image(self, character_name: str, 
                                 character_prompt: str,
                                 style: str = "anime",
@@ -47,36 +161,8 @@ class ImageGenerator:
             full_prompt = f"{self.style_consistency_keywords}, {character_prompt}, high quality, detailed, character reference sheet"
         
         try:
-            if self.provider == "qiniu":
-                generate_params = {
-                    "model": "gemini-2.5-flash-image",
-                    "prompt": full_prompt,
-                    "size": "1024x1024",
-                    "n": 1,
-                    "response_format": "b64_json"
-                }
-                
-                response = self.client.images.generate(**generate_params)
-                
-                img_data = base64.b64decode(response.data[0].b64_json)
-                img = Image.open(BytesIO(img_data))
-                img.save(cache_path)
-            else:
-                generate_params = {
-                    "model": "dall-e-3",
-                    "prompt": full_prompt,
-                    "size": "1024x1024",
-                    "quality": "standard",
-                    "n": 1
-                }
-                
-                response = self.client.images.generate(**generate_params)
-                
-                image_url = response.data[0].url
-                img_response = requests.get(image_url)
-                img = Image.open(BytesIO(img_response.content))
-                img.save(cache_path)
-            
+            img = self._request_image(full_prompt, "1024x1024")
+            img.save(cache_path)
             return cache_path
             
         except Exception as e:
@@ -87,104 +173,258 @@ class ImageGenerator:
                             characters: list = None,
                             style: str = "anime",
                             character_seeds: Dict[str, int] = None) -> Optional[str]:
-        cache_key_base = f"{scene_description}_{self.provider}"
-        if character_seeds:
-            seeds_str = "_".join(str(v) for v in sorted(character_seeds.values()))
-            cache_key_base += f"_{seeds_str}"
-        cache_key = hashlib.md5(cache_key_base.encode()).hexdigest()
+        cache_key = self._scene_cache_key(scene_description, character_seeds)
         cache_path = os.path.join(self.cache_dir, f"scene_{cache_key}.png")
         
         if os.path.exists(cache_path):
+            if self.prompt_index_ is not None:
+                self.prompt_index_.add(scene_description, self._dedup_namespace(character_seeds), cache_path)
             return cache_path
         
-        if self.custom_prompt:
-            full_prompt = f"{self.custom_prompt}, scene: {scene_description}"
-            if characters:
-                char_desc = ", ".join(characters)
-                full_prompt += f", featuring characters: {char_desc}"
-        else:
-            full_prompt = f"{self.style_consistency_keywords}, scene: {scene_description}, high quality, detailed background, cinematic lighting"
-            if characters:
-                char_desc = ", ".join(characters)
-                full_prompt += f", featuring characters: {char_desc}"
+        pending = None
+        if self.prompt_index_ is not None:
+            namespace = self._dedup_namespace(character_seeds)
+            pending = concurrent.futures.Future()
+            # 查找和登记生成中的 Future 在索引的同一把锁内完成，并发的相似分镜只有一个会去出图
+            match, entry_id = self.prompt_index_.find_or_add(scene_description, namespace,
+                                                             self.dedup_threshold, pending)
+            if match:
+                reused = self._reuse_similar_scene(scene_description, match)
+                if reused:
+                    return reused
+                # 命中的场景生成失败或图片已被清理，自己出图
+                entry_id = self.prompt_index_.add(scene_description, namespace, pending)
+        
+        full_prompt = self._build_scene_prompt(f"scene: {scene_description}", characters)
         
+        result = None
         try:
-            if self.provider == "qiniu":
-                generate_params = {
-                    "model": "gemini-2.5-flash-image",
-                    "prompt": full_prompt,
-                    "size": "1792x1024",
-                    "n": 1,
-                    "response_format": "b64_json"
-                }
-                
-                response = self.client.images.generate(**generate_params)
-                
-                img_data = base64.b64decode(response.data[0].b64_json)
-                img = Image.open(BytesIO(img_data))
-                img.save(cache_path)
-            else:
-                generate_params = {
-                    "model": "dall-e-3",
-                    "prompt": full_prompt,
-                    "size": "1792x1024",
-                    "quality": "standard",
-                    "n": 1
-                }
-                
-                response = self.client.images.generate(**generate_params)
-                
-                image_url = response.data[0].url
-                img_response = requests.get(image_url)
-                img = Image.open(BytesIO(img_response.content))
-                img.save(cache_path)
-            
-            return cache_path
+            img = self._request_image(full_prompt, "1792x1024")
+            img.save(cache_path)
+            result = cache_path
             
         except Exception as e:
             logging.exception(f"生成场景图像失败: {e}")
+        
+        if pending is not None:
+            pending.set_result(result)
+            self.prompt_index_.update(entry_id, result)
+        return result
+    
+    def _dedup_namespace(self, character_seeds: Dict[str, int] = None) -> str:
+        # 只有相同 provider、风格和角色组合的场景图才能互相复用
+        seeds_str = "_".join(str(v) for v in sorted((character_seeds or {}).values()))
+        return f"{self.provider}|{self.custom_prompt or ''}|{seeds_str}"
+    
+    def _reuse_similar_scene(self, scene_description: str, match) -> Optional[str]:
+        value, similarity, matched_prompt = match
+        # 相似的场景还在生成中时等待其结果，避免并发分镜各自重复出图
+        if isinstance(value, concurrent.futures.Future):
+            value = value.result()
+        if not value or not os.path.exists(value):
             return None
+        
+        self.dedup_hits_ += 1
+        logging.info(f"近似提示词复用场景图 (相似度 {similarity:.2f} >= {self.dedup_threshold}): "
+                     f"{scene_description[:60]!r} -> {matched_prompt[:60]!r} ({os.path.basename(value)})")
+        return value
     
-    def create_text_overlay(self, image_path: str, text: str, 
-                          output_path: str, position: str = "bottom") -> bool:
+    def generate_scene_grid(self, scene_descriptions: List[str],
+                            layout: str = "2x2",
+                            characters: list = None,
+                            character_seeds: Dict[str, int] = None) -> List[Optional[Dict]]:
+        """
+        多格合图：一次 images.generate 请求生成一整页漫画（如 2x2 / 1x3），
+        再在本地用 PIL 切成单格场景图。
+        返回与 scene_descriptions 一一对应的格子信息：
+        {'image_path', 'grid_id', 'grid_layout', 'grid_cell', 'grid_image'}，失败的位置为 None
+        """
+        if layout not in GRID_LAYOUTS:
+            raise ValueError(f"不支持的多格布局: {layout}")
+        
+        cols, rows, request_size = GRID_LAYOUTS[layout]
+        panel_count = len(scene_descriptions)
+        if panel_count == 0 or panel_count > cols * rows:
+            raise ValueError(f"布局 {layout} 只能容纳 1~{cols * rows} 个分镜，实际 {panel_count} 个")
+        
+        grid_key_base = f"{layout}_" + "|".join(scene_descriptions)
+        grid_id = self._scene_cache_key(grid_key_base, character_seeds)
+        grid_path = os.path.join(self.cache_dir, f"grid_{grid_id}.png")
+        cell_paths = [os.path.join(self.cache_dir, f"grid_{grid_id}_{i}.png") for i in range(panel_count)]
+        
+        def _cell_info(i):
+            return {
+                'image_path': cell_paths[i],
+                'grid_id': grid_id,
+                'grid_layout': layout,
+                'grid_cell': i,
+                'grid_image': grid_path
+            }
+        
+        if all(os.path.exists(path) for path in cell_paths):
+            return [_cell_info(i) for i in range(panel_count)]
+        
+        panels_desc = "; ".join(f"panel {i + 1}: {desc}" for i, desc in enumerate(scene_descriptions))
+        layout_desc = (f"comic page with {panel_count} equal-size panels arranged in a grid of "
+                       f"{rows} rows and {cols} columns, thin white gutters between panels, "
+                       f"reading order left to right then top to bottom, "
+                       f"same characters and art style in every panel")
+        full_prompt = self._build_scene_prompt(f"{layout_desc}, {panels_desc}", characters)
+        
         try:
-            img = Image.open(image_path)
-            draw = ImageDraw.Draw(img)
+            img = self._request_image(full_prompt, request_size)
+            img.save(grid_path)
             
-            img_width, img_height = img.size
+            for i, cell in enumerate(self._slice_grid(img, cols, rows, panel_count)):
+                cell.save(cell_paths[i])
             
-            font = self._load_chinese_font(40)
+            logging.info(f"多格合图完成: {layout}，{panel_count} 个分镜共用 1 次生图请求 (grid_id={grid_id})")
+            return [_cell_info(i) for i in range(panel_count)]
             
-            max_width = img_width - 100
-            lines = self._wrap_text(text, font, max_width, draw)
-            
-            line_height = 50
-            total_text_height = len(lines) * line_height + 40
-            
-            if position == "bottom":
-                y_start = img_height - total_text_height - 20
-            else:
-                y_start = 20
-            
-            overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
-            overlay_draw = ImageDraw.Draw(overlay)
-            overlay_draw.rectangle(
-                [(0, y_start - 20), (img_width, y_start + total_text_height)],
-                fill=(0, 0, 0, 180)
+        except Exception as e:
+            logging.exception(f"生成多格合图失败: {e}")
+            return [None] * panel_count
+    
+    def _slice_grid(self, img, cols: int, rows: int, panel_count: int) -> list:
+        img = img.convert('RGB')
+        width, height = img.size
+        cell_width = width / cols
+        cell_height = height / rows
+        # 向内收一点，切掉格子间的白色分隔线
+        inset = int(min(cell_width, cell_height) * GRID_GUTTER_RATIO)
+        
+        cells = []
+        for i in range(panel_count):
+            row, col = divmod(i, cols)
+            box = (
+                int(col * cell_width) + inset,
+                int(row * cell_height) + inset,
+                int((col + 1) * cell_width) - inset,
+                int((row + 1) * cell_height) - inset
             )
+            cells.append(img.crop(box).resize(SCENE_IMAGE_SIZE, Image.LANCZOS))
+        return cells
+    
+    def _scene_cache_key(self, scene_description: str, character_seeds: Dict[str, int] = None) -> str:
+        cache_key_base = f"{scene_description}_{self.provider}"
+        if character_seeds:
+            seeds_str = "_".join(str(v) for v in sorted(character_seeds.values()))
+            cache_key_base += f"_{seeds_str}"
+        return hashlib.md5(cache_key_base.encode()).hexdigest()
+    
+    def _build_scene_prompt(self, scene_prompt: str, characters: list = None) -> str:
+        if self.custom_prompt:
+            full_prompt = f"{self.custom_prompt}, {scene_prompt}"
+        else:
+            full_prompt = f"{self.style_consistency_keywords}, {scene_prompt}, high quality, detailed background, cinematic lighting"
+        if characters:
+            char_desc = ", ".join(characters)
+            full_prompt += f", featuring characters: {char_desc}"
+        return full_prompt
+    
+    def _request_image(self, full_prompt: str, size: str):
+        if self.hedge_policy is None:
+            return self._call_provider(self.provider, self.client, full_prompt, size)
+        return self._hedged_request(full_prompt, size)
+    
+    def _hedge_delay(self) -> float:
+        with self.hedge_lock_:
+            latencies = sorted(self.primary_latencies_)
+        if len(latencies) < self.hedge_policy['min_samples']:
+            return self.hedge_policy['initial_delay']
+        # nearest-rank：第 ceil(n*p) 小的样本
+        rank = max(0, math.ceil(len(latencies) * self.hedge_policy['percentile']) - 1)
+        return latencies[min(rank, len(latencies) - 1)]
+    
+    def _hedged_request(self, full_prompt: str, size: str):
+        start = time.monotonic()
+        primary = self.hedge_executor_.submit(self._call_provider, self.provider, self.client, full_prompt, size)
+        
+        # 主请求的耗时无论是否被对冲都计入延迟窗口，否则分位数会被截断而越来越低
+        def _on_primary_done(future):
+            if future.exception() is None:
+                with self.hedge_lock_:
+                    self.primary_latencies_.append(time.monotonic() - start)
+        primary.add_done_callback(_on_primary_done)
+        
+        with self.hedge_lock_:
+            self.hedge_stats_['requests'] += 1
+        
+        try:
+            return primary.result(timeout=self._hedge_delay())
+        except concurrent.futures.TimeoutError:
+            pass
+        
+        secondary = self.hedge_executor_.submit(
+            self._call_provider, self.hedge_policy['provider'], self.hedge_client,
+            full_prompt, size, self.hedge_policy['model']
+        )
+        with self.hedge_lock_:
+            self.hedge_stats_['hedged'] += 1
+        logging.info(f"生图请求超过 {time.monotonic() - start:.1f}s，向备用 provider {self.hedge_policy['provider']} 发起对冲请求")
+        
+        pending = {primary, secondary}
+        last_error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    last_error = future.exception()
+                    continue
+                
+                # 落后的请求无法中断已发出的 HTTP 调用，只能取消排队中的任务并忽略其结果
+                for other in pending:
+                    other.cancel()
+                if future is secondary:
+                    finished = time.monotonic()
+                    with self.hedge_lock_:
+                        self.hedge_stats_['hedge_wins'] += 1
+                    
+                    def _record_saved(primary_future, finished=finished):
+                        if primary_future.exception() is None:
+                            with self.hedge_lock_:
+                                self.hedge_stats_['latency_saved'] += time.monotonic() - finished
+                    primary.add_done_callback(_record_saved)
+                return future.result()
+        
+        raise last_error
+    
+    def _call_provider(self, provider: str, client, full_prompt: str, size: str, model: str = None):
+        # local 后端与七牛一样返回 b64_json
+        if provider in ("qiniu", "local"):
+            generate_params = {
+                "model": model or "gemini-2.5-flash-image",
+                "prompt": full_prompt,
+                "size": size,
+                "n": 1,
+                "response_format": "b64_json"
+            }
+            
+            response = client.images.generate(**generate_params)
             
-            img = Image.alpha_composite(img.convert('RGBA'), overlay)
-            draw = ImageDraw.Draw(img)
+            img_data = base64.b64decode(response.data[0].b64_json)
+            return Image.open(BytesIO(img_data))
+        else:
+            generate_params = {
+                "model": model or "dall-e-3",
+                "prompt": full_prompt,
+                "size": size,
+                "quality": "standard",
+                "n": 1
+            }
             
-            y = y_start
-            for line in lines:
-                bbox = draw.textbbox((0, 0), line, font=font)
-                text_width = bbox[2] - bbox[0]
-                x = (img_width - text_width) // 2
-                draw.text((x, y), line, font=font, fill=(255, 255, 255, 255))
-                y += line_height
+            response = client.images.generate(**generate_params)
             
-            img = img.convert('RGB')
+            image_url = response.data[0].url
+            img_response = requests.get(image_url)
+            return Image.open(BytesIO(img_response.content))
+    
+    def create_text_overlay(self, image_path: str, text: str, 
+                          output_path: str, position: str = "bottom") -> bool:
+        try:
+            font = self._load_chinese_font(40)
+            img = Image.open(image_path)
+            img = self._render_text_overlay(img, text, font, position)
             img.save(output_path)
             return True
             
@@ -192,44 +432,105 @@ class ImageGenerator:
             logging.exception(f"添加文字叠加失败: {e}")
             return False
     
-    def _load_chinese_font(self, size: int):
-        chinese_fonts = [
-            "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
-            "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
-            "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
-            "/usr/share/fonts/truetype/arphic/uming.ttc",
-            "/System/Library/Fonts/PingFang.ttc",
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-        ]
-        
-        for font_path in chinese_fonts:
+    def create_text_overlays(self, overlays: List[Dict], position: str = "bottom",
+                             max_workers: int = None) -> List[bool]:
+        """
+        批量字幕叠加：
+        - overlays: [{'image_path': ..., 'text': ..., 'output_path': ...}, ...]
+        - 字体只加载一次，各场景在线程池中并发渲染
+        - 返回与 overlays 一一对应的成功标记
+        """
+        if not overlays:
+            return []
+        
+        font = self._load_chinese_font(40)
+        
+        def _render_one(item):
             try:
-                return ImageFont.truetype(font_path, size)
-            except:
-                continue
+                img = Image.open(item['image_path'])
+                img = self._render_text_overlay(img, item.get('text', ''), font, item.get('position', position))
+                img.save(item['output_path'])
+                return True
+            except Exception as e:
+                logging.exception(f"批量添加文字叠加失败 ({item.get('image_path')}): {e}")
+                return False
         
-        try:
-            return ImageFont.load_default()
-        except:
-            return None
+        max_workers = max_workers or min(8, max(2, os.cpu_count() or 4))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(_render_one, overlays))
+    
+    def _render_text_overlay(self, img, text: str, font, position: str = "bottom"):
+        img_width, img_height = img.size
+        
+        max_width = img_width - 100
+        lines = self._wrap_text(text, font, max_width)
+        
+        line_height = 50
+        total_text_height = len(lines) * line_height + 40
+        
+        if position == "bottom":
+            y_start = img_height - total_text_height - 20
+        else:
+            y_start = 20
+        
+        # 只对字幕条所在区域做半透明合成，避免整图 alpha_composite
+        img = img.convert('RGBA')
+        band_box = (0, max(0, y_start - 20), img_width, min(img_height, y_start + total_text_height))
+        band = img.crop(band_box)
+        shade = Image.new('RGBA', band.size, (0, 0, 0, 180))
+        img.paste(Image.alpha_composite(band, shade), band_box[:2])
+        
+        draw = ImageDraw.Draw(img)
+        
+        y = y_start
+        for line in lines:
+            text_width = self._measure_text(line, font, draw)
+            x = (img_width - int(text_width)) // 2
+            draw.text((x, y), line, font=font, fill=(255, 255, 255, 255))
+            y += line_height
+        
+        return img.convert('RGB')
+    
+    def _load_chinese_font(self, size: int):
+        return load_chinese_font(size)
+    
+    def _measure_text(self, text: str, font, draw=None) -> float:
+        if hasattr(font, 'getlength'):
+            return font.getlength(text)
+        bbox = draw.textbbox((0, 0), text, font=font)
+        return bbox[2] - bbox[0]
     
-    def _wrap_text(self, text: str, font, max_width: int, draw) -> list:
+    def _wrap_text(self, text: str, font, max_width: int, draw=None) -> list:
+        # 逐字累加字形宽度（同一字符只测量一次），整体为线性复杂度；
+        # 中文排版基本不涉及字距调整，累加结果与整行测量一致
         lines = []
-        current_line = ""
+        current_line = []
+        current_width = 0
+        advances = {}
         
         for char in text:
-            test_line = current_line + char
-            bbox = draw.textbbox((0, 0), test_line, font=font)
-            width = bbox[2] - bbox[0]
+            if char == '\n':
+                if current_line:
+                    lines.append(''.join(current_line))
+                current_line = []
+                current_width = 0
+                continue
+            
+            advance = advances.get(char)
+            if advance is None:
+                advance = self._measure_text(char, font, draw)
+                advances[char] = advance
             
-            if width <= max_width:
-                current_line = test_line
+            if current_width + advance <= max_width:
+                current_line.append(char)
+                current_width += advance
             else:
                 if current_line:
-                    lines.append(current_line)
-                current_line = char
+                    lines.append(''.join(current_line))
+                current_line = [char]
+                current_width = advance
         
         if current_line:
-            lines.append(current_line)
+            lines.append(''.join(current_line))
         
         return lines
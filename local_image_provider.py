@@ -0,0 +1,82 @@
+import os
+import time
+import base64
+import random
+import hashlib
+import threading
+from io import BytesIO
+from types import SimpleNamespace
+
+from PIL import Image, ImageDraw
+
+from fonts import load_chinese_font
+
+
+class LocalImageError(Exception):
+    pass
+
+
+class LocalImageClient:
+    """
+    离线生图后端（provider="local"），接口与 OpenAI 客户端的 images.generate 一致：
+    - 图片由提示词哈希确定：渐变底色 + 哈希值 + 提示词片段，同一提示词总是得到同一张图
+    - latency / latency_jitter / failure_rate 模拟真实 provider 的耗时和失败，
+      用于在不花钱、不联网的情况下压测整条生成流水线和 Web 服务
+    未显式传参时从环境变量 LOCAL_IMAGE_LATENCY、LOCAL_IMAGE_LATENCY_JITTER、
+    LOCAL_IMAGE_FAILURE_RATE、LOCAL_IMAGE_SEED 读取
+    """
+
+    def __init__(self, latency: float = None, latency_jitter: float = None,
+                 failure_rate: float = None, seed: int = None):
+        self.latency = float(latency if latency is not None else os.getenv('LOCAL_IMAGE_LATENCY', 0))
+        self.latency_jitter = float(latency_jitter if latency_jitter is not None
+                                    else os.getenv('LOCAL_IMAGE_LATENCY_JITTER', 0))
+        self.failure_rate = float(failure_rate if failure_rate is not None
+                                  else os.getenv('LOCAL_IMAGE_FAILURE_RATE', 0))
+        if seed is None and os.getenv('LOCAL_IMAGE_SEED'):
+            seed = int(os.getenv('LOCAL_IMAGE_SEED'))
+        self.random_ = random.Random(seed)
+        self.random_lock_ = threading.Lock()
+        self.images = SimpleNamespace(generate=self.generate)
+
+    def generate(self, model: str = None, prompt: str = "", size: str = "1024x1024",
+                 n: int = 1, response_format: str = "b64_json", **kwargs):
+        with self.random_lock_:
+            delay = max(0.0, self.random_.gauss(self.latency, self.latency_jitter)) if self.latency_jitter else self.latency
+            failed = self.random_.random() < self.failure_rate
+
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise LocalImageError(f"本地生图模拟失败 (failure_rate={self.failure_rate})")
+
+        width, height = (int(v) for v in size.lower().split('x'))
+        img = render_placeholder(prompt, width, height)
+
+        buffer = BytesIO()
+        img.save(buffer, format='PNG')
+        b64 = base64.b64encode(buffer.getvalue()).decode('ascii')
+        return SimpleNamespace(data=[SimpleNamespace(b64_json=b64, url=None) for _ in range(n)])
+
+
+def render_placeholder(prompt: str, width: int, height: int):
+    digest = hashlib.md5((prompt or '').encode('utf-8')).digest()
+    start_color = tuple(digest[0:3])
+    end_color = tuple(digest[3:6])
+
+    # 水平渐变：先生成一行再拉伸，避免逐像素绘制
+    row = Image.new('RGB', (width, 1))
+    row.putdata([
+        tuple(int(start_color[c] + (end_color[c] - start_color[c]) * x / max(1, width - 1)) for c in range(3))
+        for x in range(width)
+    ])
+    img = row.resize((width, height))
+
+    font = load_chinese_font(max(16, height // 24))
+    draw = ImageDraw.Draw(img)
+    draw.text((20, 20), digest.hex()[:12], font=font, fill=(255, 255, 255))
+    snippet = (prompt or '')[:120]
+    line_length = max(1, width // max(16, height // 24))
+    for i in range(0, len(snippet), line_length):
+        draw.text((20, 60 + (i // line_length) * (height // 20)), snippet[i:i + line_length], font=font, fill=(255, 255, 255))
+    return img
@@ -0,0 +1,252 @@
+import os
+import re
+import json
+import logging
+import hashlib
+import threading
+from typing import Optional, Tuple, Any, List
+
+import jieba
+import numpy as np
+
+
+# MinHash 签名长度与 LSH 分桶参数：16 个 band * 4 行，相似度约 0.5 以上才会成为候选
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+_MERSENNE_PRIME = np.uint64((1 << 32) - 5)
+
+_rng = np.random.RandomState(20251024)
+_PERM_A = _rng.randint(1, (1 << 32) - 5, size=NUM_PERMUTATIONS, dtype=np.int64).astype(np.uint64)
+_PERM_B = _rng.randint(0, (1 << 32) - 5, size=NUM_PERMUTATIONS, dtype=np.int64).astype(np.uint64)
+
+_TOKEN_PATTERN = re.compile(r'\w')
+
+# 索引最多保留的条目数，超出时淘汰最早写入的；持久化文件的行数超过它的两倍时按内存里的条目重写
+MAX_INDEX_ENTRIES = 5000
+
+
+def tokenize_prompt(prompt: str) -> List[str]:
+    """jieba 分词后去掉标点/空白，用词 + 相邻词对作为 shingle，兼顾用词与语序"""
+    words = [w.strip().lower() for w in jieba.lcut(prompt or '')]
+    words = [w for w in words if w and _TOKEN_PATTERN.search(w)]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def minhash_signature(tokens: List[str]) -> np.ndarray:
+    if not tokens:
+        return np.full(NUM_PERMUTATIONS, np.iinfo(np.uint64).max, dtype=np.uint64)
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(t.encode('utf-8'), digest_size=4).digest(), 'little') for t in set(tokens)],
+        dtype=np.uint64
+    ) % _MERSENNE_PRIME
+    permuted = (np.outer(hashes, _PERM_A) + _PERM_B) % _MERSENNE_PRIME
+    return permuted.min(axis=0)
+
+
+class PromptSimilarityIndex:
+    """
+    场景提示词的近似去重索引（MinHash + LSH）。
+    namespace 用于隔离不能互相复用的图片（不同 provider / 风格 / 角色组合）。
+    条目的 value 可以是图片路径，也可以是尚在生成中的 Future。
+    """
+
+    def __init__(self, persist_path: str = None, max_entries: int = MAX_INDEX_ENTRIES):
+        self.persist_path_ = persist_path
+        self.max_entries = max_entries
+        self.lock_ = threading.Lock()
+        # entry_id -> 条目，按写入先后排列，超出 max_entries 时从最早的开始淘汰
+        self.entries_ = {}
+        self.next_id_ = 0
+        self.buckets_ = {}
+        # (namespace, prompt) -> entry_id，同一提示词只保留一个条目
+        self.keys_ = {}
+        # 持久化文件当前的行数（含被后续行覆盖的旧记录）
+        self.disk_lines_ = 0
+        self.loaded_ = persist_path is None
+
+    def find(self, prompt: str, namespace: str, threshold: float) -> Optional[Tuple[Any, float, str]]:
+        """返回 (value, 相似度, 命中的提示词)，没有达到阈值的条目时返回 None；完全相同的提示词不算命中"""
+        signature = minhash_signature(tokenize_prompt(prompt))
+        with self.lock_:
+            self._ensure_loaded()
+            return self._find(prompt, namespace, threshold, signature)
+
+    def find_or_add(self, prompt: str, namespace: str, threshold: float,
+                    value: Any) -> Tuple[Optional[Tuple[Any, float, str]], Optional[int]]:
+        """
+        在同一把锁内查找相似条目，没有时插入 value（一般是生成中的 Future）。
+        返回 (命中结果, None) 或 (None, 新条目 id)；并发的相似提示词只有一个会插入，其余命中它
+        """
+        signature = minhash_signature(tokenize_prompt(prompt))
+        with self.lock_:
+            self._ensure_loaded()
+            match = self._find(prompt, namespace, threshold, signature)
+            if match:
+                return match, None
+            entry_id, is_new = self._insert(prompt, namespace, value, signature)
+            if is_new and self.persist_path_ and isinstance(value, str):
+                self._append_to_disk(prompt, namespace, value, signature)
+            return None, entry_id
+
+    def add(self, prompt: str, namespace: str, value: Any) -> int:
+        signature = minhash_signature(tokenize_prompt(prompt))
+        with self.lock_:
+            self._ensure_loaded()
+            entry_id, is_new = self._insert(prompt, namespace, value, signature)
+            if is_new and self.persist_path_ and isinstance(value, str):
+                self._append_to_disk(prompt, namespace, value, signature)
+            return entry_id
+
+    def update(self, entry_id: int, value: Any):
+        """把生成中的 Future 替换为最终结果（图片路径或 None）"""
+        with self.lock_:
+            entry = self.entries_.get(entry_id)
+            if entry is None:
+                return
+            entry['value'] = value
+            if self.persist_path_ and isinstance(value, str):
+                self._append_to_disk(entry['prompt'], entry['namespace'], value, entry['signature'])
+
+    def _find(self, prompt, namespace, threshold, signature):
+        candidates = set()
+        for band_key in self._band_keys(signature, namespace):
+            candidates.update(self.buckets_.get(band_key, ()))
+
+        best = None
+        for entry_id in candidates:
+            entry = self.entries_[entry_id]
+            if entry['prompt'] == prompt or entry['value'] is None:
+                continue
+            similarity = float(np.mean(entry['signature'] == signature))
+            if similarity >= threshold and (best is None or similarity > best[1]):
+                best = (entry['value'], similarity, entry['prompt'])
+        return best
+
+    def _insert(self, prompt, namespace, value, signature):
+        entry_id = self.keys_.get((namespace, prompt))
+        if entry_id is not None:
+            # 重新写入的条目移到末尾，淘汰时按最近一次写入算
+            entry = self.entries_.pop(entry_id)
+            entry['value'] = value
+            self.entries_[entry_id] = entry
+            return entry_id, False
+
+        entry_id = self.next_id_
+        self.next_id_ += 1
+        self.keys_[(namespace, prompt)] = entry_id
+        self.entries_[entry_id] = {'prompt': prompt, 'namespace': namespace, 'value': value, 'signature': signature}
+        for band_key in self._band_keys(signature, namespace):
+            self.buckets_.setdefault(band_key, set()).add(entry_id)
+        self._evict_overflow()
+        return entry_id, True
+
+    def _evict_overflow(self):
+        """淘汰最早写入的条目；生成中的 Future 还会被 update，保留"""
+        overflow = len(self.entries_) - self.max_entries
+        if overflow <= 0:
+            return
+        for entry_id, entry in list(self.entries_.items()):
+            if overflow <= 0:
+                break
+            if entry['value'] is not None and not isinstance(entry['value'], str):
+                continue
+            del self.entries_[entry_id]
+            del self.keys_[(entry['namespace'], entry['prompt'])]
+            for band_key in self._band_keys(entry['signature'], entry['namespace']):
+                bucket = self.buckets_[band_key]
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self.buckets_[band_key]
+            overflow -= 1
+
+    def _band_keys(self, signature: np.ndarray, namespace: str):
+        for band in range(LSH_BANDS):
+            rows = signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]
+            yield (namespace, band, rows.tobytes())
+
+    def _ensure_loaded(self):
+        if self.loaded_:
+            return
+        self.loaded_ = True
+        # 同一提示词的多行记录以最后一行为准，并按最后写入的先后排序，只取最近的 max_entries 条
+        records = {}
+        needs_rewrite = False
+        read_failed = False
+        try:
+            with open(self.persist_path_, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self.disk_lines_ += 1
+                    try:
+                        record = json.loads(line)
+                        key = (record['namespace'], record['prompt'])
+                        if not isinstance(record['path'], str):
+                            raise ValueError(f"path 不是字符串: {record['path']!r}")
+                    except (ValueError, KeyError, TypeError) as e:
+                        # 写到一半中断的行直接跳过，重写文件时会被去掉
+                        logging.warning(f"跳过无法解析的提示词索引记录: {e}")
+                        continue
+                    records.pop(key, None)
+                    records[key] = record
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            # 没读完整个文件时不重写，免得丢掉后面的记录
+            logging.error(f"加载提示词索引失败: {e}")
+            read_failed = True
+
+        for record in list(records.values())[-self.max_entries:]:
+            signature = self._decode_signature(record.get('signature'))
+            if signature is None:
+                # 旧格式的记录没有签名，重新分词计算一次，重写文件后下次加载不必再算
+                signature = minhash_signature(tokenize_prompt(record['prompt']))
+                needs_rewrite = True
+            self._insert(record['prompt'], record['namespace'], record['path'], signature)
+
+        if not read_failed and (needs_rewrite or self.disk_lines_ > len(self.entries_)):
+            self._rewrite_disk()
+
+    @staticmethod
+    def _encode_signature(signature: np.ndarray) -> str:
+        # 签名的每个值都小于 2^32，按 uint32 存储
+        return signature.astype('<u4').tobytes().hex()
+
+    @staticmethod
+    def _decode_signature(encoded: Optional[str]) -> Optional[np.ndarray]:
+        if not encoded or len(encoded) != NUM_PERMUTATIONS * 8:
+            return None
+        try:
+            return np.frombuffer(bytes.fromhex(encoded), dtype='<u4').astype(np.uint64)
+        except ValueError:
+            return None
+
+    def _record(self, prompt: str, namespace: str, path: str, signature: np.ndarray) -> str:
+        return json.dumps({'prompt': prompt, 'namespace': namespace, 'path': path,
+                           'signature': self._encode_signature(signature)}, ensure_ascii=False) + "\n"
+
+    def _append_to_disk(self, prompt: str, namespace: str, path: str, signature: np.ndarray):
+        if self.disk_lines_ >= 2 * self.max_entries:
+            # 条目已经在内存里，重写时会一并写入
+            self._rewrite_disk()
+            return
+        try:
+            with open(self.persist_path_, 'a', encoding='utf-8') as f:
+                f.write(self._record(prompt, namespace, path, signature))
+            self.disk_lines_ += 1
+        except Exception as e:
+            logging.error(f"写入提示词索引失败: {e}")
+
+    def _rewrite_disk(self):
+        """按内存里的条目重写持久化文件，去掉被覆盖和已淘汰的记录"""
+        entries = [entry for entry in self.entries_.values() if isinstance(entry['value'], str)]
+        temp_path = f"{self.persist_path_}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for entry in entries:
+                    f.write(self._record(entry['prompt'], entry['namespace'], entry['value'], entry['signature']))
+            os.replace(temp_path, self.persist_path_)
+            self.disk_lines_ = len(entries)
+        except Exception as e:
+            logging.error(f"重写提示词索引失败: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
@@ -1,20 +1,73 @@
 import os
+import re
+import json
+import unicodedata
+import shutil
 import logging
-from typing import List, Dict, Optional
+import threading
+import concurrent.futures
+from typing import List, Dict, Optional, Callable
 from image_generator import ImageGenerator
 from tts_generator import TTSGenerator
 from character_manager import CharacterManager
+from image_compositor import ImageCompositor, COMPOSITE_LAYOUTS
+from common import link_or_copy
+from audio_utils import AUDIO_VARIANT_PROFILES
+
+
+# 分镜模式下额外写入 metadata.json 的字段
+OPTIONAL_METADATA_KEYS = ('shot_type', 'mood', 'location', 'image_source',
+                          'audio_duration', 'audio_sample_rate', 'audio_channels', 'audio_variants')
+
+MOOD_KEYWORDS = {
+    'happy': '明亮, 欢快的氛围',
+    'sad': '阴暗, 忧郁的氛围',
+    'tense': '紧张, 戏剧性的氛围',
+    'calm': '平静, 宁和的氛围',
+    'surprised': '震惊, 突然的氛围',
+    'angry': '激烈, 冲突的氛围'
+}
+
+# 镜头派生默认配置: shot_type -> 从同地点远景图中保留的画面比例
+DEFAULT_DERIVED_SHOTS = {
+    '中景': 0.6,
+    '特写': 0.35,
+    '过肩镜头': 0.7
+}
 
 
 class SceneComposer:
     def __init__(self, image_generator: ImageGenerator, 
                  tts_generator: TTSGenerator,
                  character_manager: CharacterManager,
-                 session_id: str = None):
+                 session_id: str = None,
+                 grid_layout: str = None,
+                 derive_shots: Dict[str, float] = None,
+                 reuse_backgrounds: bool = False,
+                 audio_variants=None,
+                 batch_tts: bool = False):
         self.image_gen = image_generator
         self.tts_gen = tts_generator
         self.char_mgr = character_manager
         self.session_id = session_id
+        # 多格合图模式（如 '2x2' / '1x3'），None 表示每个分镜单独生图
+        self.grid_layout = grid_layout
+        # 镜头派生（shot_type -> 裁剪比例），None 表示关闭；同地点同角色的连续分镜
+        # 只生成一张远景图，近景在本地裁剪放大得到
+        self.derive_shots = derive_shots
+        # 背景复用：同一任务内按 (地点, 情绪) 只生成一次空背景，角色立绘本地合成上去
+        self.reuse_backgrounds = reuse_backgrounds
+        # 移动端音频档位（如 ('opus', 'aac')），旁白 MP3 之外额外生成低码率版本
+        self.audio_variants = audio_variants
+        # 批量预合成很短的旁白，减少 TTS 请求次数
+        self.batch_tts = batch_tts
+        self.compositor = ImageCompositor()
+        
+        # plan_storyboard 预先规划的分镜出图方式: scene_index -> plan
+        self.panel_plans_ = {}
+        # 多个分镜共享的一次性出图结果（合图等）: key -> Future
+        self.shared_images_ = {}
+        self.shared_images_lock_ = threading.Lock()
         from common import get_base_dir
         
         if session_id:
@@ -53,7 +106,6 @@ class SceneComposer:
         
         if scene_image:
             output_image = os.path.join(scene_folder, "scene.png")
-            import shutil
             shutil.copy(scene_image, output_image)
         else:
             output_image = None
@@ -63,8 +115,7 @@ class SceneComposer:
         if audio_file:
             output_audio = os.path.join(scene_folder, "narration.mp3")
             if audio_file != output_audio:
-                import shutil
-                shutil.copy(audio_file, output_audio)
+                link_or_copy(audio_file, output_audio)
         else:
             output_audio = None
         
@@ -77,6 +128,7 @@ class SceneComposer:
             'audio_path': output_audio,
             'folder': scene_folder
         }
+        metadata.update(self._audio_metadata(output_audio))
         
         self._save_metadata(scene_folder, metadata)
         
@@ -102,7 +154,6 @@ class SceneComposer:
         return description
     
     def _save_metadata(self, folder: str, metadata: Dict):
-        import json
         metadata_path = os.path.join(folder, "metadata.json")
         
         serializable_metadata = {
@@ -113,10 +164,40 @@ class SceneComposer:
             'image_path': metadata.get('image_path'),
             'audio_path': metadata.get('audio_path')
         }
+        for key in OPTIONAL_METADATA_KEYS:
+            if metadata.get(key) is not None:
+                serializable_metadata[key] = metadata[key]
         
         with open(metadata_path, 'w', encoding='utf-8') as f:
             json.dump(serializable_metadata, f, ensure_ascii=False, indent=2)
     
+    def _audio_metadata(self, audio_path: Optional[str]) -> Dict:
+        """合成时顺带记录时长/采样率/声道，播放器和视频合成不必再解码音频；按需生成移动端音频档位"""
+        info = self.tts_gen.get_audio_info(audio_path) if audio_path else None
+        if not info:
+            return {}
+        audio_metadata = {
+            'audio_duration': info['duration'],
+            'audio_sample_rate': info['sample_rate'],
+            'audio_channels': info['channels'],
+        }
+        if self.audio_variants:
+            audio_metadata['audio_variants'] = self._encode_audio_variants(audio_path)
+        return audio_metadata
+    
+    def _encode_audio_variants(self, audio_path: str) -> Dict:
+        variants = {}
+        folder = os.path.dirname(audio_path)
+        for profile, shared_path in self.tts_gen.encode_variants(audio_path, self.audio_variants).items():
+            settings = AUDIO_VARIANT_PROFILES[profile]
+            variant_path = link_or_copy(shared_path, os.path.join(folder, f"narration.{settings['ext']}"))
+            variants[profile] = {
+                'path': variant_path,
+                'size': os.path.getsize(variant_path),
+                'mime': settings['mime'],
+            }
+        return variants
+    
     def create_scene_with_ai_analysis(self, scene_index: int, 
                                      scene_info: Dict,
                                      generate_storyboard: bool = True) -> Dict:
@@ -149,7 +230,6 @@ class SceneComposer:
         output_image = None
         if scene_image:
             output_image = os.path.join(scene_folder, "scene.png")
-            import shutil
             shutil.copy(scene_image, output_image)
         
         audio_file = self.tts_gen.generate_speech_for_scene(scene_text, scene_index)
@@ -157,8 +237,7 @@ class SceneComposer:
         if audio_file:
             output_audio = os.path.join(scene_folder, "narration.mp3")
             if audio_file != output_audio:
-                import shutil
-                shutil.copy(audio_file, output_audio)
+                link_or_copy(audio_file, output_audio)
         else:
             output_audio = None
         
@@ -171,6 +250,7 @@ class SceneComposer:
             'audio_path': output_audio,
             'folder': scene_folder
         }
+        metadata.update(self._audio_metadata(output_audio))
         
         self._save_metadata(scene_folder, metadata)
         
@@ -191,30 +271,269 @@ class SceneComposer:
         
         return scenes
     
-    def create_scene_from_storyboard(self, scene_index: int, 
-                                    panel_info: Dict,
-                                    character_designs: Dict[str, str]) -> Dict:
-        scene_folder = os.path.join(self.output_dir, f"scene_{scene_index:04d}")
-        os.makedirs(scene_folder, exist_ok=True)
-        
+    def plan_storyboard(self, panels: List[Dict],
+                        character_designs: Dict[str, str],
+                        start_index: int = 0,
+                        character_portraits: Dict[str, str] = None):
+        """
+        在并发生成分镜前做一次整体规划（需要看到相邻分镜的优化都在这里决定）：
+        - 镜头派生：同地点、同角色的连续分镜只生成一张远景图，近景在本地裁剪
+        - 背景复用：按 (地点, 情绪) 共享一张空背景，把角色立绘合成上去
+        - 多格合图：剩余的分镜按 grid_layout 的容量分组，每组只发一次生图请求
+        - 批量语音：很短的旁白拼成一次 TTS 请求预先合成，分镜生成时直接命中语音缓存
+        规划结果写入 panel_plans_，create_scene_from_storyboard 按 scene_index 取用。
+        """
+        self.panel_plans_ = {}
+        # 分组 key（grid_{i}_{j} 等）每次规划都会重新编号，不能沿用上一次的共享出图结果
+        with self.shared_images_lock_:
+            self.shared_images_ = {}
+        
+        if self.batch_tts:
+            self.tts_gen.prefetch_short_texts([self._storyboard_scene_text(panel_info) for panel_info in panels])
+        
+        if self.derive_shots:
+            self._plan_shot_runs(panels, character_designs, start_index)
+        
+        if self.reuse_backgrounds:
+            self._plan_composites(panels, start_index, character_portraits or {})
+        
+        if self.grid_layout:
+            self._plan_grids(panels, character_designs, start_index)
+    
+    def _plan_shot_runs(self, panels: List[Dict], character_designs: Dict[str, str], start_index: int):
+        def run_key(panel_info):
+            location = (panel_info.get('location') or '').strip()
+            if not location:
+                return None
+            return location, frozenset(panel_info.get('characters', []))
+        
+        runs = []
+        for offset, panel_info in enumerate(panels):
+            key = run_key(panel_info)
+            if key is not None and runs and runs[-1][0] == key:
+                runs[-1][1].append(offset)
+            else:
+                runs.append((key, [offset]))
+        
+        for key, offsets in runs:
+            if key is None or len(offsets) < 2:
+                continue
+            
+            derived = [o for o in offsets if panels[o].get('shot_type', '中景') in self.derive_shots]
+            if not derived:
+                continue
+            
+            # 优先用本组里不需要派生的镜头（远景/全景）当定场图；没有就按第一个分镜改写成远景
+            establishing = next((o for o in offsets if o not in derived), None)
+            if establishing is not None:
+                establishing_panel = panels[establishing]
+            else:
+                establishing_panel = dict(panels[offsets[0]], shot_type='远景')
+            description, prompts, seeds = self._build_storyboard_prompt(establishing_panel, character_designs)
+            
+            indices = [start_index + o for o in offsets]
+            run_plan = {
+                'group_key': f"establishing_{indices[0]}_{indices[-1]}",
+                'scene_indices': indices,
+                'establishing_index': start_index + establishing if establishing is not None else None,
+                'description': description,
+                'character_prompts': prompts,
+                'character_seeds': seeds
+            }
+            
+            if establishing is not None:
+                self.panel_plans_[start_index + establishing] = dict(run_plan, strategy='establishing')
+            for o in derived:
+                shot_type = panels[o].get('shot_type', '中景')
+                self.panel_plans_[start_index + o] = dict(run_plan, strategy='derived',
+                                                         zoom=self.derive_shots[shot_type])
+    
+    def _plan_composites(self, panels: List[Dict], start_index: int, character_portraits: Dict[str, str]):
+        for offset, panel_info in enumerate(panels):
+            scene_index = start_index + offset
+            if scene_index in self.panel_plans_:
+                continue
+            
+            location = (panel_info.get('location') or '').strip()
+            shot_type = panel_info.get('shot_type', '中景')
+            characters_in_scene = panel_info.get('characters', [])
+            layout = COMPOSITE_LAYOUTS.get(shot_type)
+            if not location or layout is None or len(characters_in_scene) > layout['max_characters']:
+                continue
+            if not all(char in character_portraits for char in characters_in_scene):
+                continue
+            
+            mood = panel_info.get('mood', 'neutral')
+            self.panel_plans_[scene_index] = {
+                'strategy': 'composite',
+                'group_key': f"background_{self._normalize_location(location)}_{mood}",
+                'location': location,
+                'mood': mood,
+                'shot_type': shot_type,
+                'characters': list(characters_in_scene),
+                'portraits': [character_portraits[char] for char in characters_in_scene]
+            }
+    
+    def _normalize_location(self, location: str) -> str:
+        location = unicodedata.normalize('NFKC', location).lower()
+        return re.sub(r'[\s\W_]+', '', location)
+    
+    def _build_background_prompt(self, location: str, mood: str) -> str:
+        prompt_parts = ["镜头类型: 远景", f"场景: {location}", "空镜头, 画面中没有任何人物, 纯背景"]
+        if mood in MOOD_KEYWORDS:
+            prompt_parts.append(MOOD_KEYWORDS[mood])
+        return ", ".join(prompt_parts) + ", 漫画分镜风格, 动漫风格, 高质量, 细节丰富"
+    
+    def _plan_grids(self, panels: List[Dict], character_designs: Dict[str, str], start_index: int):
+        from image_generator import GRID_LAYOUTS
+        
+        cols, rows, _ = GRID_LAYOUTS[self.grid_layout]
+        capacity = cols * rows
+        # 已经由镜头派生等方式规划好的分镜不再参与合图
+        remaining = [(start_index + offset, panel_info) for offset, panel_info in enumerate(panels)
+                     if start_index + offset not in self.panel_plans_]
+        
+        for group_start in range(0, len(remaining), capacity):
+            group = remaining[group_start:group_start + capacity]
+            # 只剩一个分镜时合图没有收益，退回单独生图
+            if len(group) < 2:
+                continue
+            
+            indices = [scene_index for scene_index, _ in group]
+            descriptions = []
+            character_prompts = []
+            character_seeds = {}
+            for _, panel_info in group:
+                description, prompts, seeds = self._build_storyboard_prompt(panel_info, character_designs)
+                descriptions.append(description)
+                character_prompts.extend(p for p in prompts if p not in character_prompts)
+                character_seeds.update(seeds)
+            
+            group_key = f"grid_{indices[0]}_{indices[-1]}"
+            for cell, scene_index in enumerate(indices):
+                self.panel_plans_[scene_index] = {
+                    'strategy': 'grid',
+                    'group_key': group_key,
+                    'cell': cell,
+                    'scene_indices': indices,
+                    'descriptions': descriptions,
+                    'character_prompts': character_prompts,
+                    'character_seeds': character_seeds
+                }
+    
+    def _shared_image(self, key: str, factory: Callable):
+        """同一个 key 只执行一次 factory，并发的分镜线程等待并共享结果"""
+        with self.shared_images_lock_:
+            future = self.shared_images_.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = concurrent.futures.Future()
+                self.shared_images_[key] = future
+        
+        if is_owner:
+            try:
+                future.set_result(factory())
+            except Exception as e:
+                logging.exception(f"共享出图失败 ({key}): {e}")
+                future.set_result(None)
+        
+        return future.result()
+    
+    def _planned_scene_image(self, scene_index: int) -> Optional[Dict]:
+        plan = self.panel_plans_.get(scene_index)
+        if not plan:
+            return None
+        
+        if plan['strategy'] == 'grid':
+            cells = self._shared_image(
+                plan['group_key'],
+                lambda: self.image_gen.generate_scene_grid(
+                    plan['descriptions'],
+                    layout=self.grid_layout,
+                    characters=plan['character_prompts'],
+                    character_seeds=plan['character_seeds']
+                )
+            )
+            cell = cells[plan['cell']] if cells else None
+            if not cell:
+                return None
+            return {
+                'image_path': cell['image_path'],
+                'image_source': {
+                    'type': 'grid',
+                    'grid_id': cell['grid_id'],
+                    'grid_layout': cell['grid_layout'],
+                    'grid_cell': cell['grid_cell'],
+                    'grid_scenes': plan['scene_indices']
+                }
+            }
+        
+        if plan['strategy'] in ('establishing', 'derived'):
+            establishing_image = self._shared_image(
+                plan['group_key'],
+                lambda: self.image_gen.generate_scene_image(
+                    plan['description'],
+                    characters=plan['character_prompts'],
+                    character_seeds=plan['character_seeds']
+                )
+            )
+            if not establishing_image:
+                return None
+            
+            if plan['strategy'] == 'establishing':
+                return {
+                    'image_path': establishing_image,
+                    'image_source': {
+                        'type': 'establishing',
+                        'run_scenes': plan['scene_indices']
+                    }
+                }
+            
+            derived_image = self.compositor.derive_shot(establishing_image, plan['zoom'])
+            if not derived_image:
+                return None
+            return {
+                'image_path': derived_image,
+                'image_source': {
+                    'type': 'derived',
+                    'derived_from': plan['establishing_index'],
+                    'zoom': plan['zoom'],
+                    'run_scenes': plan['scene_indices']
+                }
+            }
+        
+        if plan['strategy'] == 'composite':
+            background = self._shared_image(
+                plan['group_key'],
+                lambda: self.image_gen.generate_scene_image(
+                    self._build_background_prompt(plan['location'], plan['mood'])
+                )
+            )
+            if not background:
+                return None
+            
+            composite = self.compositor.composite_characters(background, plan['portraits'], plan['shot_type'])
+            if not composite:
+                logging.info(f"分镜 {scene_index} 无法本地合成，退回完整生图")
+                return None
+            return {
+                'image_path': composite,
+                'image_source': {
+                    'type': 'composite',
+                    'background': plan['group_key'],
+                    'characters': plan['characters']
+                }
+            }
+        
+        return None
+    
+    def _build_storyboard_prompt(self, panel_info: Dict, character_designs: Dict[str, str]):
         shot_type = panel_info.get('shot_type', '中景')
         visual_desc = panel_info.get('visual_description', '')
-        dialogues = panel_info.get('dialogue', [])
-        narration = panel_info.get('narration', '')
         characters_in_scene = panel_info.get('characters', [])
         location = panel_info.get('location', '')
         mood = panel_info.get('mood', 'neutral')
         
-        scene_text = ""
-        if narration:
-            scene_text += narration
-        if dialogues:
-            for dialogue in dialogues:
-                char = dialogue.get('character', '')
-                text = dialogue.get('text', '')
-                if char and text:
-                    scene_text += f"\n{char}：{text}"
-        
         prompt_parts = [f"镜头类型: {shot_type}"]
         
         if visual_desc:
@@ -227,17 +546,8 @@ class SceneComposer:
             if char_name in character_designs:
                 prompt_parts.append(f"{char_name}: {character_designs[char_name]}")
         
-        mood_keywords = {
-            'happy': '明亮, 欢快的氛围',
-            'sad': '阴暗, 忧郁的氛围',
-            'tense': '紧张, 戏剧性的氛围',
-            'calm': '平静, 宁和的氛围',
-            'surprised': '震惊, 突然的氛围',
-            'angry': '激烈, 冲突的氛围'
-        }
-        
-        if mood in mood_keywords:
-            prompt_parts.append(mood_keywords[mood])
+        if mood in MOOD_KEYWORDS:
+            prompt_parts.append(MOOD_KEYWORDS[mood])
         
         scene_description = ", ".join(prompt_parts)
         scene_description += ", 漫画分镜风格, 动漫风格, 高质量, 细节丰富"
@@ -251,20 +561,56 @@ class SceneComposer:
                           for char in characters_in_scene 
                           if self.char_mgr.get_character(char)}
         
+        return scene_description, character_prompts, character_seeds
+    
+    def _storyboard_scene_text(self, panel_info: Dict) -> str:
+        scene_text = ""
+        narration = panel_info.get('narration', '')
+        if narration:
+            scene_text += narration
+        for dialogue in panel_info.get('dialogue', []) or []:
+            char = dialogue.get('character', '')
+            text = dialogue.get('text', '')
+            if char and text:
+                scene_text += f"\n{char}：{text}"
+        return scene_text
+    
+    def create_scene_from_storyboard(self, scene_index: int, 
+                                    panel_info: Dict,
+                                    character_designs: Dict[str, str]) -> Dict:
+        scene_folder = os.path.join(self.output_dir, f"scene_{scene_index:04d}")
+        os.makedirs(scene_folder, exist_ok=True)
+        
+        shot_type = panel_info.get('shot_type', '中景')
+        characters_in_scene = panel_info.get('characters', [])
+        location = panel_info.get('location', '')
+        mood = panel_info.get('mood', 'neutral')
+        
+        scene_text = self._storyboard_scene_text(panel_info)
+        
+        scene_description, character_prompts, character_seeds = self._build_storyboard_prompt(
+            panel_info, character_designs
+        )
+        
         for char in characters_in_scene:
             if self.char_mgr.get_character(char):
                 self.char_mgr.increment_appearance_count(char)
         
-        scene_image = self.image_gen.generate_scene_image(
-            scene_description,
-            characters=character_prompts,
-            character_seeds=character_seeds
-        )
+        image_source = None
+        planned = self._planned_scene_image(scene_index)
+        if planned:
+            scene_image = planned['image_path']
+            image_source = planned['image_source']
+        else:
+            scene_image = self.image_gen.generate_scene_image(
+                scene_description,
+                characters=character_prompts,
+                character_seeds=character_seeds
+            )
         
         output_image = None
         if scene_image:
             output_image = os.path.join(scene_folder, "scene.png")
-            import shutil
             shutil.copy(scene_image, output_image)
         
         audio_file = self.tts_gen.generate_speech_for_scene(scene_text, scene_index)
@@ -272,7 +618,7 @@ class SceneComposer:
         if audio_file:
             output_audio = os.path.join(scene_folder, "narration.mp3")
             if audio_file != output_audio:
-                shutil.copy(audio_file, output_audio)
+                link_or_copy(audio_file, output_audio)
         else:
             output_audio = None
         
@@ -286,8 +632,10 @@ class SceneComposer:
             'location': location,
             'image_path': output_image,
             'audio_path': output_audio,
+            'image_source': image_source,
             'folder': scene_folder
         }
+        metadata.update(self._audio_metadata(output_audio))
         
         self._save_metadata(scene_folder, metadata)
         
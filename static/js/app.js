@@ -3,6 +3,11 @@ let scenes = [];
 let currentSceneIndex = 0;
 let isPlaying = false;
 let audioPlayer = null;
+// 已预取的分镜：index -> { image, audio }，保持引用让浏览器留着缓存
+let prefetchedScenes = {};
+let silentTimer = null;
+// 生成过程中边生成边播放 HLS 时的 hls.js 实例（浏览器原生支持 HLS 时为 null）
+let liveHls = null;
 let currentContextMenuSessionId = null;
 
 document.addEventListener('DOMContentLoaded', function() {
@@ -448,11 +453,14 @@ async function pollStatus() {
             updateProgress(data);
 
             if (data.status === 'processing') {
+                if (data.hls_url) startLivePlayback(data.hls_url);
                 setTimeout(pollStatus, 2000);
             } else if (data.status === 'completed') {
+                stopLivePlayback();
                 await loadScenes();
                 loadHistoryList();
             } else if (data.status === 'error') {
+                stopLivePlayback();
                 alert('生成失败: ' + data.message);
                 resetUploadSection();
             }
@@ -463,6 +471,39 @@ async function pollStatus() {
     }
 }
 
+function startLivePlayback(hlsUrl) {
+    // 第一个分镜片段就绪后即可播放：原生支持 HLS（Safari、Android WebView）直接播放，其余浏览器用 hls.js；
+    // 都不支持时不显示，生成完成后用分镜播放器
+    const video = document.getElementById('live-video');
+    if (!video || video.dataset.src === hlsUrl) return;
+
+    if (video.canPlayType('application/vnd.apple.mpegurl')) {
+        video.src = hlsUrl;
+    } else if (window.Hls && Hls.isSupported()) {
+        liveHls = new Hls();
+        liveHls.loadSource(hlsUrl);
+        liveHls.attachMedia(video);
+    } else {
+        return;
+    }
+    video.dataset.src = hlsUrl;
+    video.classList.remove('hidden');
+}
+
+function stopLivePlayback() {
+    const video = document.getElementById('live-video');
+    if (!video) return;
+    if (liveHls) {
+        liveHls.destroy();
+        liveHls = null;
+    }
+    video.pause();
+    video.removeAttribute('src');
+    video.load();
+    delete video.dataset.src;
+    video.classList.add('hidden');
+}
+
 function updateProgress(data) {
     const progressFill = document.getElementById('progress-fill');
     const progressText = document.getElementById('progress-text');
@@ -473,13 +514,14 @@ function updateProgress(data) {
 
 async function loadScenes() {
     try {
-        const response = await fetch(`/api/scenes/${currentTaskId}`, {
+        const response = await fetch(`/api/timeline/${currentTaskId}`, {
             credentials: 'include'
         });
         const data = await response.json();
 
         if (response.ok) {
             scenes = data.scenes;
+            prefetchedScenes = {};
             currentSceneIndex = 0;
 
             document.getElementById('progress-section').classList.add('hidden');
@@ -541,7 +583,14 @@ function displayScene(index) {
         sceneCharacters.textContent = '';
     }
 
-    audioPlayer.src = scene.audio_url;
+    const audioUrl = pickAudioUrl(scene);
+    if (audioUrl) {
+        audioPlayer.src = audioUrl;
+    } else {
+        audioPlayer.removeAttribute('src');
+        audioPlayer.load();
+    }
+    prefetchScene(index + 1);
 
     const sceneCard = document.getElementById('scene-card');
     sceneCard.style.animation = 'none';
@@ -550,6 +599,33 @@ function displayScene(index) {
     }, 10);
 }
 
+function pickAudioUrl(scene) {
+    // 按服务端给出的顺序选第一个能播放的档位（低码率在前，MP3 兜底）
+    const variants = scene.audio_variants || [];
+    for (const variant of variants) {
+        if (audioPlayer.canPlayType(variant.mime)) {
+            return variant.url;
+        }
+    }
+    return scene.audio_url;
+}
+
+function prefetchScene(index) {
+    // 提前加载下一分镜的图片和音频，切换时直接命中缓存
+    if (index < 0 || index >= scenes.length || prefetchedScenes[index]) return;
+    const scene = scenes[index];
+    const image = new Image();
+    image.src = scene.image_url;
+    const audioUrl = pickAudioUrl(scene);
+    let audio = null;
+    if (audioUrl) {
+        audio = new Audio();
+        audio.preload = 'auto';
+        audio.src = audioUrl;
+    }
+    prefetchedScenes[index] = { image, audio };
+}
+
 function togglePlayPause() {
     if (isPlaying) {
         pausePlayback();
@@ -562,6 +638,12 @@ function startPlayback() {
     isPlaying = true;
     document.getElementById('play-pause-btn').textContent = '⏸ 暂停';
     
+    if (!audioPlayer.getAttribute('src')) {
+        // 没有配音的分镜按时间轴给出的时长停留
+        clearTimeout(silentTimer);
+        silentTimer = setTimeout(handleAudioEnded, scenes[currentSceneIndex].duration * 1000);
+        return;
+    }
     audioPlayer.play().catch(error => {
         console.error('音频播放失败:', error);
         isPlaying = false;
@@ -571,12 +653,14 @@ function startPlayback() {
 
 function pausePlayback() {
     isPlaying = false;
+    clearTimeout(silentTimer);
     audioPlayer.pause();
     document.getElementById('play-pause-btn').textContent = '▶️ 播放';
 }
 
 function stopPlayback() {
     isPlaying = false;
+    clearTimeout(silentTimer);
     audioPlayer.pause();
     audioPlayer.currentTime = 0;
     document.getElementById('play-pause-btn').textContent = '▶️ 播放';
@@ -593,10 +677,9 @@ function navigateScene(direction) {
 
 function handleAudioEnded() {
     if (currentSceneIndex < scenes.length - 1) {
+        // 下一分镜已预取，直接切换，不留间隔
         navigateScene(1);
-        setTimeout(() => {
-            startPlayback();
-        }, 500);
+        startPlayback();
     } else {
         isPlaying = false;
         document.getElementById('play-pause-btn').textContent = '▶️ 播放';
@@ -610,12 +693,14 @@ function handleVolumeChange(event) {
 }
 
 function resetUploadSection() {
+    stopLivePlayback();
     document.getElementById('progress-section').classList.add('hidden');
     document.getElementById('welcome-section').style.display = 'flex';
 }
 
 function returnToHome() {
     stopPlayback();
+    stopLivePlayback();
     
     const fileInput = document.getElementById('novel-file');
     if (fileInput) fileInput.value = '';
@@ -691,13 +776,14 @@ function updateContentHeader() {
 
 async function loadPlayback(sessionId, inputText = null) {
     try {
-        const response = await fetch(`/api/scenes/${sessionId}`, {
+        const response = await fetch(`/api/timeline/${sessionId}`, {
             credentials: 'include'
         });
         const data = await response.json();
 
         if (response.ok) {
             scenes = data.scenes;
+            prefetchedScenes = {};
             currentSceneIndex = 0;
             currentTaskId = sessionId;
             currentInputText = inputText;
@@ -781,12 +867,20 @@ async function handleDownload() {
     try {
         const downloadUrl = `/api/download/${currentTaskId}`;
         
-        const response = await fetch(downloadUrl, {
+        let response = await fetch(downloadUrl, {
             credentials: 'include'
         });
         
+        // 202：服务端在后台合并，轮询合并状态，完成后再取文件
+        if (response.status === 202) {
+            await waitForMergedVideo(currentTaskId);
+            response = await fetch(downloadUrl, {
+                credentials: 'include'
+            });
+        }
+        
         if (!response.ok) {
-            throw new Error('下载失败');
+            throw new Error(response.status === 401 ? '请先登录' : '下载失败');
         }
         
         const blob = await response.blob();
@@ -813,6 +907,24 @@ async function handleDownload() {
     }
 }
 
+async function waitForMergedVideo(taskId) {
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        
+        const response = await fetch(`/api/download_status/${taskId}`, {
+            credentials: 'include'
+        });
+        const job = await response.json();
+        
+        if (!response.ok || job.status === 'error') {
+            throw new Error(job.message || job.error || '视频合并失败');
+        }
+        if (job.status === 'completed') {
+            return;
+        }
+    }
+}
+
 function showPaymentDialog(paymentAmount, wordCount) {
     return new Promise((resolve) => {
         const dialog = document.createElement('div');
@@ -2,6 +2,9 @@ let scenes = [];
 let currentSceneIndex = 0;
 let isPlaying = false;
 let audioPlayer = null;
+// 已预取的分镜：index -> { image, audio }，保持引用让浏览器留着缓存
+let prefetchedScenes = {};
+let silentTimer = null;
 let currentTaskId = null;
 let currentInputText = null;
 
@@ -85,6 +88,20 @@ function displaySharedList(records) {
         item.appendChild(title);
         item.appendChild(userInfo);
         
+        if (record.preview_url) {
+            // 低码率预览短片：只预加载元数据，鼠标悬停时才播放
+            const preview = document.createElement('video');
+            preview.className = 'history-item-preview';
+            preview.src = record.preview_url;
+            preview.muted = true;
+            preview.loop = true;
+            preview.playsInline = true;
+            preview.preload = 'metadata';
+            item.appendChild(preview);
+            item.addEventListener('mouseenter', () => preview.play().catch(() => {}));
+            item.addEventListener('mouseleave', () => preview.pause());
+        }
+        
         item.addEventListener('click', () => {
             if (record.session_id && record.generated_scene_count > 0) {
                 loadPlayback(record.session_id, record.input_text);
@@ -104,13 +121,14 @@ function displaySharedList(records) {
 
 async function loadPlayback(sessionId, inputText = null) {
     try {
-        const response = await fetch(`/api/scenes/${sessionId}`, {
+        const response = await fetch(`/api/timeline/${sessionId}`, {
             credentials: 'include'
         });
         const data = await response.json();
 
         if (response.ok) {
             scenes = data.scenes;
+            prefetchedScenes = {};
             currentSceneIndex = 0;
             currentTaskId = sessionId;
             currentInputText = inputText;
@@ -174,7 +192,14 @@ function displayScene(index) {
         sceneCharacters.textContent = '';
     }
 
-    audioPlayer.src = scene.audio_url;
+    const audioUrl = pickAudioUrl(scene);
+    if (audioUrl) {
+        audioPlayer.src = audioUrl;
+    } else {
+        audioPlayer.removeAttribute('src');
+        audioPlayer.load();
+    }
+    prefetchScene(index + 1);
 
     const sceneCard = document.getElementById('scene-card');
     sceneCard.style.animation = 'none';
@@ -183,6 +208,33 @@ function displayScene(index) {
     }, 10);
 }
 
+function pickAudioUrl(scene) {
+    // 按服务端给出的顺序选第一个能播放的档位（低码率在前，MP3 兜底）
+    const variants = scene.audio_variants || [];
+    for (const variant of variants) {
+        if (audioPlayer.canPlayType(variant.mime)) {
+            return variant.url;
+        }
+    }
+    return scene.audio_url;
+}
+
+function prefetchScene(index) {
+    // 提前加载下一分镜的图片和音频，切换时直接命中缓存
+    if (index < 0 || index >= scenes.length || prefetchedScenes[index]) return;
+    const scene = scenes[index];
+    const image = new Image();
+    image.src = scene.image_url;
+    const audioUrl = pickAudioUrl(scene);
+    let audio = null;
+    if (audioUrl) {
+        audio = new Audio();
+        audio.preload = 'auto';
+        audio.src = audioUrl;
+    }
+    prefetchedScenes[index] = { image, audio };
+}
+
 function togglePlayPause() {
     if (isPlaying) {
         pausePlayback();
@@ -195,6 +247,12 @@ function startPlayback() {
     isPlaying = true;
     document.getElementById('play-pause-btn').textContent = '⏸ 暂停';
     
+    if (!audioPlayer.getAttribute('src')) {
+        // 没有配音的分镜按时间轴给出的时长停留
+        clearTimeout(silentTimer);
+        silentTimer = setTimeout(handleAudioEnded, scenes[currentSceneIndex].duration * 1000);
+        return;
+    }
     audioPlayer.play().catch(error => {
         console.error('音频播放失败:', error);
         isPlaying = false;
@@ -204,12 +262,14 @@ function startPlayback() {
 
 function pausePlayback() {
     isPlaying = false;
+    clearTimeout(silentTimer);
     audioPlayer.pause();
     document.getElementById('play-pause-btn').textContent = '▶️ 播放';
 }
 
 function stopPlayback() {
     isPlaying = false;
+    clearTimeout(silentTimer);
     audioPlayer.pause();
     audioPlayer.currentTime = 0;
     document.getElementById('play-pause-btn').textContent = '▶️ 播放';
@@ -226,10 +286,9 @@ function navigateScene(direction) {
 
 function handleAudioEnded() {
     if (currentSceneIndex < scenes.length - 1) {
+        // 下一分镜已预取，直接切换，不留间隔
         navigateScene(1);
-        setTimeout(() => {
-            startPlayback();
-        }, 500);
+        startPlayback();
     } else {
         isPlaying = false;
         document.getElementById('play-pause-btn').textContent = '▶️ 播放';
@@ -365,12 +424,20 @@ async function handleDownload() {
     try {
         const downloadUrl = `/api/download/${currentTaskId}`;
         
-        const response = await fetch(downloadUrl, {
+        let response = await fetch(downloadUrl, {
             credentials: 'include'
         });
         
+        // 202：服务端在后台合并，轮询合并状态，完成后再取文件
+        if (response.status === 202) {
+            await waitForMergedVideo(currentTaskId);
+            response = await fetch(downloadUrl, {
+                credentials: 'include'
+            });
+        }
+        
         if (!response.ok) {
-            throw new Error('下载失败');
+            throw new Error(response.status === 401 ? '请先登录' : '下载失败');
         }
         
         const blob = await response.blob();
@@ -396,3 +463,21 @@ async function handleDownload() {
         alert('下载失败: ' + error.message);
     }
 }
+
+async function waitForMergedVideo(taskId) {
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        
+        const response = await fetch(`/api/download_status/${taskId}`, {
+            credentials: 'include'
+        });
+        const job = await response.json();
+        
+        if (!response.ok || job.status === 'error') {
+            throw new Error(job.message || job.error || '视频合并失败');
+        }
+        if (job.status === 'completed') {
+            return;
+        }
+    }
+}
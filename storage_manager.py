@@ -0,0 +1,275 @@
+import os
+import time
+import shutil
+import logging
+import threading
+from typing import Callable, Dict, List
+
+from common import get_base_dir
+
+
+# 存储类别：按 priority 从小到大淘汰，同一类别内按最近使用时间（LRU）淘汰
+# - regenerable：能否从其他文件重新得到（合并视频由片段拼出，片段由分镜重编码，缓存可重新合成）
+# - quota_mb：类别配额，None 不限；max_age_days：超过该天数未使用即删除，None 不限
+STORAGE_CATEGORIES = {
+    'merged_videos': {'priority': 0, 'regenerable': True, 'quota_mb': 2048, 'max_age_days': 3},
+    'video_segments': {'priority': 1, 'regenerable': True, 'quota_mb': 4096, 'max_age_days': 7},
+    'previews': {'priority': 1, 'regenerable': True, 'quota_mb': 512, 'max_age_days': None},
+    'audio_cache': {'priority': 2, 'regenerable': True, 'quota_mb': 2048, 'max_age_days': 30},
+    'image_cache': {'priority': 2, 'regenerable': True, 'quota_mb': 4096, 'max_age_days': 30},
+    'uploads': {'priority': 3, 'regenerable': False, 'quota_mb': 512, 'max_age_days': 30},
+    'session_outputs': {'priority': 4, 'regenerable': False, 'quota_mb': None, 'max_age_days': None},
+}
+# 磁盘剩余空间低于该值时，不论配额，按优先级淘汰可再生的类别
+MIN_FREE_DISK_MB = 1024
+# 后台线程每次只扫描一个类别，扫完一轮所有类别需要 len(STORAGE_CATEGORIES) 个间隔
+SCAN_INTERVAL_SECONDS = 60
+# 最近这段时间内用过的条目不淘汰，避免删掉正在写入的临时目录或刚合并完的视频
+ACTIVE_GRACE_SECONDS = 600
+
+MB = 1024 * 1024
+
+
+class StorageManager:
+    """
+    base_dir 下生成产物的生命周期管理：统计各类别占用，按配额、保留天数和磁盘剩余空间淘汰。
+    条目是一个文件或一个任务目录；is_active(task_id) 返回 True 的任务（生成或合并中）不会被淘汰
+    """
+
+    def __init__(self, base_dir: str = None, categories: Dict[str, Dict] = None,
+                 min_free_mb: int = MIN_FREE_DISK_MB, is_active: Callable[[str], bool] = None,
+                 interval: float = SCAN_INTERVAL_SECONDS):
+        self.base_dir = base_dir or get_base_dir()
+        self.categories = {name: dict(settings) for name, settings in STORAGE_CATEGORIES.items()}
+        for name, overrides in (categories or {}).items():
+            self.categories[name].update(overrides)
+        self.min_free_mb = min_free_mb
+        self.interval = interval
+        self.is_active_ = is_active or (lambda task_id: False)
+        # 类别 -> 最近一次扫描结果；路径 -> 最近访问时间（比 mtime 更接近真实的使用情况）
+        self.usage_ = {}
+        self.access_ = {}
+        self.lock_ = threading.Lock()
+        self.stop_event_ = threading.Event()
+        self.thread_ = None
+
+    def start(self):
+        if self.thread_ and self.thread_.is_alive():
+            return
+        self.stop_event_.clear()
+        self.thread_ = threading.Thread(target=self._run, name='storage-manager', daemon=True)
+        self.thread_.start()
+
+    def stop(self):
+        self.stop_event_.set()
+        if self.thread_:
+            self.thread_.join()
+            self.thread_ = None
+
+    def touch(self, path: str):
+        """记录一次访问（下载、播放），LRU 淘汰时以此为准"""
+        with self.lock_:
+            self.access_[os.path.normpath(path)] = time.time()
+
+    def get_usage(self) -> Dict:
+        """各类别最近一次扫描的占用；后台线程还没扫到的类别 bytes 为 None"""
+        categories = {}
+        with self.lock_:
+            for name, settings in self.categories.items():
+                scan = self.usage_.get(name)
+                categories[name] = {
+                    'bytes': scan['bytes'] if scan else None,
+                    'items': len(scan['items']) if scan else None,
+                    'quota_bytes': settings['quota_mb'] * MB if settings['quota_mb'] is not None else None,
+                    'regenerable': settings['regenerable'],
+                    'scanned_at': scan['scanned_at'] if scan else None,
+                }
+        disk = shutil.disk_usage(self.base_dir)
+        return {'categories': categories, 'disk': {'total_bytes': disk.total, 'free_bytes': disk.free}}
+
+    def run_once(self, category: str = None) -> int:
+        """扫描并清理一个类别（不传时全部类别），再检查磁盘剩余空间，返回释放的字节数"""
+        names = [category] if category else self._ordered_categories()
+        freed = sum(self.enforce(name) for name in names)
+        return freed + self._evict_for_disk()
+
+    def scan(self, category: str) -> List[Dict]:
+        items = []
+        for path, task_id in self._list_items(category):
+            size, modified = self._measure(path)
+            with self.lock_:
+                accessed = self.access_.get(os.path.normpath(path), 0)
+            items.append({'path': path, 'task_id': task_id, 'bytes': size,
+                          'last_used': max(modified, accessed), 'category': category})
+        with self.lock_:
+            self.usage_[category] = {'items': items, 'bytes': sum(item['bytes'] for item in items),
+                                     'scanned_at': time.time()}
+        return items
+
+    def enforce(self, category: str) -> int:
+        settings = self.categories[category]
+        items = sorted(self.scan(category), key=lambda item: item['last_used'])
+        now = time.time()
+        quota = settings['quota_mb'] * MB if settings['quota_mb'] is not None else None
+        max_age = settings['max_age_days'] * 86400 if settings['max_age_days'] is not None else None
+        total = sum(item['bytes'] for item in items)
+
+        freed = 0
+        for item in items:
+            expired = max_age is not None and now - item['last_used'] > max_age
+            over_quota = quota is not None and total > quota
+            if not expired and not over_quota:
+                # 按 LRU 排序，后面的条目更新，既没过期也不需要再腾空间
+                break
+            if self._remove(item):
+                total -= item['bytes']
+                freed += item['bytes']
+        return freed
+
+    def _evict_for_disk(self) -> int:
+        free = shutil.disk_usage(self.base_dir).free
+        if free >= self.min_free_mb * MB:
+            return 0
+
+        candidates = []
+        for name in self._ordered_categories():
+            if self.categories[name]['regenerable']:
+                candidates += sorted(self.scan(name), key=lambda item: item['last_used'])
+
+        freed = 0
+        for item in candidates:
+            if free + freed >= self.min_free_mb * MB:
+                break
+            if self._remove(item):
+                freed += item['bytes']
+        if free + freed < self.min_free_mb * MB:
+            logging.warning(f"磁盘剩余空间不足 {self.min_free_mb}MB，可再生的产物已清理完")
+        return freed
+
+    def _remove(self, item: Dict) -> bool:
+        if item['task_id'] and self.is_active_(item['task_id']):
+            return False
+        if time.time() - item['last_used'] < ACTIVE_GRACE_SECONDS:
+            return False
+        try:
+            if os.path.isdir(item['path']):
+                shutil.rmtree(item['path'])
+            else:
+                os.remove(item['path'])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"清理存储失败 ({item['path']}): {e}")
+            return False
+        with self.lock_:
+            self.access_.pop(os.path.normpath(item['path']), None)
+            scan = self.usage_.get(item['category'])
+            if scan and item in scan['items']:
+                scan['items'].remove(item)
+                scan['bytes'] -= item['bytes']
+        logging.info(f"清理存储 [{item['category']}]: {item['path']}（{item['bytes']} 字节）")
+        return True
+
+    def _list_items(self, category: str):
+        """返回 [(路径, task_id)]，task_id 用于判断条目所属任务是否仍在进行"""
+        temp_videos = os.path.join(self.base_dir, 'temp_videos')
+        audio_cache = os.path.join(self.base_dir, 'audio_cache')
+
+        if category == 'merged_videos':
+            for name in self._listdir(temp_videos):
+                if name.startswith('merged_') and name.endswith('.mp4'):
+                    task_id = name[len('merged_'):-len('.mp4')]
+                    if task_id.endswith('.partial'):
+                        task_id = task_id[:-len('.partial')]
+                    yield os.path.join(temp_videos, name), task_id
+        elif category == 'video_segments':
+            for name in self._listdir(temp_videos):
+                path = os.path.join(temp_videos, name)
+                if os.path.isdir(path):
+                    yield path, name
+        elif category == 'previews':
+            # 广场的预览短片；被清理后下次列出共享记录时重新生成
+            previews = os.path.join(self.base_dir, 'previews')
+            for name in self._listdir(previews):
+                if name.endswith('.mp4'):
+                    task_id = name[:-len('.mp4')]
+                    if task_id.endswith('.partial'):
+                        task_id = task_id[:-len('.partial')]
+                    yield os.path.join(previews, name), task_id
+        elif category == 'audio_cache':
+            for name in self._listdir(audio_cache):
+                path = os.path.join(audio_cache, name)
+                if name != 'shared' and os.path.isdir(path):
+                    yield path, name
+            # 共享缓存里的文件按内容寻址，会话目录里是硬链接，删掉不影响已生成的分镜；静音模板很小，保留
+            shared = os.path.join(audio_cache, 'shared')
+            for root, dirs, files in os.walk(shared):
+                dirs[:] = [d for d in dirs if not (root == shared and d == 'silence')]
+                for file in files:
+                    yield os.path.join(root, file), None
+        elif category == 'image_cache':
+            # 只管图片；prompt_index.jsonl 里的路径失效时复用前会检查文件是否存在
+            image_cache = os.path.join(self.base_dir, 'image_cache')
+            for name in self._listdir(image_cache):
+                if name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
+                    yield os.path.join(image_cache, name), None
+        elif category == 'uploads':
+            uploads = os.path.join(self.base_dir, 'uploads')
+            for name in self._listdir(uploads):
+                yield os.path.join(uploads, name), name.split('_', 1)[0]
+        elif category == 'session_outputs':
+            for name in self._listdir(self.base_dir):
+                path = os.path.join(self.base_dir, name)
+                if os.path.isdir(os.path.join(path, 'output_scenes')) or os.path.isdir(os.path.join(path, 'anime_output')):
+                    yield path, name
+        else:
+            raise ValueError(f"未知的存储类别: {category}")
+
+    def _measure(self, path: str):
+        """
+        返回 (可释放的字节数, 最新修改时间)。
+        字节数只统计删掉条目后真正释放的空间：还有硬链接留在条目外面的文件
+        （共享语音库和会话目录互相链接）不计入，条目内的多个硬链接只计一次
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return 0, 0
+        if not os.path.isdir(path):
+            return (stat.st_size if stat.st_nlink <= 1 else 0), stat.st_mtime
+
+        # 目录的最近使用时间取其中最新文件的修改时间；空目录取目录本身的
+        modified = 0
+        links = {}
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                try:
+                    file_stat = os.lstat(os.path.join(root, file))
+                except OSError:
+                    continue
+                modified = max(modified, file_stat.st_mtime)
+                inode = (file_stat.st_dev, file_stat.st_ino)
+                seen, nlink, file_size = links.get(inode, (0, file_stat.st_nlink, file_stat.st_size))
+                links[inode] = (seen + 1, nlink, file_size)
+        size = sum(file_size for seen, nlink, file_size in links.values() if seen >= nlink)
+        return size, modified or stat.st_mtime
+
+    def _listdir(self, path: str) -> List[str]:
+        try:
+            return os.listdir(path)
+        except OSError:
+            return []
+
+    def _ordered_categories(self) -> List[str]:
+        return sorted(self.categories, key=lambda name: self.categories[name]['priority'])
+
+    def _run(self):
+        names = self._ordered_categories()
+        index = 0
+        while not self.stop_event_.is_set():
+            try:
+                self.run_once(names[index % len(names)])
+            except Exception as e:
+                logging.exception(f"存储清理失败: {e}")
+            index += 1
+            self.stop_event_.wait(self.interval)
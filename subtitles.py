@@ -0,0 +1,59 @@
+from typing import List, Tuple, Optional
+
+from tts_generator import split_sentences
+
+
+# 每条字幕的最多字数；更长的句子按字数硬切
+SUBTITLE_MAX_CHARS = 30
+
+
+def build_cues(scenes: List[Tuple[str, float]], offset: float = 0.0) -> List[Tuple[float, float, str]]:
+    """
+    scenes: [(分镜文本, 分镜时长)]，按顺序排在时间轴上（从 offset 开始）。
+    每个分镜的文本按句切成若干条字幕，时长按字数比例分配，返回 [(开始, 结束, 文本)]
+    """
+    cues = []
+    start = offset
+    for text, duration in scenes:
+        chunks = []
+        for sentence in split_sentences(text or '', SUBTITLE_MAX_CHARS):
+            chunks += [sentence[i:i + SUBTITLE_MAX_CHARS] for i in range(0, len(sentence), SUBTITLE_MAX_CHARS)]
+        chunks = [chunk for chunk in chunks if chunk.strip()]
+
+        total_chars = sum(len(chunk) for chunk in chunks)
+        cursor = start
+        for i, chunk in enumerate(chunks):
+            end = start + duration if i == len(chunks) - 1 else cursor + duration * len(chunk) / total_chars
+            cues.append((cursor, end, chunk))
+            cursor = end
+        start += duration
+    return cues
+
+
+def format_srt(cues: List[Tuple[float, float, str]]) -> str:
+    lines = []
+    for i, (start, end, text) in enumerate(cues, 1):
+        lines += [str(i), f"{_timestamp(start, ',')} --> {_timestamp(end, ',')}", text, '']
+    return "\n".join(lines)
+
+
+def format_webvtt(cues: List[Tuple[float, float, str]], mpegts_start: Optional[int] = None) -> str:
+    """
+    mpegts_start：HLS 分片第一个采样的 PTS（90kHz），写入 X-TIMESTAMP-MAP，
+    让字幕时间 0 对齐该分片的开头
+    """
+    lines = ['WEBVTT']
+    if mpegts_start is not None:
+        lines.append(f"X-TIMESTAMP-MAP=MPEGTS:{mpegts_start},LOCAL:00:00:00.000")
+    lines.append('')
+    for start, end, text in cues:
+        lines += [f"{_timestamp(start, '.')} --> {_timestamp(end, '.')}", text, '']
+    return "\n".join(lines)
+
+
+def _timestamp(seconds: float, separator: str) -> str:
+    millis = int(round(max(0.0, seconds) * 1000))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}{separator}{millis:03d}"
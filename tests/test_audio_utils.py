@@ -0,0 +1,224 @@
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+from unittest.mock import patch
+import numpy as np
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from audio_utils import (strip_id3, parse_frame_header, iter_frames, concat_mp3, silent_frame, probe_mp3,
+                         transcode_audio, iter_adts_frames, SilenceProvider, split_mp3_on_silence)
+
+
+# MPEG2 Layer III, 32kbps, 24000Hz, 单声道（与 gTTS 输出一致），帧长 96 字节
+FRAME_HEADER = bytes([0xFF, 0xF3, 0x44, 0xC0])
+FRAME_LENGTH = 96
+
+
+def make_frames(count, fill=0):
+    return (FRAME_HEADER + bytes([fill]) * (FRAME_LENGTH - 4)) * count
+
+
+def make_id3(payload_size=20):
+    size = bytes([0, 0, 0, payload_size])
+    return b'ID3' + bytes([4, 0, 0]) + size + b'\x00' * payload_size
+
+
+class TestAudioUtils(unittest.TestCase):
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+    
+    def _write(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+    
+    def test_parse_frame_header(self):
+        header = parse_frame_header(FRAME_HEADER)
+        
+        self.assertEqual(header['version'], 2)
+        self.assertEqual(header['layer'], 3)
+        self.assertEqual(header['bitrate'], 32000)
+        self.assertEqual(header['sample_rate'], 24000)
+        self.assertEqual(header['channels'], 1)
+        self.assertEqual(header['samples'], 576)
+        self.assertEqual(header['length'], FRAME_LENGTH)
+    
+    def test_parse_invalid_header(self):
+        self.assertIsNone(parse_frame_header(b'\x00\x00\x00\x00'))
+        self.assertIsNone(parse_frame_header(bytes([0xFF, 0xF3, 0xF4, 0xC0])))
+    
+    def test_strip_id3(self):
+        data = make_id3() + make_frames(2) + b'TAG' + b'\x00' * 125
+        
+        self.assertEqual(strip_id3(data), make_frames(2))
+    
+    def test_iter_frames_resyncs_after_garbage(self):
+        data = make_frames(2) + b'\x12\x34\x56' + make_frames(3)
+        
+        offsets = [offset for offset, _ in iter_frames(data)]
+        
+        self.assertEqual(len(offsets), 5)
+        self.assertEqual(offsets[2], 2 * FRAME_LENGTH + 3)
+    
+    def test_concat_mp3(self):
+        first = self._write('a.mp3', make_id3() + make_frames(3, fill=1))
+        second = self._write('b.mp3', make_id3() + make_frames(2, fill=2))
+        output = os.path.join(self.temp_dir, 'out.mp3')
+        
+        result = concat_mp3([first, second], output)
+        
+        self.assertEqual(result, output)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), make_frames(3, fill=1) + make_frames(2, fill=2))
+    
+    def test_concat_mp3_rejects_non_mp3(self):
+        first = self._write('a.mp3', make_frames(3))
+        second = self._write('b.mp3', b'not an mp3 file')
+        
+        self.assertIsNone(concat_mp3([first, second], os.path.join(self.temp_dir, 'out.mp3')))
+
+    
+    def test_silent_frame_matches_format(self):
+        padded = bytes([0xFF, 0xF2, 0x46, 0xC0])
+        frame = silent_frame(parse_frame_header(padded))
+        header = parse_frame_header(frame)
+        
+        self.assertEqual(len(frame), FRAME_LENGTH)
+        self.assertFalse(header['protected'])
+        self.assertEqual(header['padding'], 0)
+        self.assertEqual(header['sample_rate'], 24000)
+        self.assertEqual(frame[4:], bytes(FRAME_LENGTH - 4))
+    
+    def test_concat_mp3_with_gap(self):
+        first = self._write('a.mp3', make_frames(3, fill=1))
+        second = self._write('b.mp3', make_frames(2, fill=2))
+        output = os.path.join(self.temp_dir, 'out.mp3')
+        
+        concat_mp3([first, second], output, gap=0.5)
+        
+        with open(output, 'rb') as f:
+            frames = list(iter_frames(f.read()))
+        # 0.5 秒 * 24000Hz / 576 = 20.8，向上取整 21 帧
+        self.assertEqual(len(frames), 3 + 21 + 2 + 21)
+    
+    def test_concat_mp3_rejects_mixed_formats(self):
+        first = self._write('a.mp3', make_frames(3))
+        # MPEG1 Layer III 44100Hz 128kbps 立体声，帧长 417 字节
+        second = self._write('b.mp3', (bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413)) * 3)
+        
+        self.assertIsNone(concat_mp3([first, second], os.path.join(self.temp_dir, 'out.mp3')))
+
+    
+    def test_probe_mp3(self):
+        path = self._write('a.mp3', make_id3() + make_frames(250))
+        
+        info = probe_mp3(path)
+        
+        # 250 帧 * 576 采样 / 24000Hz = 6 秒
+        self.assertEqual(info['duration'], 6.0)
+        self.assertEqual(info['sample_rate'], 24000)
+        self.assertEqual(info['channels'], 1)
+        self.assertEqual(info['bitrate'], 32000)
+        self.assertEqual(info['frames'], 250)
+    
+    def test_probe_mp3_invalid(self):
+        self.assertIsNone(probe_mp3(os.path.join(self.temp_dir, 'missing.mp3')))
+        self.assertIsNone(probe_mp3(self._write('bad.mp3', b'not an mp3 file')))
+
+    
+    @patch('audio_utils.subprocess.run')
+    def test_transcode_audio(self, mock_run):
+        source = self._write('a.mp3', make_frames(10))
+        output = os.path.join(self.temp_dir, 'a.ogg')
+        mock_run.side_effect = lambda args, **kwargs: open(args[-1], 'wb').write(b'OggS')
+        
+        result = transcode_audio(source, output, 'opus')
+        
+        args = mock_run.call_args[0][0]
+        self.assertEqual(result, output)
+        self.assertIn('libopus', args)
+        self.assertEqual(args[args.index('-f') + 1], 'ogg')
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), b'OggS')
+    
+    @patch('audio_utils.subprocess.run')
+    def test_transcode_audio_failure(self, mock_run):
+        mock_run.side_effect = Exception("ffmpeg error")
+        
+        self.assertIsNone(transcode_audio(self._write('a.mp3', make_frames(10)),
+                                          os.path.join(self.temp_dir, 'a.m4a'), 'aac'))
+        self.assertEqual(os.listdir(self.temp_dir), ['a.mp3'])
+
+    
+    def test_silence_provider_mp3(self):
+        provider = SilenceProvider(os.path.join(self.temp_dir, 'silence'))
+        
+        path = provider.mp3(1.5)
+        
+        self.assertEqual(path, provider.mp3(1.5))
+        info = probe_mp3(path)
+        self.assertAlmostEqual(info['duration'], 1.5, delta=0.03)
+        self.assertEqual(info['sample_rate'], 24000)
+    
+    def test_silence_provider_aac_repeats_template_frame(self):
+        provider = SilenceProvider(os.path.join(self.temp_dir, 'silence'))
+        # ADTS 帧头：AAC LC, 24000Hz, 单声道, 帧长 16 字节
+        adts_frame = bytes([0xFF, 0xF1, 0x58, 0x40, 0x02, 0x1F, 0xFC]) + bytes(9)
+        provider.aac_frames_[(24000, 1)] = adts_frame
+        
+        path = provider.aac(1.0)
+        
+        with open(path, 'rb') as f:
+            data = f.read()
+        # 1 秒 * 24000Hz / 1024 = 23.4，向上取整 24 帧
+        self.assertEqual(len(list(iter_adts_frames(data))), 24)
+        self.assertEqual(data, adts_frame * 24)
+
+    
+    def _pcm(self, pattern):
+        """pattern 中每个字符对应一帧（576 个采样）：'#' 为有声，'.' 为静音"""
+        return np.concatenate([np.full(576, 5000 if c == '#' else 0, dtype=np.int16) for c in pattern])
+    
+    @patch('audio_utils.decode_pcm')
+    def test_split_mp3_on_silence(self, mock_decode):
+        pattern = '#' * 10 + '.' * 3 + '#' * 5 + '.' * 12 + '#' * 6 + '.' * 10 + '#' * 4
+        path = self._write('batch.mp3', b''.join(bytes([0xFF, 0xF3, 0x44, 0xC0]) + bytes([i]) * 92
+                                                 for i in range(len(pattern))))
+        mock_decode.return_value = self._pcm(pattern)
+        
+        pieces = split_mp3_on_silence(path, 3)
+        
+        # 最短的 3 帧停顿不切；切点在 12 帧和 10 帧静音段的中间
+        self.assertEqual([len(piece) // FRAME_LENGTH for piece in pieces], [24, 17, 9])
+        self.assertEqual(b''.join(pieces), open(path, 'rb').read())
+    
+    @patch('audio_utils.decode_pcm')
+    def test_split_mp3_on_silence_not_enough_pauses(self, mock_decode):
+        pattern = '#' * 10 + '.' * 12 + '#' * 10
+        path = self._write('batch.mp3', make_frames(len(pattern)))
+        mock_decode.return_value = self._pcm(pattern)
+        
+        self.assertIsNone(split_mp3_on_silence(path, 3))
+    
+    @patch('audio_utils.decode_pcm')
+    def test_split_mp3_on_silence_checks_weights(self, mock_decode):
+        # 第一段文本内部的停顿（12 帧）比段间停顿（6 帧）还长：按最长静音切会把第一段切成两半
+        pattern = '#' * 10 + '.' * 12 + '#' * 6 + '.' * 6 + '#' * 6
+        path = self._write('batch.mp3', make_frames(len(pattern)))
+        mock_decode.return_value = self._pcm(pattern)
+        
+        self.assertIsNone(split_mp3_on_silence(path, 2, weights=[8, 3]))
+        pieces = split_mp3_on_silence(path, 2, weights=[5, 6])
+        self.assertEqual([len(piece) // FRAME_LENGTH for piece in pieces], [16, 24])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+from unittest.mock import patch
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from PIL import Image
+
+from image_compositor import ImageCompositor
+
+
+class TestImageCompositor(unittest.TestCase):
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.compositor = ImageCompositor()
+        self.compositor.cache_dir = self.temp_dir
+    
+    def tearDown(self):
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+    
+    def _make_image(self, name, subject_box=None):
+        img = Image.new('RGB', (640, 360), (40, 40, 40))
+        if subject_box:
+            img.paste((250, 220, 30), subject_box)
+        path = os.path.join(self.temp_dir, name)
+        img.save(path)
+        return path
+    
+    def test_derive_shot_keeps_size(self):
+        source = self._make_image('wide.png', (500, 40, 600, 140))
+        
+        derived = self.compositor.derive_shot(source, 0.5)
+        
+        self.assertIsNotNone(derived)
+        with Image.open(derived) as img:
+            self.assertEqual(img.size, (640, 360))
+    
+    def test_derive_shot_follows_salient_region(self):
+        source = self._make_image('wide.png', (500, 40, 600, 140))
+        
+        with Image.open(source) as img:
+            left, top, right, bottom = self.compositor._crop_box(img.convert('RGB'), 0.4, 'saliency')
+        
+        self.assertLessEqual(left, 500)
+        self.assertGreaterEqual(right, 600)
+        self.assertLessEqual(top, 40)
+        self.assertGreaterEqual(bottom, 140)
+    
+    def test_center_crop_box(self):
+        source = self._make_image('wide.png')
+        
+        with Image.open(source) as img:
+            box = self.compositor._crop_box(img.convert('RGB'), 0.5, 'center')
+        
+        self.assertEqual(box, (160, 90, 480, 270))
+    
+    def test_derive_shot_cached(self):
+        source = self._make_image('wide.png', (100, 100, 200, 200))
+        
+        first = self.compositor.derive_shot(source, 0.35)
+        with patch('image_compositor.Image.open') as mock_open:
+            second = self.compositor.derive_shot(source, 0.35)
+        
+        self.assertEqual(first, second)
+        mock_open.assert_not_called()
+    
+    def test_derive_shot_missing_source(self):
+        self.assertIsNone(self.compositor.derive_shot(os.path.join(self.temp_dir, 'none.png'), 0.5))
+
+    def _make_portrait(self, name, background=(255, 255, 255)):
+        img = Image.new('RGB', (200, 200), background)
+        img.paste((200, 30, 30), (70, 20, 130, 190))
+        path = os.path.join(self.temp_dir, name)
+        img.save(path)
+        return path
+    
+    def test_composite_characters_on_background(self):
+        background = self._make_image('bg.png')
+        portrait = self._make_portrait('char.png')
+        
+        result = self.compositor.composite_characters(background, [portrait], '中景')
+        
+        self.assertIsNotNone(result)
+        with Image.open(result) as img:
+            self.assertEqual(img.size, (640, 360))
+            self.assertEqual(img.getpixel((320, 200))[:3], (200, 30, 30))
+            self.assertEqual(img.getpixel((20, 20))[:3], (40, 40, 40))
+    
+    def test_composite_rejects_too_many_characters(self):
+        background = self._make_image('bg.png')
+        portraits = [self._make_portrait(f'c{i}.png') for i in range(2)]
+        
+        self.assertIsNone(self.compositor.composite_characters(background, portraits, '特写'))
+    
+    def test_composite_rejects_busy_portrait_background(self):
+        background = self._make_image('bg.png')
+        busy = Image.effect_noise((200, 200), 100).convert('RGB')
+        portrait = os.path.join(self.temp_dir, 'busy.png')
+        busy.save(portrait)
+        
+        self.assertIsNone(self.compositor.composite_characters(background, [portrait], '中景'))
+
+
+if __name__ == '__main__':
+    unittest.main()
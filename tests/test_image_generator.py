@@ -113,7 +113,7 @@ class TestImageGenerator(unittest.TestCase):
         self.assertIn('黑发男子', call_args[1]['prompt'])
         self.assertIn('长发女子', call_args[1]['prompt'])
     
-    @patch('image_generator.ImageFont')
+    @patch('fonts.ImageFont')
     @patch('image_generator.ImageDraw')
     @patch('image_generator.Image')
     def test_create_text_overlay_success(self, mock_image_cls, mock_draw_cls, mock_font):
@@ -171,6 +171,287 @@ class TestImageGenerator(unittest.TestCase):
             self.assertIsInstance(lines, list)
             self.assertGreater(len(lines), 0)
 
+    def test_wrap_text_measures_each_glyph_once(self):
+        generator = ImageGenerator(self.api_key)
+        
+        mock_font = MagicMock()
+        mock_font.getlength.return_value = 10
+        
+        lines = generator._wrap_text("一二一二一二一二", mock_font, 30)
+        
+        self.assertEqual(lines, ["一二一", "二一二", "一二"])
+        self.assertEqual(mock_font.getlength.call_count, 2)
+    
+    def test_wrap_text_breaks_on_newline(self):
+        generator = ImageGenerator(self.api_key)
+        
+        mock_font = MagicMock()
+        mock_font.getlength.return_value = 10
+        
+        lines = generator._wrap_text("旁白\n张三：你好", mock_font, 1000)
+        
+        self.assertEqual(lines, ["旁白", "张三：你好"])
+    
+    @patch('fonts._RESOLVED_FONTS', {})
+    @patch('fonts._FONT_CACHE', {})
+    @patch('fonts.ImageFont')
+    def test_load_chinese_font_cached(self, mock_font):
+        mock_font.truetype.return_value = MagicMock()
+        generator = ImageGenerator(self.api_key)
+        
+        font1 = generator._load_chinese_font(40)
+        font2 = generator._load_chinese_font(40)
+        
+        self.assertIs(font1, font2)
+        mock_font.truetype.assert_called_once()
+    
+    def test_create_text_overlays_batch(self):
+        import tempfile
+        import shutil
+        from PIL import Image as PILImage
+        
+        temp_dir = tempfile.mkdtemp()
+        try:
+            overlays = []
+            for i in range(3):
+                image_path = os.path.join(temp_dir, f"in_{i}.png")
+                PILImage.new('RGB', (400, 300), (200, 100, 50)).save(image_path)
+                overlays.append({
+                    'image_path': image_path,
+                    'text': f"第{i}段字幕",
+                    'output_path': os.path.join(temp_dir, f"out_{i}.png")
+                })
+            overlays.append({
+                'image_path': os.path.join(temp_dir, "missing.png"),
+                'text': "缺失",
+                'output_path': os.path.join(temp_dir, "out_missing.png")
+            })
+            
+            generator = ImageGenerator(self.api_key)
+            results = generator.create_text_overlays(overlays)
+            
+            self.assertEqual(results, [True, True, True, False])
+            with PILImage.open(overlays[0]['output_path']) as out:
+                self.assertEqual(out.size, (400, 300))
+                self.assertEqual(out.mode, 'RGB')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @patch('image_generator.OpenAI')
+    def test_generate_scene_grid_slices_cells(self, mock_openai):
+        import base64
+        import tempfile
+        import shutil
+        from io import BytesIO
+        from PIL import Image as PILImage
+        
+        grid = PILImage.new('RGB', (1792, 1024))
+        for i, color in enumerate([(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)]):
+            row, col = divmod(i, 2)
+            grid.paste(color, (col * 896, row * 512, (col + 1) * 896, (row + 1) * 512))
+        buffer = BytesIO()
+        grid.save(buffer, format='PNG')
+        
+        mock_client = MagicMock()
+        mock_openai.return_value = mock_client
+        mock_response = MagicMock()
+        mock_response.data = [MagicMock(b64_json=base64.b64encode(buffer.getvalue()).decode())]
+        mock_client.images.generate.return_value = mock_response
+        
+        temp_dir = tempfile.mkdtemp()
+        try:
+            generator = ImageGenerator(self.api_key, provider='qiniu')
+            generator.cache_dir = temp_dir
+            
+            cells = generator.generate_scene_grid(["教室", "走廊", "操场"], layout='2x2')
+            
+            mock_client.images.generate.assert_called_once()
+            self.assertIn('panel 3: 操场', mock_client.images.generate.call_args[1]['prompt'])
+            self.assertEqual([c['grid_cell'] for c in cells], [0, 1, 2])
+            self.assertEqual(len({c['grid_id'] for c in cells}), 1)
+            with PILImage.open(cells[2]['image_path']) as cell:
+                self.assertEqual(cell.size, (1792, 1024))
+                self.assertEqual(cell.getpixel((896, 512)), (0, 0, 255))
+            
+            cached = generator.generate_scene_grid(["教室", "走廊", "操场"], layout='2x2')
+            self.assertEqual(cached, cells)
+            mock_client.images.generate.assert_called_once()
+        finally:
+            shutil.rmtree(temp_dir)
+    
+    @patch('image_generator.OpenAI')
+    def test_generate_scene_grid_rejects_overflow(self, mock_openai):
+        generator = ImageGenerator(self.api_key)
+        
+        with self.assertRaises(ValueError):
+            generator.generate_scene_grid(["a", "b", "c", "d"], layout='1x3')
+
+    @patch('image_generator.Image')
+    @patch('image_generator.OpenAI')
+    def test_generate_scene_image_reuses_near_duplicate(self, mock_openai, mock_image):
+        import tempfile
+        import shutil
+        
+        mock_client = MagicMock()
+        mock_openai.return_value = mock_client
+        mock_response = MagicMock()
+        mock_response.data = [MagicMock(b64_json='dGVzdGltYWdl')]
+        mock_client.images.generate.return_value = mock_response
+        mock_image.open.return_value.save.side_effect = lambda path: open(path, 'wb').close()
+        
+        temp_dir = tempfile.mkdtemp()
+        try:
+            generator = ImageGenerator(self.api_key, provider='qiniu', dedup_threshold=0.6)
+            generator.cache_dir = temp_dir
+            
+            first = generator.generate_scene_image("镜头类型: 中景, 张三站在教室窗边看着远处的操场, 场景: 教室, 平静的氛围")
+            second = generator.generate_scene_image("镜头类型: 中景, 张三站在教室窗边望着远处的操场, 场景: 教室, 平静的氛围")
+            third = generator.generate_scene_image("镜头类型: 远景, 夜晚的城市街道下着大雨, 霓虹灯闪烁")
+            
+            self.assertEqual(first, second)
+            self.assertNotEqual(first, third)
+            self.assertEqual(mock_client.images.generate.call_count, 2)
+            self.assertEqual(generator.dedup_hits_, 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @patch('image_generator.OpenAI')
+    def test_concurrent_similar_scenes_request_once(self, mock_openai):
+        import tempfile
+        import shutil
+        import threading
+        import time
+        import prompt_index
+        
+        mock_client = MagicMock()
+        mock_client.images.generate.side_effect = self._png_response(delay=0.2)
+        mock_openai.return_value = mock_client
+        prompts = [f"镜头类型: 中景, 张三站在教室窗边{verb}远处的操场, 场景: 教室, 平静的氛围"
+                   for verb in ("看着", "望着", "看向", "望向")]
+        
+        # 计算签名时让出时间片，放大“查找”和“登记”之间的并发窗口
+        signature = prompt_index.minhash_signature
+        
+        def slow_signature(tokens):
+            time.sleep(0.05)
+            return signature(tokens)
+        
+        temp_dir = tempfile.mkdtemp()
+        try:
+            generator = ImageGenerator(self.api_key, provider='qiniu', dedup_threshold=0.5)
+            generator.cache_dir = temp_dir
+            barrier = threading.Barrier(len(prompts))
+            results = [None] * len(prompts)
+            
+            def run(i):
+                barrier.wait()
+                results[i] = generator.generate_scene_image(prompts[i])
+            
+            threads = [threading.Thread(target=run, args=(i,)) for i in range(len(prompts))]
+            with patch('prompt_index.minhash_signature', slow_signature):
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            
+            self.assertEqual(mock_client.images.generate.call_count, 1)
+            self.assertEqual(len(set(results)), 1)
+            self.assertIsNotNone(results[0])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def _png_response(self, delay=0, color=(0, 0, 0)):
+        import base64
+        import time
+        from io import BytesIO
+        from PIL import Image as PILImage
+        
+        buffer = BytesIO()
+        PILImage.new('RGB', (8, 8), color).save(buffer, format='PNG')
+        b64 = base64.b64encode(buffer.getvalue()).decode()
+        
+        def _generate(**kwargs):
+            time.sleep(delay)
+            return MagicMock(data=[MagicMock(b64_json=b64)])
+        return _generate
+    
+    @patch('image_generator.OpenAI')
+    def test_hedged_request_secondary_wins(self, mock_openai):
+        primary = MagicMock()
+        primary.images.generate.side_effect = self._png_response(delay=0.5, color=(255, 0, 0))
+        secondary = MagicMock()
+        secondary.images.generate.side_effect = self._png_response(delay=0, color=(0, 0, 255))
+        mock_openai.side_effect = [primary, secondary]
+        
+        generator = ImageGenerator(self.api_key, provider='qiniu',
+                                   hedge_policy={'provider': 'qiniu', 'initial_delay': 0.05,
+                                                 'base_url': 'http://127.0.0.1:9/v1', 'api_key': 'hedge_key'})
+        img = generator._request_image("prompt", "1024x1024")
+        
+        self.assertEqual(img.convert('RGB').getpixel((0, 0)), (0, 0, 255))
+        self.assertEqual(mock_openai.call_args_list[1][1]['base_url'], 'http://127.0.0.1:9/v1')
+        self.assertEqual(mock_openai.call_args_list[1][1]['api_key'], 'hedge_key')
+        stats = generator.get_hedge_stats()
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['hedged'], 1)
+        self.assertEqual(stats['hedge_wins'], 1)
+        self.assertEqual(stats['hedge_rate'], 1.0)
+        
+        generator.hedge_executor_.shutdown(wait=True)
+        self.assertGreater(generator.get_hedge_stats()['latency_saved'], 0.3)
+    
+    @patch('image_generator.OpenAI')
+    def test_hedged_request_fast_primary_not_hedged(self, mock_openai):
+        primary = MagicMock()
+        primary.images.generate.side_effect = self._png_response()
+        secondary = MagicMock()
+        mock_openai.side_effect = [primary, secondary]
+        
+        generator = ImageGenerator(self.api_key, provider='qiniu',
+                                   hedge_policy={'initial_delay': 5, 'api_key': 'hedge_key'})
+        generator._request_image("prompt", "1024x1024")
+        
+        secondary.images.generate.assert_not_called()
+        self.assertEqual(generator.get_hedge_stats()['hedged'], 0)
+    
+    @patch('image_generator.OpenAI')
+    def test_hedge_delay_uses_latency_percentile(self, mock_openai):
+        generator = ImageGenerator(self.api_key, hedge_policy={'provider': 'qiniu', 'min_samples': 5, 'percentile': 0.9})
+        generator.primary_latencies_.extend([1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0])
+        
+        # nearest-rank P90：10 个样本取第 9 小的，而不是最大值
+        self.assertEqual(generator._hedge_delay(), 9.0)
+        generator.hedge_policy['percentile'] = 0.5
+        self.assertEqual(generator._hedge_delay(), 5.0)
+        generator.hedge_policy['percentile'] = 1.0
+        self.assertEqual(generator._hedge_delay(), 10.0)
+    
+    @patch('image_generator.OpenAI')
+    def test_hedge_api_key_not_sent_to_other_provider(self, mock_openai):
+        generator = ImageGenerator(self.api_key, provider='qiniu', hedge_policy={'provider': 'openai'})
+        
+        self.assertIsNone(generator.hedge_policy)
+        self.assertIsNone(generator.hedge_executor_)
+        mock_openai.assert_called_once()
+        
+        mock_openai.reset_mock()
+        generator = ImageGenerator(self.api_key, provider='qiniu', hedge_policy={'provider': 'qiniu', 'model': 'backup'})
+        
+        self.assertIsNotNone(generator.hedge_policy)
+        self.assertEqual(mock_openai.call_args_list[1][1]['api_key'], self.api_key)
+        self.assertEqual(mock_openai.call_args_list[1][1]['base_url'], 'https://openai.qiniu.com/v1')
+        generator.close()
+    
+    @patch('image_generator.OpenAI')
+    def test_hedge_pool_sized_from_concurrency(self, mock_openai):
+        generator = ImageGenerator(self.api_key, provider='qiniu', max_concurrency=3,
+                                   hedge_policy={'provider': 'qiniu'})
+        
+        self.assertEqual(generator.hedge_executor_._max_workers, 6)
+        generator.close()
+        with self.assertRaises(RuntimeError):
+            generator.hedge_executor_.submit(lambda: None)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import sys
+import os
+import time
+import base64
+import tempfile
+import shutil
+from io import BytesIO
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from PIL import Image
+
+from local_image_provider import LocalImageClient, LocalImageError, render_placeholder
+from image_generator import ImageGenerator
+
+
+class TestLocalImageProvider(unittest.TestCase):
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+    
+    def _decode(self, response):
+        return Image.open(BytesIO(base64.b64decode(response.data[0].b64_json)))
+    
+    def test_generate_is_deterministic(self):
+        client = LocalImageClient(latency=0, failure_rate=0)
+        
+        first = client.images.generate(prompt="雨夜的小巷", size="256x128")
+        second = client.images.generate(prompt="雨夜的小巷", size="256x128")
+        other = client.images.generate(prompt="阳光下的操场", size="256x128")
+        
+        self.assertEqual(first.data[0].b64_json, second.data[0].b64_json)
+        self.assertNotEqual(first.data[0].b64_json, other.data[0].b64_json)
+        self.assertEqual(self._decode(first).size, (256, 128))
+    
+    def test_render_placeholder_size(self):
+        img = render_placeholder("测试", 320, 180)
+        
+        self.assertEqual(img.size, (320, 180))
+    
+    def test_failure_rate(self):
+        client = LocalImageClient(latency=0, failure_rate=1.0)
+        
+        with self.assertRaises(LocalImageError):
+            client.images.generate(prompt="测试", size="64x64")
+    
+    def test_latency(self):
+        client = LocalImageClient(latency=0.05, failure_rate=0)
+        
+        start = time.time()
+        client.images.generate(prompt="测试", size="64x64")
+        
+        self.assertGreaterEqual(time.time() - start, 0.05)
+    
+    def test_image_generator_local_provider(self):
+        generator = ImageGenerator(None, provider='local')
+        generator.cache_dir = self.temp_dir
+        
+        image_path = generator.generate_scene_image("雨夜的小巷，路灯昏黄")
+        
+        self.assertIsNotNone(image_path)
+        self.assertTrue(image_path.startswith(self.temp_dir))
+        with Image.open(image_path) as img:
+            self.assertEqual(img.size, (1792, 1024))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+import sys
+import os
+import tempfile
+import json
+import shutil
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from prompt_index import PromptSimilarityIndex, tokenize_prompt
+from unittest.mock import patch
+
+
+BASE_PROMPT = "镜头类型: 中景, 张三站在教室窗边看着远处的操场, 场景: 教室, 平静, 宁和的氛围, 漫画分镜风格, 动漫风格, 高质量, 细节丰富"
+NEAR_PROMPT = "镜头类型: 中景, 张三站在教室窗边望着远处的操场, 场景: 教室, 平静, 宁和的氛围, 漫画分镜风格, 动漫风格, 高质量, 细节丰富"
+OTHER_PROMPT = "镜头类型: 远景, 夜晚的城市街道下着大雨, 霓虹灯闪烁, 紧张, 戏剧性的氛围"
+
+
+class TestPromptSimilarityIndex(unittest.TestCase):
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+    
+    def test_tokenize_prompt_drops_punctuation(self):
+        tokens = tokenize_prompt("教室, 窗边。")
+        
+        self.assertNotIn(',', tokens)
+        self.assertNotIn('。', tokens)
+        self.assertIn('教室', tokens)
+    
+    def test_find_near_duplicate(self):
+        index = PromptSimilarityIndex()
+        index.add(BASE_PROMPT, 'ns', '/cache/scene_a.png')
+        
+        match = index.find(NEAR_PROMPT, 'ns', 0.7)
+        
+        self.assertIsNotNone(match)
+        self.assertEqual(match[0], '/cache/scene_a.png')
+        self.assertGreaterEqual(match[1], 0.7)
+    
+    def test_find_respects_threshold_and_namespace(self):
+        index = PromptSimilarityIndex()
+        index.add(BASE_PROMPT, 'ns', '/cache/scene_a.png')
+        
+        self.assertIsNone(index.find(OTHER_PROMPT, 'ns', 0.5))
+        self.assertIsNone(index.find(NEAR_PROMPT, 'other_ns', 0.5))
+        self.assertIsNone(index.find(NEAR_PROMPT, 'ns', 1.01))
+    
+    def test_update_replaces_pending_value(self):
+        index = PromptSimilarityIndex()
+        entry_id = index.add(BASE_PROMPT, 'ns', 'pending')
+        index.update(entry_id, None)
+        
+        self.assertIsNone(index.find(NEAR_PROMPT, 'ns', 0.5))
+    
+    def test_find_or_add_inserts_once(self):
+        index = PromptSimilarityIndex()
+        
+        match, entry_id = index.find_or_add(BASE_PROMPT, 'ns', 0.7, 'pending')
+        self.assertIsNone(match)
+        self.assertIsNotNone(entry_id)
+        
+        match, entry_id = index.find_or_add(NEAR_PROMPT, 'ns', 0.7, 'other')
+        self.assertEqual(match[0], 'pending')
+        self.assertIsNone(entry_id)
+        self.assertIsNone(index.find(BASE_PROMPT, 'ns', 0.7))
+    
+    def test_persisted_index_reloads(self):
+        path = os.path.join(self.temp_dir, 'prompt_index.jsonl')
+        index = PromptSimilarityIndex(persist_path=path)
+        index.add(BASE_PROMPT, 'ns', '/cache/scene_a.png')
+        index.add(BASE_PROMPT, 'ns', '/cache/scene_a.png')
+        
+        reloaded = PromptSimilarityIndex(persist_path=path)
+        
+        self.assertEqual(reloaded.find(NEAR_PROMPT, 'ns', 0.7)[0], '/cache/scene_a.png')
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), 1)
+    
+    def test_index_capped_and_compacted_on_load(self):
+        path = os.path.join(self.temp_dir, 'prompt_index.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            for i in range(5):
+                f.write(json.dumps({'prompt': f"{OTHER_PROMPT} 第{i}幕", 'namespace': 'ns', 'path': f'/cache/{i}.png'},
+                                   ensure_ascii=False) + "\n")
+            f.write('{"prompt": "写到一半')
+        
+        index = PromptSimilarityIndex(persist_path=path, max_entries=3)
+        index.add(BASE_PROMPT, 'ns', '/cache/base.png')
+        
+        self.assertEqual(len(index.entries_), 3)
+        self.assertIsNone(index.find(f"{OTHER_PROMPT} 第0幕x", 'ns', 0.9))
+        with open(path, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r['path'] for r in records], ['/cache/2.png', '/cache/3.png', '/cache/4.png', '/cache/base.png'])
+        
+        # 重写后的记录带签名，再次加载不需要重新分词
+        with patch('prompt_index.tokenize_prompt', wraps=tokenize_prompt) as mock_tokenize:
+            reloaded = PromptSimilarityIndex(persist_path=path, max_entries=3)
+            self.assertEqual(reloaded.find(NEAR_PROMPT, 'ns', 0.7)[0], '/cache/base.png')
+        mock_tokenize.assert_called_once_with(NEAR_PROMPT)
+        self.assertEqual([entry['value'] for entry in reloaded.entries_.values()],
+                         ['/cache/3.png', '/cache/4.png', '/cache/base.png'])
+    
+    def test_pending_entries_survive_eviction(self):
+        index = PromptSimilarityIndex(max_entries=1)
+        pending = object()
+        entry_id = index.add(BASE_PROMPT, 'ns', pending)
+        index.add(OTHER_PROMPT, 'ns', '/cache/other.png')
+        index.update(entry_id, '/cache/base.png')
+        
+        self.assertEqual(index.find(NEAR_PROMPT, 'ns', 0.7)[0], '/cache/base.png')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -201,6 +201,165 @@ class TestSceneComposer(unittest.TestCase):
         self.assertEqual(result['shot_type'], '特写')
         self.assertEqual(result['mood'], 'happy')
 
+    @patch('scene_composer.os.makedirs')
+    @patch('scene_composer.shutil.copy')
+    @patch.object(SceneComposer, '_save_metadata')
+    def test_storyboard_grid_mode_shares_one_request(self, mock_save, mock_copy, mock_makedirs):
+        panels = [
+            {'shot_type': '远景', 'visual_description': '教室全景', 'characters': [], 'location': '教室'},
+            {'shot_type': '中景', 'visual_description': '张三坐下', 'characters': [], 'location': '教室'},
+            {'shot_type': '特写', 'visual_description': '窗外', 'characters': [], 'location': '教室'},
+        ]
+        self.mock_char_mgr.get_character.return_value = None
+        self.mock_image_gen.generate_scene_grid.return_value = [
+            {'image_path': f'/cache/grid_g_{i}.png', 'grid_id': 'g', 'grid_layout': '1x3',
+             'grid_cell': i, 'grid_image': '/cache/grid_g.png'}
+            for i in range(3)
+        ]
+        self.mock_tts_gen.generate_speech_for_scene.return_value = None
+        
+        composer = SceneComposer(
+            self.mock_image_gen,
+            self.mock_tts_gen,
+            self.mock_char_mgr,
+            grid_layout='1x3'
+        )
+        composer.plan_storyboard(panels, {})
+        results = [composer.create_scene_from_storyboard(i, panel, {}) for i, panel in enumerate(panels)]
+        
+        self.mock_image_gen.generate_scene_grid.assert_called_once()
+        self.mock_image_gen.generate_scene_image.assert_not_called()
+        self.assertEqual(results[2]['image_source']['grid_cell'], 2)
+        self.assertEqual(results[0]['image_source']['grid_scenes'], [0, 1, 2])
+
+    @patch('scene_composer.os.makedirs')
+    @patch('scene_composer.shutil.copy')
+    @patch.object(SceneComposer, '_save_metadata')
+    def test_plan_storyboard_resets_shared_images(self, mock_save, mock_copy, mock_makedirs):
+        panels = [
+            {'shot_type': '远景', 'visual_description': '教室全景', 'characters': [], 'location': '教室'},
+            {'shot_type': '中景', 'visual_description': '张三坐下', 'characters': [], 'location': '教室'},
+            {'shot_type': '特写', 'visual_description': '窗外', 'characters': [], 'location': '教室'},
+        ]
+        self.mock_char_mgr.get_character.return_value = None
+        self.mock_image_gen.generate_scene_grid.side_effect = lambda descriptions, **kwargs: [
+            {'image_path': f'/cache/grid_g_{i}.png', 'grid_id': 'g', 'grid_layout': '1x3',
+             'grid_cell': i, 'grid_image': '/cache/grid_g.png'}
+            for i in range(len(descriptions))
+        ]
+        self.mock_tts_gen.generate_speech_for_scene.return_value = None
+        
+        composer = SceneComposer(
+            self.mock_image_gen,
+            self.mock_tts_gen,
+            self.mock_char_mgr,
+            grid_layout='1x3'
+        )
+        for _ in range(2):
+            composer.plan_storyboard(panels, {})
+            for i, panel in enumerate(panels):
+                composer.create_scene_from_storyboard(i, panel, {})
+        
+        self.assertEqual(self.mock_image_gen.generate_scene_grid.call_count, 2)
+
+    @patch('scene_composer.os.makedirs')
+    @patch('scene_composer.shutil.copy')
+    @patch.object(SceneComposer, '_save_metadata')
+    def test_storyboard_derives_closer_shots_from_establishing(self, mock_save, mock_copy, mock_makedirs):
+        panels = [
+            {'shot_type': '远景', 'visual_description': '教室全景', 'characters': ['张三'], 'location': '教室'},
+            {'shot_type': '中景', 'visual_description': '张三坐下', 'characters': ['张三'], 'location': '教室'},
+            {'shot_type': '特写', 'visual_description': '张三微笑', 'characters': ['张三'], 'location': '教室'},
+            {'shot_type': '特写', 'visual_description': '李四', 'characters': ['李四'], 'location': '走廊'},
+        ]
+        self.mock_char_mgr.get_character.return_value = None
+        self.mock_image_gen.generate_scene_image.side_effect = lambda desc, **kwargs: f"/cache/{desc[:8]}.png"
+        self.mock_tts_gen.generate_speech_for_scene.return_value = None
+        
+        composer = SceneComposer(
+            self.mock_image_gen,
+            self.mock_tts_gen,
+            self.mock_char_mgr,
+            derive_shots={'中景': 0.6, '特写': 0.35}
+        )
+        composer.compositor = MagicMock()
+        composer.compositor.derive_shot.side_effect = lambda path, zoom: f"{path}@{zoom}"
+        composer.plan_storyboard(panels, {})
+        results = [composer.create_scene_from_storyboard(i, panel, {}) for i, panel in enumerate(panels)]
+        
+        self.assertEqual(self.mock_image_gen.generate_scene_image.call_count, 2)
+        self.assertEqual(results[0]['image_source']['type'], 'establishing')
+        self.assertEqual(results[1]['image_source'],
+                         {'type': 'derived', 'derived_from': 0, 'zoom': 0.6, 'run_scenes': [0, 1, 2]})
+        self.assertEqual(results[2]['image_source']['zoom'], 0.35)
+        self.assertIsNone(results[3]['image_source'])
+
+    @patch('scene_composer.os.makedirs')
+    @patch('scene_composer.shutil.copy')
+    @patch.object(SceneComposer, '_save_metadata')
+    def test_storyboard_reuses_background_per_location(self, mock_save, mock_copy, mock_makedirs):
+        panels = [
+            {'shot_type': '中景', 'characters': ['张三'], 'location': '教室', 'mood': 'calm'},
+            {'shot_type': '特写', 'characters': ['李四'], 'location': ' 教室 ', 'mood': 'calm'},
+            {'shot_type': '中景', 'characters': ['王五'], 'location': '教室', 'mood': 'calm'},
+        ]
+        portraits = {'张三': '/cache/char_a.png', '李四': '/cache/char_b.png'}
+        self.mock_char_mgr.get_character.return_value = None
+        self.mock_image_gen.generate_scene_image.return_value = "/cache/scene.png"
+        self.mock_tts_gen.generate_speech_for_scene.return_value = None
+        
+        composer = SceneComposer(
+            self.mock_image_gen,
+            self.mock_tts_gen,
+            self.mock_char_mgr,
+            reuse_backgrounds=True
+        )
+        composer.compositor = MagicMock()
+        composer.compositor.composite_characters.side_effect = [None, "/cache/composite_b.png"]
+        composer.plan_storyboard(panels, {}, character_portraits=portraits)
+        results = [composer.create_scene_from_storyboard(i, panel, {}) for i, panel in enumerate(panels)]
+        
+        self.assertIsNone(results[0]['image_source'])
+        self.assertEqual(results[1]['image_source']['type'], 'composite')
+        self.assertIsNone(results[2]['image_source'])
+        # 一次共享背景 + 第 1 个分镜合成失败后的完整生图 + 第 3 个分镜没有立绘直接生图
+        self.assertEqual(self.mock_image_gen.generate_scene_image.call_count, 3)
+
+
+    @patch('scene_composer.os.makedirs')
+    @patch('scene_composer.shutil.copy')
+    @patch('scene_composer.link_or_copy')
+    @patch.object(SceneComposer, '_save_metadata')
+    def test_storyboard_records_audio_info(self, mock_save, mock_link, mock_copy, mock_makedirs):
+        panel = {'shot_type': '中景', 'visual_description': '教室', 'narration': '旁白', 'characters': []}
+        self.mock_char_mgr.get_character.return_value = None
+        self.mock_image_gen.generate_scene_image.return_value = '/cache/scene.png'
+        self.mock_tts_gen.generate_speech_for_scene.return_value = '/cache/audio.mp3'
+        self.mock_tts_gen.get_audio_info.return_value = {
+            'duration': 3.264, 'sample_rate': 24000, 'channels': 1, 'bitrate': 32000, 'frames': 136
+        }
+        
+        composer = SceneComposer(self.mock_image_gen, self.mock_tts_gen, self.mock_char_mgr)
+        result = composer.create_scene_from_storyboard(0, panel, {})
+        
+        self.mock_tts_gen.get_audio_info.assert_called_once_with(result['audio_path'])
+        self.assertEqual(result['audio_duration'], 3.264)
+        self.assertEqual(result['audio_sample_rate'], 24000)
+        self.assertEqual(mock_save.call_args[0][1]['audio_channels'], 1)
+
+
+    @patch('scene_composer.os.makedirs')
+    def test_plan_storyboard_prefetches_short_narrations(self, mock_makedirs):
+        panels = [
+            {'narration': '门开了。', 'dialogue': [{'character': '张三', 'text': '谁？'}]},
+            {'narration': '下雨了。'},
+        ]
+        
+        composer = SceneComposer(self.mock_image_gen, self.mock_tts_gen, self.mock_char_mgr, batch_tts=True)
+        composer.plan_storyboard(panels, {})
+        
+        self.mock_tts_gen.prefetch_short_texts.assert_called_once_with(['门开了。\n张三：谁？', '下雨了。'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+import sys
+import os
+import time
+import tempfile
+import shutil
+from unittest.mock import patch
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from storage_manager import StorageManager, MB
+
+
+class TestStorageManager(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.manager = StorageManager(base_dir=self.temp_dir, min_free_mb=0)
+
+    def tearDown(self):
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _write(self, relative_path, size=100, age_days=0):
+        path = os.path.join(self.temp_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'0' * size)
+        mtime = time.time() - age_days * 86400
+        os.utime(path, (mtime, mtime))
+        os.utime(os.path.dirname(path), (mtime, mtime))
+        return path
+
+    def test_scan_categories(self):
+        self._write('temp_videos/merged_task1.mp4', 300)
+        self._write('temp_videos/task1/segments/scene_0000.mp4', 200)
+        self._write('previews/task1.mp4', 30)
+        self._write('audio_cache/task1/a.mp3', 50)
+        self._write('audio_cache/shared/ab/abcd.mp3', 40)
+        self._write('audio_cache/shared/silence/silence_2.0.mp3', 10)
+        self._write('image_cache/scene_1.png', 70)
+        self._write('image_cache/prompt_index.jsonl', 5)
+        self._write('uploads/task1_novel.txt', 20)
+        self._write('task1/output_scenes/scene_0000/scene.png', 500)
+
+        merged = self.manager.scan('merged_videos')
+        self.assertEqual([(item['task_id'], item['bytes']) for item in merged], [('task1', 300)])
+        self.assertEqual(self.manager.scan('video_segments')[0]['bytes'], 200)
+        self.assertEqual([(item['task_id'], item['bytes']) for item in self.manager.scan('previews')], [('task1', 30)])
+        self.assertEqual(sorted(item['bytes'] for item in self.manager.scan('audio_cache')), [40, 50])
+        self.assertEqual(len(self.manager.scan('image_cache')), 1)
+        self.assertEqual(self.manager.scan('uploads')[0]['task_id'], 'task1')
+        sessions = self.manager.scan('session_outputs')
+        self.assertEqual([(item['task_id'], item['bytes']) for item in sessions], [('task1', 500)])
+
+        usage = self.manager.get_usage()
+        self.assertEqual(usage['categories']['merged_videos']['bytes'], 300)
+        self.assertEqual(usage['categories']['merged_videos']['quota_bytes'], 2048 * MB)
+        self.assertIn('free_bytes', usage['disk'])
+
+    def test_hardlinked_files_not_counted_as_freeable(self):
+        shared = self._write('audio_cache/shared/ab/abcd.mp3', 40)
+        os.link(shared, os.path.join(self.temp_dir, 'audio_cache', 'shared', 'ab', 'other.mp3'))
+        session = self._write('audio_cache/task1/a.mp3', 50)
+        os.link(session, os.path.join(self.temp_dir, 'audio_cache', 'task1', 'b.mp3'))
+        os.link(shared, os.path.join(self.temp_dir, 'audio_cache', 'task1', 'c.mp3'))
+
+        items = {item['task_id']: item['bytes'] for item in self.manager.scan('audio_cache')}
+
+        # 共享文件还链接在会话目录里，删掉哪一边都不释放空间；会话目录内部的两个链接只计一次
+        self.assertEqual(items, {'task1': 50, None: 0})
+
+    def test_usage_before_scan(self):
+        usage = self.manager.get_usage()
+
+        self.assertIsNone(usage['categories']['session_outputs']['bytes'])
+        self.assertIsNone(usage['categories']['session_outputs']['quota_bytes'])
+
+    def test_quota_evicts_least_recently_used(self):
+        self.manager.categories['merged_videos']['quota_mb'] = 250 / MB
+        old = self._write('temp_videos/merged_a.mp4', 100, age_days=2)
+        recent = self._write('temp_videos/merged_b.mp4', 100, age_days=1)
+        self._write('temp_videos/merged_c.mp4', 100, age_days=1.5)
+        self.manager.touch(os.path.join(self.temp_dir, 'temp_videos/merged_c.mp4'))
+
+        freed = self.manager.enforce('merged_videos')
+
+        self.assertEqual(freed, 100)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(recent))
+
+    def test_age_eviction_and_active_tasks(self):
+        expired = self._write('temp_videos/task_old/segments/scene_0000.mp4', 100, age_days=10)
+        active = self._write('temp_videos/task_active/segments/scene_0000.mp4', 100, age_days=10)
+        fresh = self._write('temp_videos/task_new/segments/scene_0000.mp4', 100, age_days=1)
+        self.manager.is_active_ = lambda task_id: task_id == 'task_active'
+
+        self.manager.enforce('video_segments')
+
+        self.assertFalse(os.path.exists(os.path.dirname(os.path.dirname(expired))))
+        self.assertTrue(os.path.exists(active))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_recently_written_items_are_kept(self):
+        self.manager.categories['uploads']['quota_mb'] = 0
+        path = self._write('uploads/task1_novel.txt', 100)
+
+        self.manager.enforce('uploads')
+
+        self.assertTrue(os.path.exists(path))
+
+    def test_low_disk_evicts_regenerable_first(self):
+        merged = self._write('temp_videos/merged_a.mp4', 100, age_days=1)
+        segment = self._write('temp_videos/a/segments/scene_0000.mp4', 100, age_days=2)
+        scene = self._write('a/output_scenes/scene_0000/scene.png', 100, age_days=5)
+        self.manager.min_free_mb = 1
+
+        with patch('storage_manager.shutil.disk_usage') as mock_usage:
+            mock_usage.return_value.free = 1 * MB - 150
+            freed = self.manager._evict_for_disk()
+
+        self.assertEqual(freed, 200)
+        self.assertFalse(os.path.exists(merged))
+        self.assertFalse(os.path.exists(segment))
+        self.assertTrue(os.path.exists(scene))
+
+    def test_unknown_category(self):
+        with self.assertRaises(ValueError):
+            self.manager.scan('unknown')
+
+
+if __name__ == '__main__':
+    unittest.main()
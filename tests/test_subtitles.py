@@ -0,0 +1,42 @@
+import unittest
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from subtitles import build_cues, format_srt, format_webvtt, SUBTITLE_MAX_CHARS
+
+
+class TestSubtitles(unittest.TestCase):
+    
+    def test_build_cues_follows_scene_durations(self):
+        cues = build_cues([('小明走进教室。老师在写字。', 4.0), ('', 2.0), ('下课了。', 1.5)])
+        
+        self.assertEqual(cues[0][0], 0.0)
+        self.assertEqual(cues[-1], (6.0, 7.5, '下课了。'))
+        self.assertTrue(all(start < end for start, end, _ in cues))
+    
+    def test_long_text_split_by_length(self):
+        text = '字' * (SUBTITLE_MAX_CHARS * 2 + 5)
+        
+        cues = build_cues([(text, 10.0)])
+        
+        self.assertEqual(len(cues), 3)
+        self.assertTrue(all(len(cue[2]) <= SUBTITLE_MAX_CHARS for cue in cues))
+        self.assertEqual(cues[-1][1], 10.0)
+        self.assertAlmostEqual(cues[0][1], 10.0 * SUBTITLE_MAX_CHARS / len(text))
+    
+    def test_format_srt(self):
+        srt = format_srt([(0.0, 1.5, '你好'), (3661.25, 3662.0, '再见')])
+        
+        self.assertEqual(srt, "1\n00:00:00,000 --> 00:00:01,500\n你好\n\n"
+                              "2\n01:01:01,250 --> 01:01:02,000\n再见\n")
+    
+    def test_format_webvtt_with_timestamp_map(self):
+        vtt = format_webvtt([(0.0, 1.0, '你好')], mpegts_start=126000)
+        
+        self.assertEqual(vtt.splitlines()[:4], ['WEBVTT', 'X-TIMESTAMP-MAP=MPEGTS:126000,LOCAL:00:00:00.000',
+                                                '', '00:00:00.000 --> 00:00:01.000'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,10 +3,11 @@ import sys
 import os
 import tempfile
 import shutil
+import numpy as np
 from unittest.mock import patch, MagicMock
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from tts_generator import TTSGenerator
+from tts_generator import TTSGenerator, EspeakTTSBackend, split_sentences
 
 
 class TestTTSGenerator(unittest.TestCase):
@@ -161,6 +162,279 @@ class TestTTSGenerator(unittest.TestCase):
         result2 = self.generator.generate_speech("文本2")
         
         self.assertNotEqual(result1, result2)
+    
+    def _fake_gtts(self, mock_gtts):
+        def make_tts(text, **kwargs):
+            tts = MagicMock()
+            tts.save.side_effect = lambda path: open(path, 'wb').write(text.encode('utf-8'))
+            return tts
+        mock_gtts.side_effect = make_tts
+    
+    @patch('tts_generator.gTTS')
+    def test_shared_store_reused_across_sessions(self, mock_gtts):
+        self._fake_gtts(mock_gtts)
+        shared_dir = os.path.join(self.temp_dir, 'shared')
+        first = TTSGenerator()
+        first.cache_dir_ = os.path.join(self.temp_dir, 'session_a')
+        first.shared_dir_ = shared_dir
+        second = TTSGenerator()
+        second.cache_dir_ = os.path.join(self.temp_dir, 'session_b')
+        second.shared_dir_ = shared_dir
+        os.makedirs(first.cache_dir_)
+        os.makedirs(second.cache_dir_)
+        
+        path_a = first.generate_speech_for_scene("同一段旁白", 0)
+        path_b = second.generate_speech_for_scene("同一段旁白", 3)
+        
+        mock_gtts.assert_called_once()
+        self.assertNotEqual(path_a, path_b)
+        with open(path_b, 'rb') as f:
+            self.assertEqual(f.read(), "同一段旁白".encode('utf-8'))
+        self.assertTrue(os.path.samefile(path_b, first._shared_path("同一段旁白", 'com', False)))
+    
+    @patch('tts_generator.gTTS')
+    def test_shared_store_keyed_by_voice_and_speed(self, mock_gtts):
+        self._fake_gtts(mock_gtts)
+        self.generator.cache_dir_ = self.temp_dir
+        self.generator.shared_dir_ = os.path.join(self.temp_dir, 'shared')
+        
+        self.generator.generate_speech("文本", os.path.join(self.temp_dir, 'a.mp3'), voice_type='male')
+        self.generator.generate_speech("文本", os.path.join(self.temp_dir, 'b.mp3'), voice_type='female')
+        self.generator.generate_speech("文本", os.path.join(self.temp_dir, 'c.mp3'), voice_type='male', slow=True)
+        
+        self.assertEqual(mock_gtts.call_count, 3)
+    
+    @patch('tts_generator.gTTS')
+    def test_scene_overwrite_keeps_shared_file(self, mock_gtts):
+        self._fake_gtts(mock_gtts)
+        self.generator.cache_dir_ = self.temp_dir
+        self.generator.shared_dir_ = os.path.join(self.temp_dir, 'shared')
+        
+        self.generator.generate_speech_for_scene("第一版", 0)
+        self.generator.generate_multi_voice_scene("第二版", [], 0)
+        
+        with open(self.generator._shared_path("第一版", 'com', False), 'rb') as f:
+            self.assertEqual(f.read(), "第一版".encode('utf-8'))
+
+    
+    @patch('tts_generator.gTTS')
+    def test_shared_file_removed_before_link_falls_back_to_synthesis(self, mock_gtts):
+        self._fake_gtts(mock_gtts)
+        self.generator.cache_dir_ = self.temp_dir
+        self.generator.shared_dir_ = os.path.join(self.temp_dir, 'shared')
+        self.generator.generate_speech("文本", os.path.join(self.temp_dir, 'a.mp3'))
+        
+        with patch('tts_generator.link_or_copy', side_effect=FileNotFoundError('evicted')):
+            path = self.generator.generate_speech("文本", os.path.join(self.temp_dir, 'b.mp3'))
+        
+        self.assertEqual(path, os.path.join(self.temp_dir, 'b.mp3'))
+        self.assertEqual(mock_gtts.call_count, 2)
+    
+    def test_split_sentences(self):
+        text = "今天天气很好。我们去公园吧！" * 20
+        
+        segments = split_sentences(text)
+        
+        self.assertGreater(len(segments), 1)
+        self.assertEqual("".join(segments), text)
+        self.assertTrue(all(len(segment) <= 100 for segment in segments))
+    
+    @patch('tts_generator.gTTS')
+    def test_parallel_segments_cached_per_sentence(self, mock_gtts):
+        frame = bytes([0xFF, 0xF3, 0x44, 0xC0]) + b'\x00' * 92
+        
+        def make_tts(text, **kwargs):
+            tts = MagicMock()
+            tts.save.side_effect = lambda path: open(path, 'wb').write(frame * len(text))
+            return tts
+        mock_gtts.side_effect = make_tts
+        
+        generator = TTSGenerator(parallel_segments=True)
+        generator.cache_dir_ = self.temp_dir
+        generator.shared_dir_ = os.path.join(self.temp_dir, 'shared')
+        sentences = [f"这是第{i}句比较长的旁白，用来测试分句并行合成的效果。" for i in range(8)]
+        
+        original = "".join(sentences)
+        first = generator.generate_speech(original, os.path.join(self.temp_dir, 'a.mp3'))
+        first_calls = mock_gtts.call_count
+        sentences[-1] = "最后一句改过了。"
+        second = generator.generate_speech("".join(sentences), os.path.join(self.temp_dir, 'b.mp3'))
+        
+        self.assertGreater(first_calls, 1)
+        self.assertEqual(mock_gtts.call_count, first_calls + 1)
+        with open(first, 'rb') as f:
+            self.assertEqual(len(f.read()), len(frame) * len(original))
+        self.assertTrue(os.path.exists(second))
+
+    
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            TTSGenerator(backend='unknown')
+    
+    @patch('tts_generator.subprocess.run')
+    def test_espeak_backend(self, mock_run):
+        backend = EspeakTTSBackend(executable='/usr/bin/espeak-ng')
+        output_file = os.path.join(self.temp_dir, 'local.mp3')
+        
+        backend.synthesize("本地合成", 'zh-CN', output_file, voice='+f3', slow=True)
+        
+        espeak_call, ffmpeg_call = mock_run.call_args_list
+        self.assertEqual(espeak_call[0][0][:5], ['/usr/bin/espeak-ng', '-v', 'cmn+f3', '-s', '120'])
+        self.assertEqual(espeak_call[1]['input'], "本地合成".encode('utf-8'))
+        self.assertEqual(ffmpeg_call[0][0][-1], output_file)
+        self.assertIn('libmp3lame', ffmpeg_call[0][0])
+    
+    def test_espeak_backend_missing_executable(self):
+        backend = EspeakTTSBackend()
+        backend.executable = None
+        
+        with self.assertRaises(RuntimeError):
+            backend.synthesize("文本", 'zh-CN', os.path.join(self.temp_dir, 'x.mp3'))
+    
+    @patch('tts_generator.gTTS')
+    @patch('tts_generator.subprocess.run')
+    def test_generate_speech_with_espeak_backend(self, mock_run, mock_gtts):
+        generator = TTSGenerator(backend='espeak')
+        generator.backend_.executable = '/usr/bin/espeak-ng'
+        generator.cache_dir_ = self.temp_dir
+        generator.shared_dir_ = os.path.join(self.temp_dir, 'shared')
+        
+        result = generator.generate_speech_for_scene("场景文本", 1)
+        
+        self.assertTrue(result.endswith('scene_0001.mp3'))
+        mock_gtts.assert_not_called()
+        self.assertEqual(mock_run.call_count, 2)
+        self.assertNotEqual(generator._shared_path("场景文本", '', False),
+                            TTSGenerator()._shared_path("场景文本", '', False))
+
+    
+    @patch('tts_generator.gTTS')
+    def test_multi_voice_scene_concatenates_frames(self, mock_gtts):
+        frame = bytes([0xFF, 0xF3, 0x44, 0xC0]) + b'\x01' * 92
+        
+        def make_tts(text, **kwargs):
+            tts = MagicMock()
+            tts.save.side_effect = lambda path: open(path, 'wb').write(frame * 10)
+            return tts
+        mock_gtts.side_effect = make_tts
+        self.generator.cache_dir_ = self.temp_dir
+        self.generator.shared_dir_ = os.path.join(self.temp_dir, 'shared')
+        dialogues = [{'character': '张三', 'text': f'台词{i}'} for i in range(3)]
+        
+        with patch('pydub.AudioSegment.from_mp3') as mock_decode:
+            result = self.generator.generate_multi_voice_scene("旁白", dialogues, 2)
+        
+        mock_decode.assert_not_called()
+        self.assertTrue(result.endswith('scene_0002.mp3'))
+        with open(result, 'rb') as f:
+            data = f.read()
+        self.assertEqual(data.count(frame), 40)
+        self.assertEqual(len(data), len(frame) * (40 + 4 * 21))
+
+    
+    @patch('tts_generator.probe_mp3')
+    def test_get_audio_info_cached_per_inode(self, mock_probe):
+        mock_probe.return_value = {'duration': 1.5, 'sample_rate': 24000, 'channels': 1}
+        source = os.path.join(self.temp_dir, 'a.mp3')
+        with open(source, 'wb') as f:
+            f.write(b'data')
+        linked = os.path.join(self.temp_dir, 'b.mp3')
+        os.link(source, linked)
+        
+        self.assertEqual(self.generator.get_audio_info(source)['duration'], 1.5)
+        self.assertEqual(self.generator.get_audio_info(linked)['duration'], 1.5)
+        self.assertIsNone(self.generator.get_audio_info(os.path.join(self.temp_dir, 'missing.mp3')))
+        mock_probe.assert_called_once_with(source)
+
+    
+    @patch('tts_generator.transcode_audio')
+    def test_encode_variants_cached_by_content(self, mock_transcode):
+        mock_transcode.side_effect = lambda src, dst, profile: open(dst, 'wb').write(profile.encode()) and dst
+        self.generator.shared_dir_ = os.path.join(self.temp_dir, 'shared')
+        first = os.path.join(self.temp_dir, 'a.mp3')
+        second = os.path.join(self.temp_dir, 'b.mp3')
+        for path in (first, second):
+            with open(path, 'wb') as f:
+                f.write(b'same audio')
+        
+        variants = self.generator.encode_variants(first, ('opus', 'aac'))
+        again = self.generator.encode_variants(second, ('opus', 'aac'))
+        
+        self.assertEqual(variants, again)
+        self.assertTrue(variants['opus'].endswith('.ogg'))
+        self.assertTrue(variants['aac'].endswith('.m4a'))
+        self.assertEqual(mock_transcode.call_count, 2)
+
+    
+    @patch('tts_generator.gTTS')
+    def test_empty_text_uses_generated_silence(self, mock_gtts):
+        self.generator.silence_.cache_dir_ = os.path.join(self.temp_dir, 'silence')
+        output_file = os.path.join(self.temp_dir, 'empty_scene.mp3')
+        
+        result = self.generator.generate_speech("\n", output_file)
+        
+        mock_gtts.assert_not_called()
+        self.assertEqual(result, output_file)
+        self.assertAlmostEqual(self.generator.get_audio_info(result)['duration'], 2.0, delta=0.03)
+
+    
+    @patch('tts_generator.split_mp3_on_silence')
+    @patch('tts_generator.gTTS')
+    def test_prefetch_short_texts_batches_requests(self, mock_gtts, mock_split):
+        self._fake_gtts(mock_gtts)
+        mock_split.side_effect = lambda path, count, **kwargs: [f"piece{i}".encode() for i in range(count)]
+        self.generator.cache_dir_ = self.temp_dir
+        self.generator.shared_dir_ = os.path.join(self.temp_dir, 'shared')
+        texts = ["他笑了。", "门开了。", "下雨了。", "这是一段超过三十个字的旁白，不适合拼进批量请求，应该单独合成才对。"]
+        
+        written = self.generator.prefetch_short_texts(texts)
+        
+        self.assertEqual(written, 3)
+        mock_gtts.assert_called_once()
+        self.assertIn("门开了。", mock_gtts.call_args[1]['text'])
+        result = self.generator.generate_speech_for_scene("门开了。", 1)
+        mock_gtts.assert_called_once()
+        with open(result, 'rb') as f:
+            self.assertEqual(f.read(), b'piece1')
+    
+    @patch('tts_generator.split_mp3_on_silence')
+    @patch('tts_generator.gTTS')
+    def test_prefetch_short_texts_split_failure(self, mock_gtts, mock_split):
+        self._fake_gtts(mock_gtts)
+        mock_split.return_value = None
+        self.generator.shared_dir_ = os.path.join(self.temp_dir, 'shared')
+        
+        written = self.generator.prefetch_short_texts(["他笑了。", "门开了。"])
+        
+        self.assertEqual(written, 0)
+        self.assertFalse(os.path.exists(self.generator._shared_path("他笑了。", 'com', False)))
+        self.assertEqual([name for name in os.listdir(self.generator.shared_dir_) if name.startswith('batch_')], [])
+
+    
+    @patch('audio_utils.decode_pcm')
+    @patch('tts_generator.gTTS')
+    def test_prefetch_short_texts_rejects_split_inside_text(self, mock_gtts, mock_decode):
+        frame = bytes([0xFF, 0xF3, 0x44, 0xC0]) + bytes(92)
+        texts = ["他停了一下，又走了。", "门开了……"]
+        self.generator.shared_dir_ = os.path.join(self.temp_dir, 'shared')
+        
+        def run(pattern):
+            """pattern 中每个字符对应一帧：'#' 为有声，'.' 为静音"""
+            mock_gtts.side_effect = None
+            mock_gtts.return_value.save.side_effect = lambda path: open(path, 'wb').write(frame * len(pattern))
+            mock_decode.return_value = np.concatenate([np.full(576, 5000 if c == '#' else 0, dtype=np.int16)
+                                                       for c in pattern])
+            return self.generator.prefetch_short_texts(texts)
+        
+        # "，" 处的停顿比段间停顿长：最长静音落在第一段内部，切分被拒绝，不写入共享库
+        self.assertEqual(run('#' * 10 + '.' * 12 + '#' * 6 + '.' * 6 + '#' * 6), 0)
+        self.assertFalse(os.path.exists(self.generator._shared_path(texts[0], 'com', False)))
+        self.assertFalse(os.path.exists(self.generator._shared_path(texts[1], 'com', False)))
+        
+        # 段间停顿最长：切在两段之间，各段时长与字数相符
+        self.assertEqual(run('#' * 10 + '.' * 4 + '#' * 6 + '.' * 12 + '#' * 6), 2)
+        with open(self.generator._shared_path(texts[1], 'com', False), 'rb') as f:
+            self.assertEqual(len(f.read()) // len(frame), 12)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,362 @@
+import unittest
+import sys
+import os
+import json
+import tempfile
+import shutil
+from unittest.mock import patch, MagicMock
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from PIL import Image
+
+import struct
+
+from video_merger import VideoMerger, HlsPlaylist, mp4_duration, ts_start_pts, PREVIEW_PROFILE
+
+
+class TestVideoMerger(unittest.TestCase):
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.merger = VideoMerger()
+        self.merger.temp_dir_ = os.path.join(self.temp_dir, 'temp_videos')
+        os.makedirs(self.merger.temp_dir_)
+        self.merger.silence_ = MagicMock()
+        self.merger.silence_.mp3.return_value = '/cache/silence.mp3'
+        self.merger.silence_.aac.return_value = '/cache/silence.aac'
+    
+    def tearDown(self):
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+    
+    def _make_scene(self, index, with_audio=True, duration=None):
+        folder = os.path.join(self.temp_dir, f'scene_{index:04d}')
+        os.makedirs(folder)
+        Image.new('RGB', (179, 102), (200, 100, 50)).save(os.path.join(folder, 'scene.png'))
+        if with_audio:
+            open(os.path.join(folder, 'narration.mp3'), 'wb').close()
+        if duration:
+            with open(os.path.join(folder, 'metadata.json'), 'w', encoding='utf-8') as f:
+                json.dump({'audio_duration': duration}, f)
+        return folder
+    
+    def _ffmpeg_ok(self, calls):
+        def run(args):
+            calls.append(args)
+            if '-loop' in args:
+                scaled = args[args.index('-loop') + 5]
+                with Image.open(scaled) as img:
+                    calls.append(img.size)
+            with open(args[-1], 'wb') as f:
+                f.write(b'0' * 100)
+            return {'cpu_seconds': 0.5, 'wall_seconds': 1.0}
+        return run
+    
+    @patch.object(VideoMerger, '_run_ffmpeg')
+    def test_concat_merge_stream_copies_segments(self, mock_run):
+        calls = []
+        mock_run.side_effect = self._ffmpeg_ok(calls)
+        folders = [self._make_scene(0, duration=2.5), self._make_scene(1)]
+        output = os.path.join(self.temp_dir, 'merged.mp4')
+        
+        result = self.merger.merge_scene_videos(folders, output)
+        
+        self.assertTrue(result)
+        first_segment, scaled_size, second_segment, _, concat = calls
+        self.assertEqual(first_segment[first_segment.index('-t') + 1], '2.5')
+        self.assertEqual(scaled_size, (1344, 768))
+        self.assertIn('stillimage', first_segment)
+        self.assertIn('-shortest', second_segment)
+        self.assertEqual(concat[concat.index('-c') + 1], 'copy')
+        self.assertEqual(concat[concat.index('-f') + 1], 'concat')
+        self.assertEqual(concat[-1], output)
+        self.assertEqual(os.listdir(self.merger.temp_dir_), [])
+    
+    @patch.object(VideoMerger, '_run_ffmpeg')
+    def test_concat_merge_uses_silence_for_image_only_scene(self, mock_run):
+        calls = []
+        mock_run.side_effect = self._ffmpeg_ok(calls)
+        folders = [self._make_scene(0, with_audio=False)]
+        
+        self.merger.merge_scene_videos(folders, os.path.join(self.temp_dir, 'merged.mp4'))
+        
+        self.assertIn('/cache/silence.aac', calls[0])
+        self.assertEqual(calls[0][calls[0].index('-c:a') + 1], 'copy')
+        self.assertEqual(calls[0][calls[0].index('-t') + 1], '2.0')
+    
+    @patch.object(VideoMerger, '_run_ffmpeg')
+    def test_still_profile_copies_aac_narration(self, mock_run):
+        calls = []
+        mock_run.side_effect = self._ffmpeg_ok(calls)
+        folder = self._make_scene(0, duration=3.0)
+        open(os.path.join(folder, 'narration.m4a'), 'wb').close()
+        
+        self.merger.merge_scene_videos([folder], os.path.join(self.temp_dir, 'merged.mp4'))
+        
+        self.assertIn(os.path.join(folder, 'narration.m4a'), calls[0])
+        self.assertEqual(calls[0][calls[0].index('-c:a') + 1], 'copy')
+        report = self.merger.get_last_report()
+        self.assertEqual(report['profile'], 'still')
+        self.assertEqual(report['segment_bytes'], 100)
+        self.assertEqual(report['cpu_seconds'], 0.5)
+        self.assertTrue(report['segments'][0]['audio_copied'])
+    
+    @patch.object(VideoMerger, '_run_ffmpeg')
+    def test_standard_profile_transcodes_audio(self, mock_run):
+        calls = []
+        mock_run.side_effect = self._ffmpeg_ok(calls)
+        self.merger.profile = 'standard'
+        folder = self._make_scene(0, with_audio=False)
+        
+        self.merger.merge_scene_videos([folder], os.path.join(self.temp_dir, 'merged.mp4'))
+        
+        self.assertIn('/cache/silence.mp3', calls[0])
+        self.assertEqual(calls[0][calls[0].index('-c:a') + 1], 'aac')
+        self.assertEqual(calls[1], (1792, 1024))
+    
+    @patch.object(VideoMerger, '_run_ffmpeg')
+    def test_segment_dir_reuses_unchanged_segments(self, mock_run):
+        calls = []
+        mock_run.side_effect = self._ffmpeg_ok(calls)
+        folders = [self._make_scene(0, duration=2.0), self._make_scene(1, duration=3.0)]
+        segment_dir = os.path.join(self.temp_dir, 'task', 'segments')
+        output_path = os.path.join(self.temp_dir, 'merged.mp4')
+        
+        self.assertTrue(self.merger.merge_scene_videos(folders, output_path, segment_dir=segment_dir))
+        self.assertTrue(os.path.exists(os.path.join(segment_dir, 'scene_0001.mp4.json')))
+        
+        Image.new('RGB', (179, 102), (0, 0, 0)).save(os.path.join(folders[1], 'scene.png'))
+        calls.clear()
+        self.assertTrue(self.merger.merge_scene_videos(folders, output_path, segment_dir=segment_dir))
+        
+        reused = [segment['reused'] for segment in self.merger.get_last_report()['segments']]
+        self.assertEqual(reused, [True, False])
+        encoded = [args for args in calls if isinstance(args, list) and '-loop' in args]
+        self.assertEqual(len(encoded), 1)
+        self.assertIn('scene_0001.mp4', encoded[0][-1])
+        self.assertTrue(os.path.exists(os.path.join(segment_dir, 'scene_0000.mp4')))
+    
+    @patch.object(VideoMerger, '_run_ffmpeg')
+    def test_failed_segment_leaves_no_partial_file(self, mock_run):
+        def run(args):
+            with open(args[-1], 'wb') as f:
+                f.write(b'partial')
+            raise RuntimeError('killed')
+        mock_run.side_effect = run
+        segment_dir = os.path.join(self.temp_dir, 'segments')
+        os.makedirs(segment_dir)
+        
+        report = self.merger.prepare_segment(self._make_scene(0), os.path.join(segment_dir, 'segment_0000.mp4'))
+        
+        self.assertIsNone(report)
+        self.assertEqual(os.listdir(segment_dir), [])
+    
+    def test_submit_segment_reuses_pending_encode(self):
+        import threading
+        release = threading.Event()
+        calls = []
+        
+        def prepare(scene_folder, segment_path):
+            calls.append(segment_path)
+            release.wait(5)
+            return {'scene': os.path.basename(scene_folder)}
+        
+        folder = self._make_scene(3)
+        segment_dir = os.path.join(self.temp_dir, 'segments')
+        with patch.object(self.merger, 'prepare_segment', side_effect=prepare):
+            first = self.merger.submit_segment(folder, segment_dir)
+            second = self.merger.submit_segment(folder, segment_dir)
+            release.set()
+            self.assertIs(first, second)
+            self.assertEqual(first.result(), {'scene': 'scene_0003'})
+            self.merger.shutdown()
+        
+        self.assertEqual(calls, [os.path.join(segment_dir, 'scene_0003.mp4')])
+        self.assertEqual(self.merger.pending_, {})
+    
+    @patch.object(VideoMerger, '_run_ffmpeg')
+    def test_hls_remuxes_segments_and_writes_playlist(self, mock_run):
+        calls = []
+        mock_run.side_effect = self._ffmpeg_ok(calls)
+        self.merger.hls = True
+        folders = [self._make_scene(0, duration=2.0), self._make_scene(1, duration=3.0)]
+        segment_dir = os.path.join(self.temp_dir, 'segments')
+        
+        durations = {'scene_0000.mp4': 2.0, 'scene_0001.mp4': 3.5}
+        with patch('video_merger.mp4_duration', side_effect=lambda path: durations[os.path.basename(path)]):
+            self.merger.merge_scene_videos(folders, os.path.join(self.temp_dir, 'merged.mp4'), segment_dir=segment_dir)
+        
+        remuxes = sorted(args[1] for args in calls if isinstance(args, list) and 'mpegts' in args)
+        self.assertEqual(remuxes, [os.path.join(segment_dir, 'scene_0000.mp4'),
+                                   os.path.join(segment_dir, 'scene_0001.mp4')])
+        with open(os.path.join(segment_dir, 'playlist.m3u8'), encoding='utf-8') as f:
+            playlist = f.read().splitlines()
+        self.assertIn('#EXT-X-TARGETDURATION:4', playlist)
+        self.assertEqual(playlist[-6:], ['#EXTINF:2.000,', 'scene_0000.ts', '#EXT-X-DISCONTINUITY',
+                                         '#EXTINF:3.500,', 'scene_0001.ts', '#EXT-X-ENDLIST'])
+        with open(os.path.join(segment_dir, 'subtitles.m3u8'), encoding='utf-8') as f:
+            self.assertIn('scene_0001.vtt', f.read())
+        with open(os.path.join(segment_dir, 'master.m3u8'), encoding='utf-8') as f:
+            self.assertIn('URI="subtitles.m3u8"', f.read())
+        with open(os.path.join(segment_dir, 'scene_0000.vtt'), encoding='utf-8') as f:
+            self.assertTrue(f.read().startswith('WEBVTT'))
+    
+    @patch.object(VideoMerger, '_run_ffmpeg')
+    def test_concat_muxes_soft_subtitles(self, mock_run):
+        calls = []
+        mock_run.side_effect = self._ffmpeg_ok(calls)
+        folders = [self._make_scene(0), self._make_scene(1)]
+        for folder, text in zip(folders, ['第一句。', '第二句。']):
+            with open(os.path.join(folder, 'metadata.json'), 'w', encoding='utf-8') as f:
+                json.dump({'text': text, 'audio_duration': 2.0}, f, ensure_ascii=False)
+        segment_dir = os.path.join(self.temp_dir, 'segments')
+        
+        with patch('video_merger.mp4_duration', return_value=2.0):
+            self.merger.merge_scene_videos(folders, os.path.join(self.temp_dir, 'merged.mp4'), segment_dir=segment_dir)
+        
+        concat = calls[-1]
+        srt_path = os.path.join(segment_dir, 'subtitles.srt')
+        self.assertEqual(concat[concat.index('-c:s') + 1], 'mov_text')
+        self.assertEqual(concat[concat.index('-c') + 1], 'copy')
+        self.assertIn(srt_path, concat)
+        with open(srt_path, encoding='utf-8') as f:
+            self.assertIn('00:00:02,000 --> 00:00:04,000\n第二句。', f.read())
+    
+    def test_hls_playlist_publishes_in_order(self):
+        segment_dir = os.path.join(self.temp_dir, 'segments')
+        playlist = HlsPlaylist(segment_dir, 3)
+        path = os.path.join(segment_dir, 'playlist.m3u8')
+        
+        def read():
+            with open(path, encoding='utf-8') as f:
+                return [line for line in f.read().splitlines() if not line.startswith('#')]
+        
+        playlist.mark_ready(1, 'scene_0001.ts', 2.0, 'scene_0001.vtt')
+        self.assertFalse(os.path.exists(path))
+        
+        playlist.mark_ready(0, 'scene_0000.ts', 2.0, 'scene_0000.vtt')
+        self.assertEqual(read(), ['scene_0000.ts', 'scene_0001.ts'])
+        with open(path, encoding='utf-8') as f:
+            content = f.read()
+        self.assertIn('#EXT-X-PLAYLIST-TYPE:EVENT', content)
+        self.assertNotIn('#EXT-X-ENDLIST', content)
+        
+        playlist.finish()
+        playlist.mark_ready(2, 'scene_0002.ts', 2.0, 'scene_0002.vtt')
+        self.assertEqual(read(), ['scene_0000.ts', 'scene_0001.ts'])
+        with open(path, encoding='utf-8') as f:
+            self.assertIn('#EXT-X-ENDLIST', f.read())
+    
+    def test_hls_playlist_skips_failed_scene(self):
+        segment_dir = os.path.join(self.temp_dir, 'segments')
+        playlist = HlsPlaylist(segment_dir, 3)
+        
+        playlist.mark_ready(0, 'scene_0000.ts', 2.0, 'scene_0000.vtt')
+        playlist.mark_skipped(1)
+        playlist.mark_ready(2, 'scene_0002.ts', 2.0, 'scene_0002.vtt')
+        
+        with open(os.path.join(segment_dir, 'playlist.m3u8'), encoding='utf-8') as f:
+            content = f.read()
+        self.assertIn('scene_0002.ts', content)
+        self.assertNotIn('scene_0001.ts', content)
+    
+    def test_mp4_duration(self):
+        mvhd = struct.pack('>I4sB3x8xII', 8 + 4 + 8 + 8, b'mvhd', 0, 1000, 2500)
+        moov = struct.pack('>I4s', 8 + len(mvhd), b'moov') + mvhd
+        path = os.path.join(self.temp_dir, 'test.mp4')
+        with open(path, 'wb') as f:
+            f.write(struct.pack('>I4s4s', 12, b'ftyp', b'isom') + struct.pack('>I4s', 12, b'mdat') + b'abcd' + moov)
+        
+        self.assertEqual(mp4_duration(path), 2.5)
+        
+        with open(path, 'wb') as f:
+            f.write(b'not an mp4')
+        self.assertIsNone(mp4_duration(path))
+    
+    def test_ts_start_pts(self):
+        pts = 216000
+        pts_bytes = bytes([0x21 | ((pts >> 29) & 0x0E), (pts >> 22) & 0xFF, ((pts >> 14) & 0xFE) | 1,
+                           (pts >> 7) & 0xFF, ((pts << 1) & 0xFE) | 1])
+        pat = b'\x47\x40\x00\x10' + b'\xff' * 184
+        pes = b'\x47\x41\x00\x10' + b'\x00\x00\x01\xe0\x00\x00\x80\x80\x05' + pts_bytes
+        path = os.path.join(self.temp_dir, 'scene.ts')
+        with open(path, 'wb') as f:
+            f.write(pat + pes + b'\xff' * (188 - len(pes)))
+        
+        self.assertEqual(ts_start_pts(path), pts)
+        self.assertIsNone(ts_start_pts(os.path.join(self.temp_dir, 'missing.ts')))
+    
+    def test_worker_threads_split_cores(self):
+        with patch('video_merger.os.cpu_count', return_value=8):
+            merger = VideoMerger(max_workers=4)
+        
+        self.assertEqual(merger.max_workers, 4)
+        self.assertEqual(merger.ffmpeg_threads_, 2)
+    
+    @patch('video_merger.resource')
+    def test_limit_memory(self, mock_resource):
+        self.merger.worker_memory_mb = 512
+        
+        self.merger._limit_memory(1234)
+        
+        mock_resource.prlimit.assert_called_once_with(1234, mock_resource.RLIMIT_AS,
+                                                       (512 * 1024 * 1024, 512 * 1024 * 1024))
+    
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            VideoMerger(profile='unknown')
+    
+    def test_run_ffmpeg_reports_usage(self):
+        usage = self.merger._run_ffmpeg(['-f', 'lavfi', '-i', 'anullsrc', '-t', '0.1', '-f', 'null', '-'])
+        
+        self.assertGreater(usage['wall_seconds'], 0)
+        self.assertIsNotNone(usage['cpu_seconds'])
+    
+    def test_run_ffmpeg_failure(self):
+        with self.assertRaises(RuntimeError):
+            self.merger._run_ffmpeg(['-i', os.path.join(self.temp_dir, 'missing.png'), '-f', 'null', '-'])
+    
+    @patch.object(VideoMerger, '_merge_with_moviepy')
+    @patch.object(VideoMerger, '_run_ffmpeg')
+    def test_concat_failure_falls_back_to_compose(self, mock_run, mock_moviepy):
+        mock_run.side_effect = RuntimeError('encoder error')
+        mock_moviepy.return_value = True
+        folders = [self._make_scene(0)]
+        output = os.path.join(self.temp_dir, 'merged.mp4')
+        
+        result = self.merger.merge_scene_videos(folders, output)
+        
+        self.assertTrue(result)
+        mock_moviepy.assert_called_once_with(folders, output)
+    
+    @patch.object(VideoMerger, '_merge_with_moviepy')
+    @patch.object(VideoMerger, '_run_ffmpeg')
+    def test_preview_encodes_first_scenes(self, mock_run, mock_moviepy):
+        calls = []
+        mock_run.side_effect = self._ffmpeg_ok(calls)
+        self.merger.profile = PREVIEW_PROFILE
+        folders = [self._make_scene(i, duration=2.0) for i in range(3)]
+        output = os.path.join(self.temp_dir, 'preview.mp4')
+        
+        self.assertTrue(self.merger.create_preview(folders, output, max_scenes=2))
+        
+        self.assertEqual([call for call in calls if call == (448, 256)], [(448, 256)] * 2)
+        self.assertEqual(len(self.merger.get_last_report()['segments']), 2)
+        
+        mock_run.side_effect = RuntimeError('encoder error')
+        self.assertFalse(self.merger.create_preview(folders, output))
+        mock_moviepy.assert_not_called()
+    
+    @patch.object(VideoMerger, '_merge_with_concat')
+    @patch.object(VideoMerger, '_merge_with_moviepy')
+    def test_compose_method(self, mock_moviepy, mock_concat):
+        mock_moviepy.return_value = True
+        
+        self.merger.merge_scene_videos([], 'out.mp4', method='compose')
+        
+        mock_concat.assert_not_called()
+        mock_moviepy.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
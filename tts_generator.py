@@ -2,29 +2,143 @@ import logging
 import os
 from gtts import gTTS
 from typing import Optional, List, Dict
+import re
 import hashlib
 import shutil
+import threading
+import subprocess
+import concurrent.futures
+
+from common import link_or_copy, get_ffmpeg_exe
+from audio_utils import (concat_mp3, probe_mp3, transcode_audio, split_mp3_on_silence,
+                         AUDIO_VARIANT_PROFILES, SilenceProvider)
+
+
+# 分句合成：按中文句末标点切分，再把短句合并到接近 gTTS 单次请求的上限（100 字），
+# 超过 SEGMENT_MIN_CHARS 的文本才分句，短文本一次请求即可
+SENTENCE_END_PATTERN = re.compile(r'(?<=[。！？；…!?;\n])')
+SEGMENT_MAX_CHARS = 100
+SEGMENT_MIN_CHARS = 150
+# 多角色场景中每段语音之后的停顿
+DIALOGUE_GAP_SECONDS = 0.5
+# 批量合成短文本：不超过 BATCH_MAX_TEXT_CHARS 字的文本用停顿标记拼成一次请求（总长不超过 SEGMENT_MAX_CHARS），
+# 再按静音切回各自的音频
+BATCH_MAX_TEXT_CHARS = 30
+BATCH_PAUSE_MARKER = "……。\n"
+BATCH_MIN_PAUSE_SECONDS = 0.2
+# 切开后每段有声时长占比与其字数占比的最大偏差（倍数）；超出时说明切在了文本自身的停顿（，……）上，整批放弃
+BATCH_DURATION_TOLERANCE = 1.5
+# 空文本用静音代替
+EMPTY_TEXT_SILENCE_SECONDS = 2.0
+
+
+def split_sentences(text: str, max_chars: int = SEGMENT_MAX_CHARS) -> List[str]:
+    segments = []
+    current = ''
+    for sentence in SENTENCE_END_PATTERN.split(text):
+        if not sentence.strip():
+            current += sentence
+            continue
+        if current.strip() and len(current) + len(sentence) > max_chars:
+            segments.append(current)
+            current = ''
+        current += sentence
+    if current.strip():
+        segments.append(current)
+    return [segment.strip() for segment in segments]
+
+
+class GoogleTTSBackend:
+    """gTTS（Google 翻译语音），不同音色用不同域名（tld）区分"""
+    name = 'google'
+    voices = {
+        'male': 'com.au',
+        'female': 'co.uk',
+        'narrator': 'com',
+        'default': 'com'
+    }
+
+    def synthesize(self, text: str, language: str, output_path: str, voice: str = None, slow: bool = False):
+        if voice:
+            tts = gTTS(text=text, lang=language, slow=slow, tld=voice)
+        else:
+            tts = gTTS(text=text, lang=language, slow=slow)
+        tts.save(output_path)
+
+
+class EspeakTTSBackend:
+    """
+    本地 espeak-ng 合成，不依赖网络，延迟稳定，适合压测和离线环境。
+    输出转成与 gTTS 相同规格的 MP3（24kHz 单声道 32kbps），两种来源的音频可以按帧拼接。
+    同时运行的 espeak/ffmpeg 子进程数不超过 CPU 核数
+    """
+    name = 'espeak'
+    voices = {
+        'male': '+m3',
+        'female': '+f3',
+        'narrator': '',
+        'default': ''
+    }
+    language_voices = {'zh-CN': 'cmn', 'zh-TW': 'cmn', 'zh': 'cmn'}
+
+    def __init__(self, executable: str = None, max_concurrency: int = None):
+        self.executable = executable or shutil.which('espeak-ng') or shutil.which('espeak')
+        self.semaphore_ = threading.BoundedSemaphore(max_concurrency or os.cpu_count() or 4)
+
+    def synthesize(self, text: str, language: str, output_path: str, voice: str = None, slow: bool = False):
+        if not self.executable:
+            raise RuntimeError("未找到 espeak-ng，请先安装（apt install espeak-ng）")
+
+        espeak_voice = self.language_voices.get(language, language.lower()) + (voice or '')
+        wav_path = f"{output_path}.wav"
+        try:
+            with self.semaphore_:
+                subprocess.run([self.executable, '-v', espeak_voice, '-s', '120' if slow else '170',
+                                '-w', wav_path, '--stdin'],
+                               input=text.encode('utf-8'), check=True, capture_output=True, timeout=120)
+                subprocess.run([get_ffmpeg_exe(), '-y', '-loglevel', 'error', '-i', wav_path,
+                                '-ar', '24000', '-ac', '1', '-codec:a', 'libmp3lame', '-b:a', '32k',
+                                '-write_xing', '0', '-id3v2_version', '0', '-f', 'mp3', output_path],
+                               check=True, capture_output=True, timeout=120)
+        finally:
+            if os.path.exists(wav_path):
+                os.remove(wav_path)
+
+
+TTS_BACKENDS = {
+    'google': GoogleTTSBackend,
+    'espeak': EspeakTTSBackend,
+}
 
 
 class TTSGenerator:
-    def __init__(self, session_id='',  language: str = 'zh-CN'):
+    def __init__(self, session_id='',  language: str = 'zh-CN', parallel_segments: bool = False,
+                 segment_workers: int = 4, backend: str = 'google'):
         self.language = language
+        if backend not in TTS_BACKENDS:
+            raise ValueError(f"不支持的语音后端: {backend}")
+        self.backend = backend
+        self.backend_ = TTS_BACKENDS[backend]()
+        # 长旁白分句并行合成，每句单独进共享语音库，改一句只重新合成这一句
+        self.parallel_segments = parallel_segments
+        self.segment_workers = segment_workers
         from common import get_base_dir
         
         self.cache_dir_ = os.path.join(get_base_dir(), "audio_cache", session_id)
         os.makedirs(self.cache_dir_, exist_ok=True)
+        # 跨会话共享的内容寻址语音库：相同 (文本, 语言, 音色, 语速) 只合成一次，
+        # 各会话里的文件是指向这里的硬链接
+        self.shared_dir_ = os.path.join(get_base_dir(), "audio_cache", "shared")
+        self.silence_ = SilenceProvider(os.path.join(self.shared_dir_, "silence"))
         
-        self.tld_map = {
-            'male': 'com.au',
-            'female': 'co.uk',
-            'narrator': 'com',
-            'default': 'com'
-        }
+        self.voice_map = dict(self.backend_.voices)
         
         self.character_voice_mapping = {}
+        # 音频信息按 inode 缓存：共享库的硬链接只解析一次
+        self.audio_info_ = {}
     
     def assign_voice_to_character(self, character_name: str, voice_type: str = 'default'):
-        if voice_type not in self.tld_map:
+        if voice_type not in self.voice_map:
             voice_type = 'default'
         self.character_voice_mapping[character_name] = voice_type
     
@@ -38,26 +152,168 @@ class TTSGenerator:
             return output_filename
 
         if text == '' or text == '\n':
-            silent_mp3_path = os.path.join('templates', 'slient_2s.mp3')
-            shutil.copy(silent_mp3_path, output_filename)
             logging.error('text is empty, return silent_mp3!')
-            return output_filename
+            return link_or_copy(self.silence_.mp3(EMPTY_TEXT_SILENCE_SECONDS), output_filename)
+
+        voice = self.voice_map.get(voice_type, self.voice_map['default'])
+        shared_path = self._shared_path(text, voice, slow)
+        if os.path.exists(shared_path):
+            try:
+                return link_or_copy(shared_path, output_filename)
+            except OSError as e:
+                # 存储清理可能在检查和链接之间删掉共享文件，重新合成即可
+                logging.warning(f"共享语音缓存不可用，重新合成: {e}")
+
+        if self.parallel_segments and len(text) > SEGMENT_MIN_CHARS:
+            segments = split_sentences(text)
+            if len(segments) > 1 and self._generate_segmented(segments, voice, slow, output_filename):
+                self._publish(output_filename, shared_path)
+                return output_filename
 
         try:
-            tld = self.tld_map.get(voice_type, 'com')
-            tts = gTTS(text=text, lang=self.language, slow=slow, tld=tld)
-            tts.save(output_filename)
+            self.backend_.synthesize(text, self.language, output_filename, voice=voice, slow=slow)
+            self._publish(output_filename, shared_path)
             return output_filename
         except Exception as e:
-            logging.exception(f"生成语音失败 (voice_type={voice_type}): {e}, text={text}")
+            logging.exception(f"生成语音失败 (backend={self.backend}, voice_type={voice_type}): {e}, text={text}")
             try:
-                tts = gTTS(text=text, lang=self.language, slow=slow)
-                tts.save(output_filename)
+                self.backend_.synthesize(text, self.language, output_filename, slow=slow)
                 return output_filename
             except Exception as fallback_e:
                 logging.exception(f"降级生成语音也失败: {fallback_e},  text={text}")
                 return None
     
+    def prefetch_short_texts(self, texts: List[str], voice_type: str = 'narrator', slow: bool = False) -> int:
+        """
+        批量预合成短文本：多条短文本用停顿标记拼成一次请求，合成后按静音切开，
+        每条各自写入共享语音库，之后 generate_speech 直接命中缓存。
+        某一批切分失败时跳过，这些文本在 generate_speech 时再单独合成。返回写入的条数
+        """
+        voice = self.voice_map.get(voice_type, self.voice_map['default'])
+        pending = []
+        for text in dict.fromkeys(texts):
+            if text and text.strip() and len(text) <= BATCH_MAX_TEXT_CHARS \
+                    and not os.path.exists(self._shared_path(text, voice, slow)):
+                pending.append(text)
+        
+        batches = []
+        for text in pending:
+            if batches and len(BATCH_PAUSE_MARKER.join(batches[-1] + [text])) <= SEGMENT_MAX_CHARS:
+                batches[-1].append(text)
+            else:
+                batches.append([text])
+        batches = [batch for batch in batches if len(batch) > 1]
+        if not batches:
+            return 0
+        
+        workers = max(1, min(self.segment_workers, len(batches)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            written = list(executor.map(lambda batch: self._synthesize_batch(batch, voice, slow), batches))
+        logging.info(f"批量合成短文本：{len(batches)} 次请求，写入 {sum(written)}/{len(pending)} 条")
+        return sum(written)
+    
+    def _synthesize_batch(self, batch: List[str], voice: str, slow: bool) -> int:
+        os.makedirs(self.shared_dir_, exist_ok=True)
+        batch_path = os.path.join(self.shared_dir_, f"batch_{os.getpid()}_{threading.get_ident()}.mp3")
+        try:
+            self.backend_.synthesize(BATCH_PAUSE_MARKER.join(batch), self.language, batch_path, voice=voice, slow=slow)
+            # 按不含标点的字数估计每段的有声时长，切错的整批不写入共享库（会被之后所有会话复用）
+            weights = [max(1, len(re.sub(r'[\W_]', '', text))) for text in batch]
+            pieces = split_mp3_on_silence(batch_path, len(batch), min_silence=BATCH_MIN_PAUSE_SECONDS,
+                                          weights=weights, tolerance=BATCH_DURATION_TOLERANCE)
+            if not pieces:
+                logging.info(f"批量合成结果无法按 {len(batch) - 1} 处停顿可靠切开，改为逐条合成")
+                return 0
+            for text, piece in zip(batch, pieces):
+                shared_path = self._shared_path(text, voice, slow)
+                os.makedirs(os.path.dirname(shared_path), exist_ok=True)
+                tmp_path = f"{shared_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(piece)
+                os.replace(tmp_path, shared_path)
+            return len(batch)
+        except Exception as e:
+            logging.exception(f"批量合成失败: {e}")
+            return 0
+        finally:
+            if os.path.exists(batch_path):
+                os.remove(batch_path)
+    
+    def _generate_segmented(self, segments: List[str], voice: str, slow: bool, output_filename: str) -> bool:
+        """并行合成各句后按帧拼接；任一句失败返回 False，由调用方整段合成"""
+        workers = max(1, min(self.segment_workers, len(segments)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            paths = list(executor.map(lambda segment: self._synthesize_segment(segment, voice, slow), segments))
+        if not all(paths):
+            return False
+        return concat_mp3(paths, output_filename) is not None
+    
+    def _synthesize_segment(self, text: str, voice: str, slow: bool) -> Optional[str]:
+        shared_path = self._shared_path(text, voice, slow)
+        if os.path.exists(shared_path):
+            return shared_path
+        try:
+            os.makedirs(os.path.dirname(shared_path), exist_ok=True)
+            tmp_path = f"{shared_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            self.backend_.synthesize(text, self.language, tmp_path, voice=voice, slow=slow)
+            os.replace(tmp_path, shared_path)
+            return shared_path
+        except Exception as e:
+            logging.exception(f"分句合成失败: {e}, text={text}")
+            return None
+    
+    def get_audio_info(self, audio_path: str) -> Optional[Dict]:
+        """返回 {'duration', 'sample_rate', 'channels', 'bitrate', 'frames'}，只解析 MP3 帧头，不解码"""
+        try:
+            stat = os.stat(audio_path)
+        except OSError:
+            return None
+        key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+        info = self.audio_info_.get(key)
+        if info is None:
+            info = probe_mp3(audio_path)
+            if info is not None:
+                self.audio_info_[key] = info
+        return info
+    
+    def encode_variants(self, audio_path: str, profiles) -> Dict[str, str]:
+        """
+        把 MP3 转成移动端档位（见 AUDIO_VARIANT_PROFILES），返回 {档位: 共享库中的路径}。
+        转码结果按 MP3 内容哈希放在共享库里，同样的音频只转一次；转码失败的档位不返回
+        """
+        with open(audio_path, 'rb') as f:
+            content_key = hashlib.md5(f.read()).hexdigest()
+        
+        variants = {}
+        for profile in profiles:
+            ext = AUDIO_VARIANT_PROFILES[profile]['ext']
+            variant_path = os.path.join(self.shared_dir_, "variants", content_key[:2], f"{content_key}.{ext}")
+            if not os.path.exists(variant_path):
+                os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+                if not transcode_audio(audio_path, variant_path, profile):
+                    continue
+            variants[profile] = variant_path
+        return variants
+    
+    def _shared_path(self, text: str, voice: str, slow: bool) -> str:
+        key_source = f"{text}|{self.language}|{voice}|{slow}"
+        if self.backend != 'google':
+            key_source += f"|{self.backend}"
+        key = hashlib.md5(key_source.encode('utf-8')).hexdigest()
+        return os.path.join(self.shared_dir_, key[:2], f"{key}.mp3")
+    
+    def _publish(self, audio_path: str, shared_path: str):
+        """把新合成的语音放入共享库；先链接到临时文件再 rename，其他会话不会读到写了一半的文件"""
+        if not os.path.exists(audio_path):
+            return
+        try:
+            os.makedirs(os.path.dirname(shared_path), exist_ok=True)
+            tmp_path = f"{shared_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            link_or_copy(audio_path, tmp_path)
+            os.replace(tmp_path, shared_path)
+        except Exception as e:
+            logging.error(f"写入共享语音库失败: {e}")
+    
     def generate_speech_for_scene(self, scene_text: str, scene_index: int, 
                                   voice_type: str = 'narrator') -> Optional[str]:
         output_path = os.path.join(self.cache_dir_, f"scene_{scene_index:04d}.mp3")
@@ -100,34 +356,38 @@ class TTSGenerator:
         
         if len(audio_segments) == 1:
             output_path = os.path.join(self.cache_dir_, f"scene_{scene_index:04d}.mp3")
-            shutil.copy(audio_segments[0], output_path)
+            return link_or_copy(audio_segments[0], output_path)
+        
+        output_path = os.path.join(self.cache_dir_, f"scene_{scene_index:04d}.mp3")
+        # 同规格的 MP3 直接按帧拼接并插入静音帧，耗时与总音频长度成正比，不解码也不重新编码
+        if concat_mp3(audio_segments, output_path, gap=DIALOGUE_GAP_SECONDS):
             return output_path
         
         try:
             from pydub import AudioSegment
             
-            combined = AudioSegment.empty()
+            # 规格不一致时才解码：统一采样参数后一次性拼接 PCM，避免逐段 += 反复复制整段缓冲区
+            segments = [AudioSegment.from_mp3(audio_file) for audio_file in audio_segments]
+            frame_rate = max(segment.frame_rate for segment in segments)
+            channels = max(segment.channels for segment in segments)
+            silence = AudioSegment.silent(duration=int(DIALOGUE_GAP_SECONDS * 1000), frame_rate=frame_rate)
+            parts = []
+            for segment in segments:
+                parts.append(segment)
+                parts.append(silence)
+            parts = [part.set_frame_rate(frame_rate).set_channels(channels).set_sample_width(2) for part in parts]
+            combined = parts[0]._spawn(b''.join(part.raw_data for part in parts))
             
-            for audio_file in audio_segments:
-                segment = AudioSegment.from_mp3(audio_file)
-                combined += segment
-                combined += AudioSegment.silent(duration=500)
-            
-            output_path = os.path.join(self.cache_dir_, f"scene_{scene_index:04d}.mp3")
+            # 旧文件可能是共享库的硬链接，先删除再导出，避免改写共享文件
+            if os.path.lexists(output_path):
+                os.remove(output_path)
             combined.export(output_path, format="mp3")
             
             return output_path
             
         except ImportError:
             logging.exception("警告: pydub未安装，使用简单拼接。安装pydub以获得更好的音频合成效果。")
-            
-            output_path = os.path.join(self.cache_dir_, f"scene_{scene_index:04d}.mp3")
-            shutil.copy(audio_segments[0], output_path)
-            return output_path
+            return link_or_copy(audio_segments[0], output_path)
         except Exception as e:
             logging.exception(f"合成多音轨失败: {e}")
-            if audio_segments:
-                output_path = os.path.join(self.cache_dir_, f"scene_{scene_index:04d}.mp3")
-                shutil.copy(audio_segments[0], output_path)
-                return output_path
-            return None
+            return link_or_copy(audio_segments[0], output_path)
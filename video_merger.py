@@ -1,17 +1,561 @@
 import os
+import json
+import time
+import math
+import struct
+import hashlib
+import shutil
 import logging
-from typing import List, Optional
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+from typing import List, Optional, Dict
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource，跳过内存限制
+    resource = None
+
+from PIL import Image, ImageOps
 from moviepy.editor import VideoFileClip, ImageClip, AudioFileClip, concatenate_videoclips, CompositeAudioClip
 
-from common import get_base_dir
+from common import get_base_dir, get_ffmpeg_exe
+from audio_utils import SilenceProvider
+from subtitles import build_cues, format_srt, format_webvtt
+
+
+# 没有旁白的分镜（文本为空或语音合成失败）按静音停留的时长
+SILENT_SCENE_SECONDS = 2.0
+
+# concat 合并时每个分镜片段的编码档位；同一次合并的片段参数必须一致，才能用 concat demuxer 直接拼接（-c copy）
+# - standard：通用参数，24fps
+# - still：分镜是静态图 + 旁白，预先缩放图片、2fps + 长 GOP + stillimage 调优；
+#   音频与旁白的 AAC 档位（narration.m4a）和 AAC 静音同规格，可以直接复制音频流
+SEGMENT_PROFILES = {
+    'standard': {
+        'size': (1792, 1024),
+        'fps': 24,
+        'video_args': ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p'],
+        'audio_args': ['-c:a', 'aac', '-b:a', '96k', '-ar', '44100', '-ac', '2'],
+        'copy_audio': False,
+        'bandwidth': 3000000,
+    },
+    'still': {
+        'size': (1344, 768),
+        'fps': 2,
+        'video_args': ['-c:v', 'libx264', '-preset', 'medium', '-tune', 'stillimage', '-pix_fmt', 'yuv420p',
+                       '-g', '120'],
+        'audio_args': ['-c:a', 'aac', '-b:a', '24k', '-ar', '24000', '-ac', '1'],
+        'copy_audio': True,
+        'bandwidth': 400000,
+    },
+    # 广场列表里的预览短片：与 still 同样的静态图调优，降低分辨率、画质和音频码率
+    'preview': {
+        'size': (448, 256),
+        'fps': 2,
+        'video_args': ['-c:v', 'libx264', '-preset', 'medium', '-tune', 'stillimage', '-pix_fmt', 'yuv420p',
+                       '-crf', '32', '-g', '120'],
+        'audio_args': ['-c:a', 'aac', '-b:a', '16k', '-ar', '16000', '-ac', '1'],
+        'copy_audio': False,
+        'bandwidth': 100000,
+    },
+}
+DEFAULT_SEGMENT_PROFILE = 'still'
+# 预览短片取开头几个分镜
+PREVIEW_PROFILE = 'preview'
+PREVIEW_SCENES = 3
+FFMPEG_TIMEOUT_SECONDS = 600
+
+# 并行编码片段：每个 ffmpeg 子进程的地址空间上限（RLIMIT_AS），超出时该片段编码失败而不是拖垮整机
+SEGMENT_WORKER_MEMORY_MB = 2048
+# 参与片段输入哈希的文件；哈希与片段旁的 .json 记录一致时直接复用已有片段
+SEGMENT_INPUT_FILES = ('scene.mp4', 'scene.png', 'narration.mp3', 'narration.m4a', 'metadata.json')
+
+# HLS 播放列表放在片段目录下，每个分镜片段流复制成一个 .ts 分片，字幕是同名的 .vtt；
+# 主列表把视频列表和字幕列表关联起来，客户端播放主列表即可开关字幕
+HLS_PLAYLIST_NAME = 'playlist.m3u8'
+HLS_SUBTITLE_PLAYLIST_NAME = 'subtitles.m3u8'
+HLS_MASTER_PLAYLIST_NAME = 'master.m3u8'
+SUBTITLE_LANGUAGE = 'zh'
+
+
+def mp4_duration(path: str) -> Optional[float]:
+    """从 moov/mvhd 读取 MP4 时长（秒），不调用 ffmpeg；解析失败返回 None"""
+    def find_box(f, end, box_type):
+        while f.tell() + 8 <= end:
+            start = f.tell()
+            size, name = struct.unpack('>I4s', f.read(8))
+            header = 8
+            if size == 1:
+                size = struct.unpack('>Q', f.read(8))[0]
+                header = 16
+            elif size == 0:
+                size = end - start
+            if size < header:
+                return None
+            if name == box_type:
+                return start + header, start + size
+            f.seek(start + size)
+        return None
+    
+    try:
+        with open(path, 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            f.seek(0)
+            moov = find_box(f, end, b'moov')
+            if not moov:
+                return None
+            f.seek(moov[0])
+            mvhd = find_box(f, moov[1], b'mvhd')
+            if not mvhd:
+                return None
+            f.seek(mvhd[0])
+            version = f.read(4)[0]
+            if version == 1:
+                timescale, duration = struct.unpack('>16xIQ', f.read(28))
+            else:
+                timescale, duration = struct.unpack('>8xII', f.read(16))
+            return duration / timescale if timescale else None
+    except (OSError, struct.error, IndexError):
+        return None
+
+
+def ts_start_pts(path: str) -> Optional[int]:
+    """MPEG-TS 分片中第一个 PES 的 PTS（90kHz），字幕的 X-TIMESTAMP-MAP 需要它来对齐"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(188 * 200)
+    except OSError:
+        return None
+    for i in range(0, len(data) - 187, 188):
+        packet = data[i:i + 188]
+        if packet[0] != 0x47 or not packet[1] & 0x40:
+            continue
+        offset = 4
+        if (packet[3] >> 4) & 0x2:
+            offset += 1 + packet[4]
+        pes = packet[offset:]
+        # PES 起始码 + PTS 标志（跳过 PAT/PMT 等 PSI 表）
+        if len(pes) >= 14 and pes[:3] == b'\x00\x00\x01' and pes[7] & 0x80:
+            b = pes[9:14]
+            return ((b[0] >> 1) & 0x7) << 30 | b[1] << 22 | (b[2] >> 1) << 15 | b[3] << 7 | b[4] >> 1
+    return None
+
+
+def write_hls_playlist(playlist_path: str, entries: List, ended: bool):
+    """
+    entries: [(分片文件名, 时长)]。每个分镜独立编码、时间戳都从 0 开始，分片之间加 DISCONTINUITY；
+    未结束时为 EVENT 列表（只追加），结束时写 ENDLIST。先写临时文件再替换，播放器不会读到半个列表
+    """
+    target = max([math.ceil(duration) for _, duration in entries] or [1])
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{target}', '#EXT-X-MEDIA-SEQUENCE:0',
+             f"#EXT-X-PLAYLIST-TYPE:{'VOD' if ended else 'EVENT'}"]
+    for i, (name, duration) in enumerate(entries):
+        if i:
+            lines.append('#EXT-X-DISCONTINUITY')
+        lines += [f'#EXTINF:{duration:.3f},', name]
+    if ended:
+        lines.append('#EXT-X-ENDLIST')
+    
+    _write_text(playlist_path, "\n".join(lines) + "\n")
+
+
+def write_hls_master_playlist(segment_dir: str, bandwidth: int):
+    """主列表：视频列表 + 中文字幕列表（SUBTITLES 组）"""
+    _write_text(os.path.join(segment_dir, HLS_MASTER_PLAYLIST_NAME), "\n".join([
+        '#EXTM3U',
+        f'#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="中文",LANGUAGE="{SUBTITLE_LANGUAGE}",'
+        f'DEFAULT=YES,AUTOSELECT=YES,URI="{HLS_SUBTITLE_PLAYLIST_NAME}"',
+        f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},SUBTITLES="subs"',
+        HLS_PLAYLIST_NAME,
+    ]) + "\n")
+
+
+def write_hls_playlists(segment_dir: str, entries: List, ended: bool):
+    """entries: [(分片文件名, 时长, 字幕文件名)]，同时写视频和字幕的媒体列表，二者分片一一对应"""
+    write_hls_playlist(os.path.join(segment_dir, HLS_PLAYLIST_NAME),
+                       [(ts_name, duration) for ts_name, duration, _ in entries], ended)
+    write_hls_playlist(os.path.join(segment_dir, HLS_SUBTITLE_PLAYLIST_NAME),
+                       [(vtt_name, duration) for _, duration, vtt_name in entries], ended)
+
+
+def _write_text(path: str, content: str):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+class HlsPlaylist:
+    """
+    生成过程中逐步发布的 HLS 播放列表：分镜乱序完成，但列表只能追加，
+    所以只发布从头开始连续就绪的分镜（失败的分镜跳过），finish() 后写 ENDLIST
+    """
+    
+    def __init__(self, segment_dir: str, total: int,
+                 bandwidth: int = SEGMENT_PROFILES[DEFAULT_SEGMENT_PROFILE]['bandwidth']):
+        self.segment_dir = segment_dir
+        os.makedirs(segment_dir, exist_ok=True)
+        write_hls_master_playlist(segment_dir, bandwidth)
+        # None：未完成；False：跳过；(分片文件名, 时长, 字幕文件名)：就绪
+        self.entries_ = [None] * total
+        self.published_ = 0
+        self.ended_ = False
+        self.lock_ = threading.Lock()
+    
+    def mark_ready(self, index: int, ts_name: str, duration: float, vtt_name: str):
+        self._resolve(index, (ts_name, duration, vtt_name))
+    
+    def mark_skipped(self, index: int):
+        self._resolve(index, False)
+    
+    def finish(self):
+        with self.lock_:
+            self.entries_ = [entry if entry is not None else False for entry in self.entries_]
+            self.ended_ = True
+            self._publish()
+    
+    def _resolve(self, index: int, entry):
+        with self.lock_:
+            if self.ended_ or self.entries_[index] is not None:
+                return
+            self.entries_[index] = entry
+            self._publish()
+    
+    def _publish(self):
+        ready = 0
+        while ready < len(self.entries_) and self.entries_[ready] is not None:
+            ready += 1
+        if ready == self.published_ and not self.ended_:
+            return
+        self.published_ = ready
+        write_hls_playlists(self.segment_dir, [entry for entry in self.entries_[:ready] if entry], self.ended_)
 
 
 class VideoMerger:
-    def __init__(self):
+    def __init__(self, profile: str = DEFAULT_SEGMENT_PROFILE, max_workers: int = None,
+                 worker_memory_mb: int = SEGMENT_WORKER_MEMORY_MB, hls: bool = False):
+        if profile not in SEGMENT_PROFILES:
+            raise ValueError(f"不支持的片段编码档位: {profile}")
+        self.profile = profile
+        # 片段编码在独立的 ffmpeg 进程里进行，线程池只负责等待子进程；
+        # 进程数按 CPU 核数，每个进程分到的编码线程数 = 核数 / 进程数
+        cpu_count = os.cpu_count() or 1
+        self.max_workers = max(1, max_workers or cpu_count)
+        self.ffmpeg_threads_ = max(1, cpu_count // self.max_workers)
+        self.worker_memory_mb = worker_memory_mb
+        # hls=True 时每个片段额外流复制出 .ts 分片，合并时在片段目录写 playlist.m3u8
+        self.hls = hls
+        self.executor_ = None
+        self.executor_lock_ = threading.Lock()
+        self.pending_ = {}
         self.temp_dir_ = os.path.join(get_base_dir(), "temp_videos")
         os.makedirs(self.temp_dir_, exist_ok=True)
+        self.silence_ = SilenceProvider()
+        # 最近一次 concat 合并的统计：每个片段的大小、CPU 时间、耗时，用于对比编码档位
+        self.last_report_ = None
+    
+    def merge_scene_videos(self, scene_folders: List[str], output_path: str, method: str = "concat",
+                           segment_dir: str = None) -> bool:
+        """
+        method='concat'：每个分镜并行编码成参数一致的片段，再用 ffmpeg concat demuxer 流复制拼接，
+        合并耗时主要是 I/O；失败时退回 method='compose'（moviepy 整体重新编码）
+        segment_dir：任务自己的片段目录，片段保留下来供下次合并复用；不传时用临时目录，合并后删除
+        """
+        if method == "concat":
+            if self._merge_with_concat(scene_folders, output_path, segment_dir):
+                return True
+            logging.error("concat 合并失败，改用 moviepy 合并")
+        return self._merge_with_moviepy(scene_folders, output_path)
+    
+    def create_preview(self, scene_folders: List[str], output_path: str, max_scenes: int = PREVIEW_SCENES) -> bool:
+        """
+        开头 max_scenes 个分镜拼成的短片，档位由构造参数决定（一般用 PREVIEW_PROFILE）；
+        只走 concat，失败时不退回 moviepy，避免为了预览整体重新编码
+        """
+        return self._merge_with_concat(scene_folders[:max_scenes], output_path)
+    
+    def get_last_report(self) -> Optional[Dict]:
+        return self.last_report_
     
-    def merge_scene_videos(self, scene_folders: List[str], output_path: str) -> bool:
+    def encode_segments(self, scene_folders: List[str], segment_dir: str) -> List[Optional[Dict]]:
+        """并行准备所有分镜的片段，按分镜顺序返回报告，失败的为 None"""
+        futures = [self.submit_segment(scene_folder, segment_dir) for scene_folder in scene_folders]
+        return [future.result() for future in futures]
+    
+    def submit_segment(self, scene_folder: str, segment_dir: str) -> concurrent.futures.Future:
+        """把一个分镜提交到后台编码池；分镜生成完成时即可调用，合并时命中已编码的片段"""
+        os.makedirs(segment_dir, exist_ok=True)
+        segment_path = self.segment_path(segment_dir, scene_folder)
+        with self.executor_lock_:
+            # 同一片段正在编码时复用该任务，不重复启动 ffmpeg
+            pending = self.pending_.get(segment_path)
+            if pending and not pending.done():
+                return pending
+            if self.executor_ is None:
+                self.executor_ = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                                       thread_name_prefix='segment-encode')
+            future = self.executor_.submit(self.prepare_segment, scene_folder, segment_path)
+            self.pending_[segment_path] = future
+        future.add_done_callback(lambda f: self._forget_pending(segment_path, f))
+        return future
+    
+    def _forget_pending(self, segment_path: str, future: concurrent.futures.Future):
+        with self.executor_lock_:
+            if self.pending_.get(segment_path) is future:
+                del self.pending_[segment_path]
+    
+    def shutdown(self, wait: bool = True):
+        with self.executor_lock_:
+            executor, self.executor_ = self.executor_, None
+        if executor:
+            executor.shutdown(wait=wait)
+    
+    @staticmethod
+    def segment_path(segment_dir: str, scene_folder: str) -> str:
+        """片段按分镜目录名命名（scene_0003.mp4），与分镜在合并列表中的位置无关，后台预编码和合并时路径一致"""
+        return os.path.join(segment_dir, f"{os.path.basename(os.path.normpath(scene_folder))}.mp4")
+    
+    def prepare_segment(self, scene_folder: str, segment_path: str) -> Optional[Dict]:
+        """片段已存在且输入哈希一致时直接复用，否则重新编码；编码先写临时文件再替换，避免留下半截片段"""
+        input_hash = self._segment_input_hash(scene_folder)
+        record_path = f"{segment_path}.json"
+        try:
+            with open(record_path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+            if record.get('input_hash') == input_hash and os.path.exists(segment_path):
+                report = dict(record['report'], cpu_seconds=0.0, wall_seconds=0.0, reused=True)
+                return self._finish_segment(scene_folder, segment_path, report)
+        except (OSError, ValueError, KeyError):
+            pass
+        
+        temp_path = f"{segment_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        report = self._encode_scene_segment(scene_folder, temp_path)
+        if not report:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+        os.replace(temp_path, segment_path)
+        
+        report['reused'] = False
+        report['duration'] = mp4_duration(segment_path)
+        temp_record_path = f"{record_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_record_path, 'w', encoding='utf-8') as f:
+                json.dump({'input_hash': input_hash, 'report': report}, f, ensure_ascii=False)
+            os.replace(temp_record_path, record_path)
+        except OSError as e:
+            logging.warning(f"写入片段记录失败 ({record_path}): {e}")
+        return self._finish_segment(scene_folder, segment_path, report)
+    
+    def _finish_segment(self, scene_folder: str, segment_path: str, report: Dict) -> Dict:
+        if report.get('duration') is None:
+            report['duration'] = mp4_duration(segment_path)
+        report['text'] = self._read_scene_text(scene_folder)
+        if self.hls:
+            report['ts'] = self._remux_to_ts(segment_path)
+            if report['ts'] and report['duration']:
+                report['vtt'] = self._write_segment_vtt(segment_path, report)
+        return report
+    
+    def _write_segment_vtt(self, segment_path: str, report: Dict) -> str:
+        """分片对应的字幕：时间从分片开头算起，X-TIMESTAMP-MAP 对齐分片的起始 PTS"""
+        vtt_path = segment_path[:-len('.mp4')] + '.vtt'
+        ts_path = os.path.join(os.path.dirname(segment_path), report['ts'])
+        cues = build_cues([(report['text'], report['duration'])])
+        _write_text(vtt_path, format_webvtt(cues, ts_start_pts(ts_path)))
+        return os.path.basename(vtt_path)
+    
+    def _remux_to_ts(self, segment_path: str) -> Optional[str]:
+        """片段流复制成 MPEG-TS 分片，返回分片文件名；分片比片段新时直接复用"""
+        ts_path = segment_path[:-len('.mp4')] + '.ts'
+        if os.path.exists(ts_path) and os.path.getmtime(ts_path) >= os.path.getmtime(segment_path):
+            return os.path.basename(ts_path)
+        
+        temp_path = f"{ts_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            self._run_ffmpeg(['-i', segment_path, '-c', 'copy', '-f', 'mpegts', temp_path])
+            os.replace(temp_path, ts_path)
+            return os.path.basename(ts_path)
+        except Exception as e:
+            logging.error(f"生成 HLS 分片失败 ({segment_path}): {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+    
+    def _segment_input_hash(self, scene_folder: str) -> str:
+        """编码档位 + 分镜输入文件内容的 md5"""
+        digest = hashlib.md5(json.dumps([self.profile, SEGMENT_PROFILES[self.profile], SILENT_SCENE_SECONDS],
+                                        sort_keys=True).encode('utf-8'))
+        for name in SEGMENT_INPUT_FILES:
+            path = os.path.join(scene_folder, name)
+            if not os.path.exists(path):
+                continue
+            digest.update(name.encode('utf-8'))
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+    
+    def _merge_with_concat(self, scene_folders: List[str], output_path: str, segment_dir: str = None) -> bool:
+        work_dir = segment_dir or tempfile.mkdtemp(dir=self.temp_dir_)
+        started = time.time()
+        try:
+            reports = self.encode_segments(scene_folders, work_dir)
+            segments = [self.segment_path(work_dir, scene_folder)
+                        for scene_folder, report in zip(scene_folders, reports) if report]
+            segment_reports = [report for report in reports if report]
+            
+            if not segments:
+                logging.error("没有可合并的视频片段")
+                return False
+            
+            list_path = os.path.join(work_dir, "segments.txt")
+            with open(list_path, 'w', encoding='utf-8') as f:
+                for segment_path in segments:
+                    escaped = segment_path.replace("'", "'\\''")
+                    f.write(f"file '{escaped}'\n")
+            
+            # 字幕作为软字幕流（mov_text）封装进 MP4，不需要把文字烧进画面重新编码
+            subtitle_input, subtitle_args = [], []
+            subtitle_path = self._write_subtitles(work_dir, segment_reports)
+            if subtitle_path:
+                subtitle_input = ['-i', subtitle_path, '-map', '0:v', '-map', '0:a', '-map', '1:s']
+                subtitle_args = ['-c:s', 'mov_text', '-metadata:s:s:0', 'language=chi']
+            self._run_ffmpeg(['-f', 'concat', '-safe', '0', '-i', list_path] + subtitle_input +
+                             ['-c', 'copy'] + subtitle_args + ['-movflags', '+faststart', output_path])
+            
+            if self.hls and segment_dir:
+                write_hls_master_playlist(segment_dir, SEGMENT_PROFILES[self.profile]['bandwidth'])
+                write_hls_playlists(segment_dir, [(report['ts'], report['duration'], report['vtt'])
+                                                  for report in segment_reports if report.get('vtt')], ended=True)
+            
+            self.last_report_ = self._build_report(segment_reports, output_path, time.time() - started)
+            reused = sum(1 for report in segment_reports if report.get('reused'))
+            logging.info(f"视频合并完成: {output_path}（{len(segments)} 个片段，复用 {reused} 个，档位 {self.profile}，"
+                         f"片段共 {self.last_report_['segment_bytes']} 字节，"
+                         f"编码 CPU {self.last_report_['cpu_seconds']:.1f}s，总耗时 {self.last_report_['wall_seconds']:.1f}s）")
+            return True
+        except Exception as e:
+            logging.exception(f"concat 合并失败: {e}")
+            return False
+        finally:
+            if segment_dir is None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    
+    def _build_report(self, segment_reports: List[Dict], output_path: str, wall_seconds: float) -> Dict:
+        cpu_values = [report['cpu_seconds'] for report in segment_reports if report['cpu_seconds'] is not None]
+        return {
+            'profile': self.profile,
+            'segments': segment_reports,
+            'segment_bytes': sum(report['bytes'] for report in segment_reports),
+            'output_bytes': os.path.getsize(output_path) if os.path.exists(output_path) else 0,
+            'cpu_seconds': sum(cpu_values),
+            'wall_seconds': wall_seconds,
+        }
+    
+    def _encode_scene_segment(self, scene_folder: str, segment_path: str) -> Optional[Dict]:
+        """
+        把一个分镜编码成当前档位的片段：已有 scene.mp4 的转成统一参数，否则用图片 + 旁白（或静音）生成。
+        返回 {'scene', 'bytes', 'cpu_seconds', 'wall_seconds', 'audio_copied'}，失败返回 None
+        """
+        settings = SEGMENT_PROFILES[self.profile]
+        width, height = settings['size']
+        video_path = os.path.join(scene_folder, 'scene.mp4')
+        image_path = os.path.join(scene_folder, 'scene.png')
+        scaled_path = f"{segment_path}.png"
+        
+        try:
+            audio_copied = False
+            if os.path.exists(video_path):
+                scale_filter = (f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                                f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1")
+                args = ['-i', video_path, '-vf', scale_filter, '-r', str(settings['fps'])] + settings['audio_args']
+            elif os.path.exists(image_path):
+                # 图片只缩放一次，不让 ffmpeg 对每一帧做缩放
+                with Image.open(image_path) as img:
+                    ImageOps.pad(img.convert('RGB'), (width, height), color=(0, 0, 0)).save(scaled_path)
+                
+                audio_path, duration, audio_copied = self._segment_audio(scene_folder, settings)
+                args = ['-loop', '1', '-framerate', str(settings['fps']), '-i', scaled_path, '-i', audio_path,
+                        '-map', '0:v', '-map', '1:a', '-r', str(settings['fps'])]
+                args += ['-c:a', 'copy'] if audio_copied else settings['audio_args']
+                args += ['-t', str(duration)] if duration else ['-shortest']
+            else:
+                return None
+            
+            usage = self._run_ffmpeg(args + settings['video_args'] + ['-threads', str(self.ffmpeg_threads_),
+                                                                       '-f', 'mp4', segment_path])
+            return {
+                'scene': os.path.basename(scene_folder),
+                'bytes': os.path.getsize(segment_path),
+                'cpu_seconds': usage['cpu_seconds'],
+                'wall_seconds': usage['wall_seconds'],
+                'audio_copied': audio_copied,
+            }
+        except Exception as e:
+            logging.exception(f"编码分镜片段失败 ({scene_folder}): {e}")
+            return None
+        finally:
+            if os.path.exists(scaled_path):
+                os.remove(scaled_path)
+    
+    def _segment_audio(self, scene_folder: str, settings: Dict):
+        """返回 (音频路径, 时长, 是否直接复制音频流)"""
+        audio_path = os.path.join(scene_folder, 'narration.mp3')
+        aac_path = os.path.join(scene_folder, 'narration.m4a')
+        
+        if not os.path.exists(audio_path):
+            if settings['copy_audio']:
+                return self.silence_.aac(SILENT_SCENE_SECONDS), SILENT_SCENE_SECONDS, True
+            return self.silence_.mp3(SILENT_SCENE_SECONDS), SILENT_SCENE_SECONDS, False
+        
+        duration = self._read_audio_duration(scene_folder)
+        if settings['copy_audio'] and os.path.exists(aac_path):
+            return aac_path, duration, True
+        return audio_path, duration, False
+    
+    def _run_ffmpeg(self, args: List[str]) -> Dict:
+        """运行 ffmpeg，返回 {'cpu_seconds', 'wall_seconds'}；CPU 时间来自 wait4 的 rusage，不支持的平台为 None"""
+        started = time.time()
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen([get_ffmpeg_exe(), '-y', '-loglevel', 'error'] + args,
+                                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr)
+            self._limit_memory(process.pid)
+            timer = threading.Timer(FFMPEG_TIMEOUT_SECONDS, process.kill)
+            timer.start()
+            try:
+                if hasattr(os, 'wait4'):
+                    _, status, rusage = os.wait4(process.pid, 0)
+                    process.returncode = os.waitstatus_to_exitcode(status)
+                    cpu_seconds = rusage.ru_utime + rusage.ru_stime
+                else:
+                    process.wait()
+                    cpu_seconds = None
+            finally:
+                timer.cancel()
+            
+            if process.returncode != 0:
+                stderr.seek(0)
+                raise RuntimeError(stderr.read().decode('utf-8', errors='replace').strip()
+                                   or f"ffmpeg 退出码 {process.returncode}")
+        return {'cpu_seconds': cpu_seconds, 'wall_seconds': time.time() - started}
+    
+    def _limit_memory(self, pid: int):
+        """
+        子进程启动后用 prlimit 设置地址空间上限；不用 preexec_fn，
+        因为片段是多线程并发启动的，preexec_fn 在多线程进程里 fork 后可能死锁
+        """
+        if not self.worker_memory_mb or resource is None or not hasattr(resource, 'prlimit'):
+            return
+        limit = self.worker_memory_mb * 1024 * 1024
+        try:
+            resource.prlimit(pid, resource.RLIMIT_AS, (limit, limit))
+        except (OSError, ValueError) as e:
+            logging.debug(f"设置 ffmpeg 内存上限失败: {e}")
+    
+    def _merge_with_moviepy(self, scene_folders: List[str], output_path: str) -> bool:
         try:
             video_clips = []
             
@@ -26,7 +570,14 @@ class VideoMerger:
                     audio_path = os.path.join(scene_folder, 'narration.mp3')
                     
                     if os.path.exists(image_path) and os.path.exists(audio_path):
-                        clip = self._create_video_from_image_audio(image_path, audio_path)
+                        clip = self._create_video_from_image_audio(image_path, audio_path,
+                                                                   self._read_audio_duration(scene_folder))
+                        if clip:
+                            video_clips.append(clip)
+                    elif os.path.exists(image_path):
+                        # 没有旁白的分镜也保留画面，用预编码的静音填充，不再被整段跳过
+                        clip = self._create_video_from_image_audio(image_path, self.silence_.mp3(SILENT_SCENE_SECONDS),
+                                                                   SILENT_SCENE_SECONDS)
                         if clip:
                             video_clips.append(clip)
             
@@ -56,10 +607,39 @@ class VideoMerger:
             logging.exception(f"视频合并失败: {e}")
             return False
     
-    def _create_video_from_image_audio(self, image_path: str, audio_path: str) -> Optional[VideoFileClip]:
+    def _write_subtitles(self, work_dir: str, segment_reports: List[Dict]) -> Optional[str]:
+        """按片段时长把各分镜文本排到合并后的时间轴上，写 subtitles.srt / subtitles.vtt，返回 SRT 路径"""
+        if any(not report.get('duration') for report in segment_reports):
+            return None
+        cues = build_cues([(report.get('text', ''), report['duration']) for report in segment_reports])
+        if not cues:
+            return None
+        srt_path = os.path.join(work_dir, 'subtitles.srt')
+        _write_text(srt_path, format_srt(cues))
+        _write_text(os.path.join(work_dir, 'subtitles.vtt'), format_webvtt(cues))
+        return srt_path
+    
+    def _read_scene_text(self, scene_folder: str) -> str:
+        try:
+            with open(os.path.join(scene_folder, 'metadata.json'), 'r', encoding='utf-8') as f:
+                return json.load(f).get('text') or ''
+        except (OSError, ValueError):
+            return ''
+    
+    def _read_audio_duration(self, scene_folder: str) -> Optional[float]:
+        """合成语音时已把时长写入 metadata.json，读不到时返回 None"""
+        try:
+            with open(os.path.join(scene_folder, 'metadata.json'), 'r', encoding='utf-8') as f:
+                return json.load(f).get('audio_duration')
+        except (OSError, ValueError):
+            return None
+    
+    def _create_video_from_image_audio(self, image_path: str, audio_path: str,
+                                       duration: float = None) -> Optional[VideoFileClip]:
         try:
             audio = AudioFileClip(audio_path)
-            duration = audio.duration
+            if duration is None:
+                duration = audio.duration
             
             image_clip = ImageClip(image_path).set_duration(duration)
             
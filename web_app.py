@@ -4,12 +4,17 @@ import json
 import logging
 import threading
 import uuid
+import concurrent.futures
 from functools import wraps
 from gevent.pywsgi import WSGIServer
 
 from werkzeug.utils import secure_filename
 from anime_generator import AnimeGenerator
-from video_merger import VideoMerger
+from tts_generator import TTS_BACKENDS
+from audio_utils import probe_mp3, DEFAULT_AUDIO_VARIANTS
+from video_merger import VideoMerger, HLS_PLAYLIST_NAME, HLS_MASTER_PLAYLIST_NAME, SILENT_SCENE_SECONDS, PREVIEW_PROFILE
+from subtitles import build_cues
+from storage_manager import StorageManager
 
 from common import get_base_dir
 from flask import Flask, render_template, request, jsonify, send_from_directory, session, redirect, url_for, send_file
@@ -18,6 +23,13 @@ from statistics_db import insert_statistics, update_generation_stats, get_statis
 from user_auth import register_user, login_user, get_user_by_id, get_user_video_count, increment_user_video_count
 
 
+# 同时进行的视频合并任务数；片段编码本身已按 CPU 核数并行，这里只限制排队的合并任务
+MERGE_WORKERS = 2
+# 生成过程中每个分镜完成后即在后台编码视频片段：下载时只需流复制拼接，并提供边生成边播放的 HLS。
+# 设为 0 时不预编码，播放只走 /api/timeline，视频在下载时才合并（节省 CPU）
+PREENCODE_SEGMENTS = os.getenv('PREENCODE_SEGMENTS', '1') == '1'
+
+
 class FlaskAppWrapper:
     def __init__(self, name, port=5000):
         self.app_ = Flask(name, static_folder='static', template_folder='templates')
@@ -32,6 +44,19 @@ class FlaskAppWrapper:
         
         os.makedirs(self.upload_folder_, exist_ok=True)
         self.generation_status_ = {}
+        # 视频合并任务：task_id -> 状态；同一 task_id 同时只有一个合并在跑，并发的下载请求共享它
+        self.merge_jobs_ = {}
+        self.merge_jobs_lock_ = threading.Lock()
+        self.merge_executor_ = concurrent.futures.ThreadPoolExecutor(max_workers=MERGE_WORKERS,
+                                                                     thread_name_prefix='video-merge')
+        # 广场预览短片：共享时生成，单线程排队，不占用下载合并的名额；
+        # preview_jobs_ 是排队中的 session_id，preview_failed_ 是生成失败的，进程重启前不再重试
+        self.preview_jobs_ = set()
+        self.preview_failed_ = set()
+        self.preview_executor_ = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                       thread_name_prefix='preview-encode')
+        # 生成产物的配额与淘汰；后台线程在 main() 里启动
+        self.storage_manager_ = StorageManager(is_active=self._is_task_active)
         
         self._register_routes()
         logging.info(f"Flask is started on http://127.0.0.1:{self.port_}")
@@ -52,11 +77,18 @@ class FlaskAppWrapper:
         self.app_.add_url_rule('/api/upload', view_func=self.upload_novel, methods=['POST'])
         self.app_.add_url_rule('/api/status/<task_id>', view_func=self.get_status, methods=['GET'])
         self.app_.add_url_rule('/api/scenes/<task_id>', view_func=self.get_scenes, methods=['GET'])
+        self.app_.add_url_rule('/api/timeline/<task_id>', view_func=self.get_timeline, methods=['GET'])
         self.app_.add_url_rule('/api/file/<path:filepath>', view_func=self.serve_file, methods=['GET'])
-        self.app_.add_url_rule('/api/download/<task_id>', view_func=self.download_content, methods=['GET'])
+        # 下载会触发服务端合并视频，只对登录用户开放；合并状态与下载同样需要登录
+        self.app_.add_url_rule('/api/download/<task_id>', view_func=self._login_required(self.download_content), methods=['GET'])
+        self.app_.add_url_rule('/api/download_status/<task_id>', view_func=self._login_required(self.get_download_status),
+                               methods=['GET'])
+        self.app_.add_url_rule('/api/hls/<task_id>/<filename>', view_func=self.serve_hls, methods=['GET'])
+        self.app_.add_url_rule('/api/storage', view_func=self._login_required(self.get_storage_usage), methods=['GET'])
         self.app_.add_url_rule('/api/delete_history/<session_id>', view_func=self.delete_history, methods=['DELETE'])
         self.app_.add_url_rule('/api/share/<session_id>', view_func=self.share_history, methods=['POST'])
         self.app_.add_url_rule('/api/shared_records', view_func=self.get_shared_records_api, methods=['GET'])
+        self.app_.add_url_rule('/api/preview/<session_id>', view_func=self.serve_preview, methods=['GET'])
         self.app_.add_url_rule('/get_apk', view_func=self.get_apk, methods=['GET'])
 
     def get_apk(self):
@@ -73,7 +105,7 @@ class FlaskAppWrapper:
             return f(*args, **kwargs)
         return decorated_function
     
-    def _generate_anime_async(self, task_id, novel_path, max_scenes, api_key, provider='qiniu', custom_prompt=None, use_ai_analysis=True, use_storyboard=True, user_id=None):
+    def _generate_anime_async(self, task_id, novel_path, max_scenes, api_key, provider='qiniu', custom_prompt=None, use_ai_analysis=True, use_storyboard=True, user_id=None, tts_backend='google'):
         def update_status(progress, message):
             self.generation_status_[task_id] = {
                 'status': 'processing',
@@ -81,6 +113,7 @@ class FlaskAppWrapper:
                 'message': message
             }
         
+        generator = None
         try:
             update_status(0, '正在解析小说...')
             
@@ -89,7 +122,10 @@ class FlaskAppWrapper:
                 provider=provider, 
                 custom_prompt=custom_prompt, 
                 use_ai_analysis=use_ai_analysis,
-                session_id=task_id
+                session_id=task_id,
+                tts_backend=tts_backend,
+                audio_variants=DEFAULT_AUDIO_VARIANTS,
+                segment_dir=self._segment_dir(task_id) if PREENCODE_SEGMENTS else None
             )
             
             update_status(5, '开始分析小说内容...')
@@ -128,6 +164,9 @@ class FlaskAppWrapper:
                 'progress': 0,
                 'message': str(e)
             }
+        finally:
+            if generator:
+                generator.close()
     
     def index(self):
         return redirect(url_for('square_page'))
@@ -212,14 +251,76 @@ class FlaskAppWrapper:
         success, message = share_record(session_id, username)
         
         if success:
+            self._submit_preview_job(session_id)
             return jsonify({'message': message}), 200
         else:
             return jsonify({'error': message}), 400
     
     def get_shared_records_api(self):
         records = get_shared_records(limit=50)
+        for record in records:
+            # 预览还没生成好（或已被存储清理删掉）时不给地址，并在后台补上
+            if os.path.exists(self._preview_path(record['session_id'])):
+                record['preview_url'] = f"/api/preview/{record['session_id']}"
+            else:
+                record['preview_url'] = None
+                self._submit_preview_job(record['session_id'], record.get('metadata'))
         return jsonify({'records': records}), 200
     
+    def serve_preview(self, session_id):
+        preview_path = self._preview_path(session_id)
+        if not os.path.exists(preview_path):
+            return jsonify({'error': '预览尚未生成'}), 404
+        self.storage_manager_.touch(preview_path)
+        return send_file(preview_path, mimetype='video/mp4', conditional=True)
+    
+    def _submit_preview_job(self, session_id, metadata=None):
+        with self.merge_jobs_lock_:
+            if session_id in self.preview_jobs_ or session_id in self.preview_failed_:
+                return
+            self.preview_jobs_.add(session_id)
+        self.preview_executor_.submit(self._create_preview_async, session_id, metadata)
+    
+    def _create_preview_async(self, session_id, metadata=None):
+        preview_path = self._preview_path(session_id)
+        partial_path = preview_path[:-len('.mp4')] + '.partial.mp4'
+        success = False
+        try:
+            if os.path.exists(preview_path):
+                success = True
+                return
+            if metadata is None:
+                db_record = get_statistics(session_id=session_id)
+                metadata = db_record.get('metadata') if db_record else None
+            if not metadata:
+                return
+            if isinstance(metadata, str):
+                metadata = json.loads(metadata)
+            
+            scene_folders = [scene_info['folder'] for scene_info in metadata.get('scenes', [])]
+            if not scene_folders:
+                return
+            
+            merger = VideoMerger(profile=PREVIEW_PROFILE)
+            try:
+                success = merger.create_preview(scene_folders, partial_path)
+            finally:
+                merger.shutdown()
+            if success:
+                os.replace(partial_path, preview_path)
+                logging.info(f"预览短片已生成 ({session_id}): {os.path.getsize(preview_path)} 字节")
+            else:
+                logging.error(f"预览短片生成失败 ({session_id})")
+        except Exception as e:
+            logging.exception(f"预览短片生成失败 ({session_id}): {e}")
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            with self.merge_jobs_lock_:
+                self.preview_jobs_.discard(session_id)
+                if not success:
+                    self.preview_failed_.add(session_id)
+    
     def check_payment(self):
         if 'user_id' not in session:
             return jsonify({'error': '请先登录'}), 401
@@ -289,17 +390,24 @@ class FlaskAppWrapper:
             custom_prompt = request.form.get('custom_prompt', '')
             use_ai_analysis = request.form.get('use_ai_analysis', 'true').lower() == 'true'
             use_storyboard = request.form.get('use_storyboard', 'true').lower() == 'true'
+            tts_backend = request.form.get('tts_backend', 'google')
+            if tts_backend not in TTS_BACKENDS:
+                return jsonify({'error': f'不支持的语音后端: {tts_backend}'}), 400
             
             if not api_key:
                 api_key = os.getenv('OPENAI_API_KEY')
             
+            # local 为离线占位图后端，用于压测，不需要 API Key
+            if not api_key and provider == 'local':
+                api_key = 'local'
+            
             if not api_key:
                 return jsonify({'error': '需要提供 API Key'}), 400
             
             user_id = session.get('user_id')
             thread = threading.Thread(
                 target=self._generate_anime_async,
-                args=(task_id, file_path, max_scenes, api_key, provider, custom_prompt, use_ai_analysis, use_storyboard, user_id)
+                args=(task_id, file_path, max_scenes, api_key, provider, custom_prompt, use_ai_analysis, use_storyboard, user_id, tts_backend)
             )
             thread.start()
             
@@ -314,26 +422,83 @@ class FlaskAppWrapper:
         if task_id not in self.generation_status_:
             return jsonify({'error': '任务不存在'}), 404
         
-        return jsonify(self.generation_status_[task_id])
+        status = dict(self.generation_status_[task_id])
+        # 生成过程中就有第一个片段时即可通过 HLS 边生成边播放
+        if os.path.exists(os.path.join(self._segment_dir(task_id), HLS_PLAYLIST_NAME)):
+            status['hls_url'] = f'/api/hls/{task_id}/{HLS_MASTER_PLAYLIST_NAME}'
+        return jsonify(status)
     
     def get_scenes(self, task_id):
+        scenes, error = self._load_scenes(task_id)
+        if error:
+            return error
+        
+        return jsonify({
+            'total_scenes': len(scenes),
+            'scenes': scenes
+        })
+    
+    def get_timeline(self, task_id):
+        """
+        播放清单：按顺序给出每个分镜在时间轴上的起点、时长、图片、音频和字幕，
+        前端据此预取下一分镜并无缝切换，不需要服务端先合并视频
+        """
+        scenes, error = self._load_scenes(task_id)
+        if error:
+            return error
+        
+        timeline = []
+        start = 0.0
+        for index, scene_data in enumerate(scenes):
+            has_audio = bool(scene_data['audio_variants'])
+            # 没有配音的分镜按合并视频里的静音时长展示
+            duration = scene_data.get('audio_duration') if has_audio else None
+            duration = duration or SILENT_SCENE_SECONDS
+            text = scene_data.get('text') or ''
+            timeline.append({
+                'index': index,
+                'start': round(start, 3),
+                'duration': round(duration, 3),
+                'image_url': scene_data['image_url'],
+                'audio_url': scene_data['audio_url'] if has_audio else None,
+                'audio_variants': scene_data['audio_variants'],
+                'text': text,
+                # 字幕时间从本分镜开头算起
+                'subtitles': [{'start': round(cue_start, 3), 'end': round(cue_end, 3), 'text': cue_text}
+                              for cue_start, cue_end, cue_text in build_cues([(text, duration)])],
+                'shot_type': scene_data.get('shot_type'),
+                'mood': scene_data.get('mood'),
+                'characters': scene_data.get('characters', [])
+            })
+            start += duration
+        
+        return jsonify({
+            'task_id': task_id,
+            'total_scenes': len(timeline),
+            'total_duration': round(start, 3),
+            'scenes': timeline
+        })
+    
+    def _load_scenes(self, task_id):
+        """返回 (分镜列表, None)；任务不存在或未完成时返回 (None, 错误响应)"""
         metadata = None
         
         if task_id in self.generation_status_:
             status = self.generation_status_[task_id]
             if status['status'] != 'completed':
-                return jsonify({'error': '任务未完成'}), 400
+                return None, (jsonify({'error': '任务未完成'}), 400)
             metadata = status.get('metadata', {})
         else:
             db_record = get_statistics(session_id=task_id)
             if not db_record:
-                return jsonify({'error': '任务不存在'}), 404
+                return None, (jsonify({'error': '任务不存在'}), 404)
             
             if not db_record.get('metadata'):
-                return jsonify({'error': '任务未完成或元数据不存在'}), 400
+                return None, (jsonify({'error': '任务未完成或元数据不存在'}), 400)
             
             metadata = json.loads(db_record['metadata'])
         
+        self.storage_manager_.touch(os.path.join(get_base_dir(), task_id))
         scenes = []
         
         for scene_info in metadata.get('scenes', []):
@@ -346,12 +511,39 @@ class FlaskAppWrapper:
                     
                     scene_data['image_url'] = f"/api/file/{scene_folder}/scene.png"
                     scene_data['audio_url'] = f"/api/file/{scene_folder}/narration.mp3"
+                    # 旧任务的 metadata.json 没有音频时长，这里补上（只解析帧头）
+                    if 'audio_duration' not in scene_data and scene_data.get('audio_path'):
+                        audio_info = probe_mp3(scene_data['audio_path'])
+                        if audio_info:
+                            scene_data['audio_duration'] = audio_info['duration']
+                            scene_data['audio_sample_rate'] = audio_info['sample_rate']
+                            scene_data['audio_channels'] = audio_info['channels']
+                    scene_data['audio_variants'] = self._audio_variant_list(scene_folder, scene_data)
                     scenes.append(scene_data)
         
-        return jsonify({
-            'total_scenes': len(scenes),
-            'scenes': scenes
-        })
+        return scenes, None
+    
+    def _audio_variant_list(self, scene_folder, scene_data):
+        """客户端按顺序选第一个能播放的档位：低码率的 Opus/AAC 在前，MP3 兜底"""
+        variants = []
+        for profile, variant in (scene_data.get('audio_variants') or {}).items():
+            variants.append({
+                'format': profile,
+                'mime': variant['mime'],
+                'size': variant['size'],
+                'url': f"/api/file/{scene_folder}/{os.path.basename(variant['path'])}"
+            })
+        variants.sort(key=lambda variant: variant['size'])
+        
+        audio_path = scene_data.get('audio_path')
+        if audio_path and os.path.exists(audio_path):
+            variants.append({
+                'format': 'mp3',
+                'mime': 'audio/mpeg',
+                'size': os.path.getsize(audio_path),
+                'url': f"/api/file/{scene_folder}/narration.mp3"
+            })
+        return variants
     
     def serve_file(self, filepath):
         if not filepath.startswith('/'):
@@ -385,13 +577,10 @@ class FlaskAppWrapper:
         
         try:
             scene_folders = [scene_info['folder'] for scene_info in scenes]
-
-            temp_video_dir = os.path.join(get_base_dir(), 'temp_videos')
-            os.makedirs(temp_video_dir, exist_ok=True)
-
-            output_video_path = os.path.join(temp_video_dir, f'merged_{task_id}.mp4')
+            output_video_path = self._merged_video_path(task_id)
 
             if os.path.exists(output_video_path):
+                self.storage_manager_.touch(output_video_path)
                 return send_file(
                     output_video_path,
                     mimetype='video/mp4',
@@ -399,29 +588,118 @@ class FlaskAppWrapper:
                     download_name=f'anime_{task_id}.mp4'
                 )
             
-            merger = VideoMerger()
-            success = merger.merge_scene_videos(scene_folders, output_video_path)
-            
-            if not success:
-                return jsonify({'error': '视频合并失败'}), 500
-            
-            return send_file(
-                output_video_path,
-                mimetype='video/mp4',
-                as_attachment=True,
-                download_name=f'anime_{task_id}.mp4'
-            )
+            # 合并放到后台线程池，请求立即返回 202，客户端轮询 /api/download_status 后再来取文件
+            job = self._submit_merge_job(task_id, scene_folders, output_video_path)
+            status_url = f'/api/download_status/{task_id}'
+            return jsonify(dict(job, task_id=task_id, status_url=status_url)), 202, {'Location': status_url}
             
         except Exception as e:
             logging.error(f"下载失败: {e}")
             return jsonify({'error': f'下载失败: {str(e)}'}), 500
     
+    def get_download_status(self, task_id):
+        with self.merge_jobs_lock_:
+            job = self.merge_jobs_.get(task_id)
+            job = dict(job) if job else None
+        
+        if job is None or job['status'] == 'completed':
+            if os.path.exists(self._merged_video_path(task_id)):
+                return jsonify({'task_id': task_id, 'status': 'completed', 'message': '视频已生成',
+                                'download_url': f'/api/download/{task_id}'})
+            if job is None:
+                return jsonify({'error': '合并任务不存在'}), 404
+        
+        return jsonify(dict(job, task_id=task_id))
+    
+    def _submit_merge_job(self, task_id, scene_folders, output_video_path):
+        """同一 task_id 已有排队或进行中的合并时直接返回它；上次失败的任务重新提交"""
+        with self.merge_jobs_lock_:
+            job = self.merge_jobs_.get(task_id)
+            if job and job['status'] in ('queued', 'processing'):
+                return dict(job)
+            
+            job = {'status': 'queued', 'message': '等待合并视频...'}
+            self.merge_jobs_[task_id] = job
+            self.merge_executor_.submit(self._merge_video_async, task_id, scene_folders, output_video_path)
+            return dict(job)
+    
+    def _merge_video_async(self, task_id, scene_folders, output_video_path):
+        def update_job(status, message):
+            with self.merge_jobs_lock_:
+                self.merge_jobs_[task_id] = {'status': status, 'message': message}
+        
+        # 先合并到临时文件再改名：下载接口以文件存在作为合并完成的依据
+        partial_path = output_video_path[:-len('.mp4')] + '.partial.mp4'
+        merger = VideoMerger(hls=True)
+        try:
+            update_job('processing', f'正在合并 {len(scene_folders)} 个场景...')
+            success = merger.merge_scene_videos(scene_folders, partial_path, segment_dir=self._segment_dir(task_id))
+            
+            if not success:
+                update_job('error', '视频合并失败')
+                return
+            
+            os.replace(partial_path, output_video_path)
+            update_job('completed', '视频已生成')
+        except Exception as e:
+            logging.exception(f"视频合并失败 ({task_id}): {e}")
+            update_job('error', f'视频合并失败: {str(e)}')
+        finally:
+            merger.shutdown()
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+    
+    def serve_hls(self, task_id, filename):
+        self.storage_manager_.touch(os.path.dirname(self._segment_dir(task_id)))
+        if filename.endswith('.m3u8'):
+            # 生成过程中播放列表会不断追加，不能被缓存
+            response = send_from_directory(self._segment_dir(task_id), filename,
+                                           mimetype='application/vnd.apple.mpegurl')
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        if filename.endswith('.ts'):
+            return send_from_directory(self._segment_dir(task_id), filename, mimetype='video/mp2t')
+        if filename.endswith('.vtt'):
+            return send_from_directory(self._segment_dir(task_id), filename, mimetype='text/vtt')
+        if filename.endswith('.srt'):
+            return send_from_directory(self._segment_dir(task_id), filename, mimetype='application/x-subrip')
+        return jsonify({'error': '文件不存在'}), 404
+    
+    def get_storage_usage(self):
+        return jsonify(self.storage_manager_.get_usage())
+    
+    def _is_task_active(self, task_id):
+        """生成中或合并中的任务，其产物不能被存储清理删除"""
+        status = self.generation_status_.get(task_id)
+        if status and status['status'] == 'processing':
+            return True
+        with self.merge_jobs_lock_:
+            if task_id in self.preview_jobs_:
+                return True
+            job = self.merge_jobs_.get(task_id)
+            return bool(job and job['status'] in ('queued', 'processing'))
+    
+    def _merged_video_path(self, task_id):
+        temp_video_dir = os.path.join(get_base_dir(), 'temp_videos')
+        os.makedirs(temp_video_dir, exist_ok=True)
+        return os.path.join(temp_video_dir, f'merged_{task_id}.mp4')
+    
+    def _preview_path(self, session_id):
+        preview_dir = os.path.join(get_base_dir(), 'previews')
+        os.makedirs(preview_dir, exist_ok=True)
+        return os.path.join(preview_dir, f'{session_id}.mp4')
+    
+    def _segment_dir(self, task_id):
+        """任务的视频片段目录：生成时后台预编码写入，下载合并时复用"""
+        return os.path.join(get_base_dir(), 'temp_videos', task_id, 'segments')
+    
     def run(self, debug=True, host='0.0.0.0'):
         self.app_.run(debug=debug, host=host, port=self.port_)
 
 
 def main(port):
     server = FlaskAppWrapper('novel_to_anime', port=port)
+    server.storage_manager_.start()
     WSGIServer(('0.0.0.0', server.port_), server.app_).serve_forever()
 
 if __name__ == '__main__':